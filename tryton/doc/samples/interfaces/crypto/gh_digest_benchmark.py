@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                       gh_digest_benchmark.py                          #
+#     Compares the legacy serialization of the documents digests        #
+#     with the canonical one, on large patient evaluations              #
+#########################################################################
+
+# It only needs the health_crypto package in the python path, no
+# database. The evaluations are generated with many signs and symptoms
+# and long texts.
+#
+# Usage: gh_digest_benchmark [evaluations] [signs] [text size]
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import random
+import sys
+import time
+import tracemalloc
+
+from trytond.modules.health_crypto.health_crypto import HealthCrypto
+
+
+def evaluation_sections(n, signs, text_size):
+    start = datetime(2022, 1, 1) + timedelta(minutes=n)
+    text = ''.join(random.choice('abcdefghij ') for _ in range(text_size))
+    return {
+        'encounter': {
+            'patient': 'Patient %s' % n,
+            'evaluation_start': start,
+            'evaluation_endtime': start + timedelta(minutes=30),
+            'healthprof': 'Health Professional',
+            'visit_type': 'followup',
+            },
+        'anamnesis': {
+            'chief_complaint': 'Headache',
+            'present_illness': text,
+            'evaluation_summary': text,
+            'signs_and_symptoms': [
+                {'clinical': 'Sign %s' % i, 'sign_or_symptom': 'symptom'}
+                for i in range(signs)],
+            },
+        'clinical': {
+            'systolic': 120,
+            'diastolic': 80,
+            'temperature': 36.5,
+            'weight': Decimal('70.25'),
+            },
+        'diagnosis': {'diagnosis': 'J11', 'info_diagnosis': text},
+        'treatment': {'directions': text},
+        }
+
+
+def legacy_digest(crypto, sections):
+    # Flat dictionary of strings, dumped and hashed as a whole
+    data = {}
+    for section in sections.values():
+        for key, value in section.items():
+            data[key] = value if isinstance(value, list) else str(value)
+    return crypto.gen_hash(str(crypto.serialize(data)))
+
+
+def canonical_digest(crypto, sections):
+    return crypto.gen_section_digests(sections)[0]
+
+
+def measure(label, function, crypto, documents):
+    start = time.time()
+    for sections in documents:
+        function(crypto, sections)
+    elapsed = time.time() - start
+
+    # Memory is traced in a second pass, tracing slows down the first one
+    tracemalloc.start()
+    for sections in documents:
+        function(crypto, sections)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-10s %6.3f s  %8.1f docs/s  peak %8.1f KiB" % (
+        label, elapsed, len(documents) / elapsed, peak / 1024))
+
+
+if __name__ == '__main__':
+    evaluations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    signs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    text_size = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+    crypto = HealthCrypto()
+    documents = [
+        evaluation_sections(n, signs, text_size)
+        for n in range(evaluations)]
+
+    print("%s evaluations, %s signs and symptoms, texts of %s chars" % (
+        evaluations, signs, text_size))
+    measure('legacy', legacy_digest, crypto, documents)
+    measure('canonical', canonical_digest, crypto, documents)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                     gh_patient_tree_benchmark.py                      #
+#     Counts the SQL queries needed to read a page of patients, as      #
+#     the client does when opening the patient list                     #
+#########################################################################
+
+# It runs on the server host, with the same configuration file as the
+# GNU Health server (PostgreSQL backend).
+# Run it before and after upgrading the health package, with a different
+# label, to record both results in the same CSV file.
+#
+# Usage: gh_patient_tree_benchmark <trytond.conf> <dbname> <label>
+#           [page size] [csv file]
+
+from datetime import datetime
+import csv
+import sys
+import time
+
+from psycopg2.extensions import cursor as pg_cursor
+
+from trytond.config import config
+
+# Fields of the patient tree view and the Function fields
+# computed from the person and the death certificate
+FIELDS = [
+    'rec_name', 'age', 'puid', 'lastname', 'active',
+    'dob', 'gender', 'marital_status', 'deceased', 'dod', 'cod',
+    'childbearing_age', 'photo',
+    ]
+
+
+class CountingCursor(pg_cursor):
+    queries = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.queries += 1
+        return super().execute(query, vars)
+
+
+def benchmark(dbname, label, page_size, csv_file):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(dbname)
+    pool.init()
+
+    with Transaction().start(dbname, 0, readonly=True) as transaction:
+        User = pool.get('res.user')
+        Patient = pool.get('gnuhealth.patient')
+
+        context = User.get_preferences(context_only=True)
+        with transaction.set_context(context):
+            ids = list(map(int, Patient.search([], limit=page_size)))
+
+            transaction.connection.cursor_factory = CountingCursor
+            start = time.time()
+            Patient.read(ids, FIELDS)
+            elapsed = time.time() - start
+
+    print("%s: %s patients read with %s queries in %.3f s" % (
+        label, len(ids), CountingCursor.queries, elapsed))
+
+    with open(csv_file, 'a', newline='') as results:
+        csv.writer(results).writerow([
+            datetime.now().isoformat(), label, len(ids),
+            CountingCursor.queries, '%.3f' % elapsed])
+
+
+if (len(sys.argv) < 4):
+    exit("usage: ./gh_patient_tree_benchmark <trytond.conf> <dbname> <label>"
+         " [page size] [csv file]")
+
+conf_file, dbname, label = sys.argv[1:4]
+page_size = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+csv_file = sys.argv[5] if len(sys.argv) > 5 else 'patient_tree_benchmark.csv'
+
+config.update_etc(conf_file)
+benchmark(dbname, label, page_size, csv_file)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                       gh_import_benchmark.py                          #
+#     Measures the bulk import of persons, with and without the         #
+#     health_federation package installed on the database               #
+#########################################################################
+
+# Run it against two databases, one of them with health_federation
+# installed, to compare the cost of enqueuing the persons.
+#
+# Usage: gh_import_benchmark <hostname> <port> <user> <password> <dbname>
+#           [persons] [batch]
+
+from datetime import date, timedelta
+from uuid import uuid4
+import random
+import sys
+import time
+
+from proteus import Model
+from proteus import config as pconfig
+
+
+def person_values(n):
+    # Federation account and PUID must be unique
+    puid = uuid4().hex[:12].upper()
+    return {
+        'name': 'Person%s' % n,
+        'lastname': 'Benchmark',
+        'is_person': True,
+        'gender': random.choice(['m', 'f']),
+        'dob': date(1940, 1, 1) + timedelta(days=random.randint(0, 29000)),
+        'fed_country': 'XXX',
+        'federation_account': 'XXX' + puid,
+        }
+
+
+def import_persons(conf, persons, batch):
+    Party = Model.get('party.party')
+    Module = Model.get('ir.module')
+
+    federation = Module.find([
+        ('name', '=', 'health_federation'),
+        ('state', '=', 'activated')])
+
+    print("Federation module installed:", bool(federation))
+    print("Importing", persons, "persons in batches of", batch, "...")
+
+    start = time.time()
+    for offset in range(0, persons, batch):
+        vlist = [
+            person_values(n)
+            for n in range(offset, min(offset + batch, persons))]
+        Party._proxy.create(vlist, conf.context)
+    elapsed = time.time() - start
+
+    print("Imported in %.1f s (%.1f persons/s)" % (
+        elapsed, persons / elapsed))
+
+    if federation:
+        Queue = Model.get('gnuhealth.federation.queue')
+        print("Messages in the federation queue",
+              Queue._proxy.search_count(
+                  [('state', '=', 'queued')], conf.context))
+
+
+if (len(sys.argv) < 6):
+    exit("usage: ./gh_import_benchmark <hostname> <port> <user> <password>"
+         " <dbname> [persons] [batch]")
+
+hostname, port, user, passwd, dbname = sys.argv[1:6]
+persons = int(sys.argv[6]) if len(sys.argv) > 6 else 50000
+batch = int(sys.argv[7]) if len(sys.argv) > 7 else 1000
+
+health_server = 'http://'+user+':'+passwd+'@'+hostname+':'+port+'/'+dbname+'/'
+
+print("Connecting to GNU Health Server ...")
+conf = pconfig.set_xmlrpc(health_server)
+print("Connected !")
+
+import_persons(conf, persons, batch)
@@ -31,6 +31,7 @@ usage = """
     Actions:
         * check: View messages in queue
         * push: Send messages to the federation
+        * bulk: Send messages to the federation in bulk
     """
 def federation_queue(action):
     Queue = Model.get('gnuhealth.federation.queue')
@@ -51,6 +52,13 @@ def federation_queue(action):
             except:
                 print ("Failed to send message ", msg.msgid)
 
+    if (action == "bulk"):
+        print ("Sending messages with status Queued in bulk...")
+        stats = Queue.send_bulk([msg.id for msg in mqueued], conf.context)
+        print ("Sent", stats['sent'], "Failed", stats['failed'],
+               "Requests", stats['requests'],
+               "Messages/s", round(stats['rate'], 1))
+
 
 
 if (len(sys.argv) < 2):
@@ -14,7 +14,12 @@
 
 import pytz
 
+from sql import Literal, Null
+from sql.aggregate import Count
+from sql.conditionals import Case, Coalesce
+from sql.functions import Age, Extract
 from dateutil.relativedelta import relativedelta
+from functools import lru_cache
 from datetime import datetime
 from trytond.transaction import Transaction
 from trytond.pool import Pool
@@ -47,6 +52,22 @@ def convert_date_timezone(sdate, target):
     return res
 
 
+def get_institution_timezone():
+    """
+    Return the name of the institution (company) timezone.
+    Defaults to UTC when the company has no timezone defined
+    """
+
+    Company = Pool().get('company.company')
+
+    company_id = Transaction().context.get('company')
+    if company_id:
+        company = Company(company_id)
+        if company.timezone:
+            return company.timezone
+    return 'UTC'
+
+
 def estimated_date_from_years(years_old):
     """ returns a date of substracting the
         referred number of years from today's date
@@ -59,6 +80,57 @@ def estimated_date_from_years(years_old):
     return est_dob
 
 
+def _age_end_date(end):
+    # Dates of death are stored as datetime
+    if end is None:
+        return datetime.today().date()
+    if isinstance(end, datetime):
+        return end.date()
+    return end
+
+
+@lru_cache(maxsize=4096)
+def _age_delta(dob, end):
+    rdelta = relativedelta(end, dob)
+    return (rdelta.years, rdelta.months, rdelta.days)
+
+
+def compute_age(dob, end=None):
+    """ Return the age as a tuple of integers (years, months, days)
+
+    dob: date of birth
+    end: date or datetime to compute the age at (eg, date of death).
+       Defaults to today.
+
+    The result is memoised per (dob, end date), so computing the age
+    of many persons does not compute again the same dates.
+    """
+    if not dob:
+        return None
+    return _age_delta(dob, _age_end_date(end))
+
+
+def compute_age_in_days(dob, end=None):
+    """ Return the age in days at the end date (today by default) """
+    if not dob:
+        return None
+    return (_age_end_date(end) - dob).days
+
+
+def format_age(age):
+    """ Return the (years, months, days) age in the "Yy Mm Dd" format """
+    if age is None:
+        return None
+    return '%sy %sm %sd' % age
+
+
+def sql_age_years(dob, end):
+    """ Return the SQL expression of the age in full years
+    between the dob and end date columns or values
+    """
+    return Extract('YEAR', Age(end, dob))
+
+
 def compute_age_from_dates(dob, deceased, dod, gender, caller, extra_date):
     """ Get the person's age.
 
@@ -70,43 +142,75 @@ def compute_age_from_dates(dob, deceased, dod, gender, caller, extra_date):
        caller == 'raw_age': [Y, M, D]
 
     """
-    today = datetime.today().date()
+    if not dob:
+        return None
 
-    if dob:
-        start = datetime.strptime(str(dob), '%Y-%m-%d')
-        end = datetime.strptime(str(today), '%Y-%m-%d')
+    end = extra_date
+    if deceased and dod:
+        end = dod
 
-        if extra_date:
-            end = datetime.strptime(str(extra_date), '%Y-%m-%d')
+    age = compute_age(dob, end)
 
-        if deceased and dod:
-            end = datetime.strptime(
-                        str(dod), '%Y-%m-%d %H:%M:%S')
+    if caller == 'age':
+        return format_age(age)
 
-        rdelta = relativedelta(end, start)
+    elif caller == 'childbearing_age':
+        return is_childbearing_age(age[0], gender)
 
-        years_months_days = str(rdelta.years) + 'y ' \
-            + str(rdelta.months) + 'm ' \
-            + str(rdelta.days) + 'd'
+    elif caller == 'raw_age':
+        return list(age)
 
     else:
         return None
 
-    if caller == 'age':
-        return years_months_days
 
-    elif caller == 'childbearing_age':
-        if (rdelta.years >= 11
-           and rdelta.years <= 55 and gender == 'f'):
-            return True
-        else:
-            return False
+def is_childbearing_age(years, gender):
+    return bool(years is not None
+                and years >= 11 and years <= 55 and gender == 'f')
 
-    elif caller == 'raw_age':
-        return [rdelta.years, rdelta.months, rdelta.days]
 
-    else:
-        return None
+def get_population_pyramid(band_edges=None, reference_date=None):
+    """ Return the living persons segmented by age band and gender,
+    computed in a single query.
+
+    band_edges: ascending list of ages (years) where each band starts.
+       Defaults to bands of 5 years, from 0 to 105 and over.
+       The last band is open ended.
+    reference_date: date to compute the age. Defaults to today.
+
+    Returns a matrix with one row per band. Each row is a dictionary
+    with the number of persons of each gender, eg [{'f': 10, 'm': 8}, ...]
+    """
+    Party = Pool().get('party.party')
+    party = Party.__table__()
+
+    if band_edges is None:
+        band_edges = list(range(0, 110, 5))
+    if reference_date is None:
+        reference_date = datetime.today().date()
+
+    # A person belongs to the band i when the date of birth is
+    # within (dob of age band_edges[i+1], dob of age band_edges[i]]
+    whens = []
+    for band, edge in enumerate(band_edges[1:]):
+        edge_dob = reference_date - relativedelta(years=edge)
+        whens.append((party.dob > edge_dob, band))
+    band = Case(*whens, else_=len(band_edges) - 1)
+
+    cursor = Transaction().connection.cursor()
+    cursor.execute(*party.select(
+            band, party.gender, Count(Literal(1)),
+            where=((party.is_person == Literal(True))
+                & (Coalesce(party.deceased, False) == Literal(False))
+                & (party.gender != Null)
+                & (party.dob <= reference_date - relativedelta(
+                    years=band_edges[0]))),
+            group_by=[band, party.gender]))
+
+    pyramid = [{} for edge in band_edges]
+    for band, gender, count in cursor:
+        pyramid[band][gender] = count
+    return pyramid
 
 
 def get_institution():
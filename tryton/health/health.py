@@ -20,7 +20,6 @@ import string
 import random
 import pytz
 
-from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta, date
 from urllib.parse import urlencode
 from urllib.parse import urlunparse
@@ -28,7 +27,9 @@ from collections import OrderedDict
 from io import BytesIO
 from uuid import uuid4
 
-from sql import Literal, Join
+from sql import Literal, Join, Null
+from sql.conditionals import Case
+from sql.functions import CurrentDate
 
 from trytond.model import (ModelView, ModelSingleton, ModelSQL,
                            MultiValueMixin, fields, Unique, tree)
@@ -38,6 +39,7 @@ from trytond.pyson import Eval, Not, Bool, PYSONEncoder, Equal, And, Or
 from trytond.pool import Pool, PoolMeta
 from trytond.rpc import RPC
 from trytond.i18n import gettext
+from trytond.tools import grouped_slice, reduce_ids
 
 
 from .exceptions import (
@@ -49,7 +51,8 @@ from .exceptions import (
     )
 
 from .core import (get_institution, compute_age_from_dates,
-                   estimated_date_from_years,
+                   compute_age, format_age, is_childbearing_age,
+                   sql_age_years, estimated_date_from_years,
                    get_health_professional)
 
 
@@ -327,6 +330,55 @@ class Party(metaclass=PoolMeta):
             self.dob, self.deceased,
             self.dod, self.gender, name, None)
 
+    @classmethod
+    def get_person_age(cls, parties, names):
+        """ Compute the age of the persons in bulk, reading the dates of
+            birth and death in a single query per slice of ids
+        """
+        pool = Pool()
+        DeathCertificate = pool.get('gnuhealth.death_certificate')
+        party = cls.__table__()
+        certificate = DeathCertificate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {name: {p.id: None for p in parties} for name in names}
+        for sub_ids in grouped_slice([p.id for p in parties]):
+            cursor.execute(*party.join(certificate, 'LEFT',
+                    condition=certificate.id == party.death_certificate
+                    ).select(
+                    party.id, party.dob, party.deceased, certificate.dod,
+                    where=reduce_ids(party.id, sub_ids)))
+            for party_id, dob, deceased, dod in cursor:
+                age = compute_age(dob, dod if deceased else None)
+                if age is None:
+                    continue
+                if 'age' in result:
+                    result['age'][party_id] = format_age(age)
+                if 'age_years' in result:
+                    result['age_years'][party_id] = age[0]
+        return result
+
+    @classmethod
+    def search_age_years(cls, name, clause):
+        pool = Pool()
+        DeathCertificate = pool.get('gnuhealth.death_certificate')
+        party = cls.__table__()
+        certificate = DeathCertificate.__table__()
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        # Age at the date of death for the deceased persons
+        end = Case(
+            ((party.deceased == Literal(True)) & (certificate.dod != Null),
+                certificate.dod),
+            else_=CurrentDate())
+        query = party.join(certificate, 'LEFT',
+            condition=certificate.id == party.death_certificate
+            ).select(party.id,
+            where=(party.dob != Null)
+            & Operator(sql_age_years(party.dob, end), value))
+        return [('id', 'in', query)]
+
     def get_du_address(self, name):
         if (self.du):
             return self.du.address_repr
@@ -390,7 +442,13 @@ class Party(metaclass=PoolMeta):
     est_dob = fields.Boolean('Est', help="Estimated from referred years")
     est_years = fields.Integer('Years', help="Referred years")
 
-    age = fields.Function(fields.Char('Age'), 'person_age')
+    age = fields.Function(fields.Char('Age'), 'get_person_age')
+    age_years = fields.Function(
+        fields.Integer(
+            'Age (years)',
+            help="Age in full years, at the date of death for deceased"
+                 " persons"),
+        'get_person_age', searcher='search_age_years')
 
     gender = fields.Selection([
         (None, ''),
@@ -2825,14 +2883,7 @@ class DeathCertificate (ModelSQL, ModelView):
             })
 
     def get_age_at_death(self, name):
-        if (self.name.dob):
-            delta = relativedelta(self.dod, self.name.dob)
-            years_months_days = str(delta.years) + 'y ' \
-                + str(delta.months) + 'm ' \
-                + str(delta.days) + 'd'
-        else:
-            years_months_days = None
-        return years_months_days
+        return format_age(compute_age(self.name.dob, self.dod))
 
 
 class Product(ModelSQL, ModelView):
@@ -2895,12 +2946,12 @@ class PatientData(ModelSQL, ModelView):
         help="Person associated to this patient")
 
     lastname = fields.Function(
-        fields.Char('Lastname'), 'get_patient_lastname',
+        fields.Char('Lastname'), 'get_patient_data',
         searcher='search_patient_lastname')
 
     puid = fields.Function(
         fields.Char('PUID', help="Person Unique Identifier"),
-        'get_patient_puid', searcher='search_patient_puid')
+        'get_patient_data', searcher='search_patient_puid')
 
     family = fields.Many2One(
         'gnuhealth.family', 'Family', help='Family Code')
@@ -2933,9 +2984,12 @@ class PatientData(ModelSQL, ModelView):
     # Retrieves the information from the party.
     #    dob = fields.Date('DoB', help='Date of Birth')
 
-    dob = fields.Function(fields.Date('DoB'), 'get_patient_dob')
+    dob = fields.Function(fields.Date('DoB'), 'get_patient_data')
 
-    age = fields.Function(fields.Char('Age'), 'get_patient_age')
+    age = fields.Function(fields.Char('Age'), 'get_patient_data')
+    age_years = fields.Function(
+        fields.Integer('Age (years)'),
+        'get_patient_data', searcher='search_patient_age_years')
 
     gender = fields.Function(fields.Selection([
         (None, ''),
@@ -2943,7 +2997,7 @@ class PatientData(ModelSQL, ModelView):
         ('f', 'Female'),
         ('f-m', 'Female -> Male'),
         ('m-f', 'Male -> Female'),
-        ], 'Gender'), 'get_patient_gender')
+        ], 'Gender'), 'get_patient_data')
 
     biological_sex = fields.Selection([
         (None, ''),
@@ -2966,7 +3020,7 @@ class PatientData(ModelSQL, ModelView):
             ('d', 'Divorced'),
             ('x', 'Separated'),
             ], 'Marital Status', sort=False, help="Marital Status"),
-        'get_patient_marital_status')
+        'get_patient_data')
 
     blood_type = fields.Selection([
         (None, ''),
@@ -3026,24 +3080,24 @@ class PatientData(ModelSQL, ModelView):
         'General Information',
         help='General information about the patient')
 
-    deceased = fields.Function(fields.Boolean('Deceased'), 'check_is_alive')
+    deceased = fields.Function(fields.Boolean('Deceased'), 'get_patient_data')
 
     dod = fields.Function(fields.DateTime(
         'Date of Death',
         states={
             'invisible': Not(Bool(Eval('deceased'))),
             },
-        depends=['deceased']), 'get_dod')
+        depends=['deceased']), 'get_patient_data')
 
     cod = fields.Function(fields.Many2One(
         'gnuhealth.pathology', 'Cause of Death',
         states={
             'invisible': Not(Bool(Eval('deceased'))),
             },
-        depends=['deceased']), 'get_cod')
+        depends=['deceased']), 'get_patient_data')
 
     childbearing_age = fields.Function(
-        fields.Boolean('Potential for Childbearing'), 'get_childbearing_age')
+        fields.Boolean('Potential for Childbearing'), 'get_patient_data')
 
     appointments = fields.One2Many(
         'gnuhealth.appointment', 'patient', 'Appointments')
@@ -3090,47 +3144,71 @@ class PatientData(ModelSQL, ModelView):
         ]
         cls._order.insert(0, ('name', 'ASC'))
 
-    def get_patient_dob(self, name):
-        return self.name.dob
-
-    def get_patient_gender(self, name):
-        gender = self.name.gender
-        sex = self.biological_sex
-        if sex:
-            if (gender != sex):
-                res = sex + '-' + gender
-            else:
-                res = gender
-        else:
-            res = gender
-        return res
-
-    def get_patient_photo(self, name):
-        return self.name.photo
-
-    def get_patient_puid(self, name):
-        return self.name.ref
-
-    def get_patient_marital_status(self, name):
-        return self.name.marital_status
-
-    def check_is_alive(self, name):
-        return self.name.deceased
-
-    def get_patient_age(self, name):
-        return self.name.age
-
-    def get_childbearing_age(self, name):
-        return compute_age_from_dates(
-            self.dob, self.deceased, self.dod, self.gender, name, None)
+    @classmethod
+    def get_patient_data(cls, patients, names):
+        """ Read the person and death certificate information of the
+            patients in one joined query per slice of ids
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        DeathCertificate = pool.get('gnuhealth.death_certificate')
+        patient = cls.__table__()
+        party = Party.__table__()
+        certificate = DeathCertificate.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {name: {p.id: None for p in patients} for name in names}
+        for sub_ids in grouped_slice([p.id for p in patients]):
+            cursor.execute(*patient.join(party,
+                    condition=party.id == patient.name
+                    ).join(certificate, 'LEFT',
+                    condition=certificate.id == party.death_certificate
+                    ).select(
+                    patient.id, patient.biological_sex, party.gender,
+                    party.dob, party.ref, party.lastname,
+                    party.marital_status, party.deceased,
+                    certificate.dod, certificate.cod,
+                    where=reduce_ids(patient.id, sub_ids)))
+            for (patient_id, sex, gender, dob, puid, lastname,
+                    marital_status, deceased, dod, cod) in cursor:
+                if not deceased:
+                    dod = cod = None
+                age = compute_age(dob, dod)
+                if sex and gender and gender != sex:
+                    gender = sex + '-' + gender
+                elif sex:
+                    gender = sex
+                values = {
+                    'dob': dob,
+                    'gender': gender,
+                    'puid': puid,
+                    'lastname': lastname,
+                    'marital_status': marital_status,
+                    'deceased': bool(deceased),
+                    'dod': dod,
+                    'cod': cod,
+                    'age': format_age(age),
+                    'age_years': age and age[0],
+                    'childbearing_age': is_childbearing_age(
+                        age and age[0], gender),
+                    }
+                for name in names:
+                    result[name][patient_id] = values[name]
+        return result
 
-    def get_dod(self, name):
-        if (self.deceased):
-            return self.name.death_certificate.dod
+    @classmethod
+    def get_patient_photo(cls, patients, name):
+        Party = Pool().get('party.party')
+        photos = {}
+        for sub_patients in grouped_slice(patients):
+            sub_patients = list(sub_patients)
+            photos.update((p['id'], p['photo']) for p in Party.read(
+                    list({p.name.id for p in sub_patients}), ['photo']))
+        return {p.id: photos.get(p.name.id) for p in patients}
 
-    def get_cod(self, name):
-        if (self.deceased):
-            return self.name.death_certificate.cod.id
+    @classmethod
+    def search_patient_age_years(cls, name, clause):
+        return [('name.age_years',) + tuple(clause[1:])]
 
     # Show the gender upon entering the individual
     @fields.depends('name')
@@ -3146,9 +3224,6 @@ class PatientData(ModelSQL, ModelView):
         res.append(('name.ref', clause[1], value))
         return res
 
-    def get_patient_lastname(self, name):
-        return self.name.lastname
-
     @classmethod
     def search_patient_lastname(cls, name, clause):
         res = []
@@ -15,6 +15,8 @@
 from trytond.report import Report
 from trytond.pool import Pool
 
+from ..core import compute_age
+
 __all__ = ['ImmunizationStatusReport']
 
 
@@ -50,21 +52,20 @@ class ImmunizationStatusReport(Report):
 
         immunizations_for_age = []
 
+        # Age of the person in years and months
+        age = compute_age(
+            patient.dob, patient.dod if patient.deceased else None)
+        if age is None:
+            return immunizations_for_age
+        pyears, pmonths, _ = age
+        pmonths = (pyears*12)+pmonths
+
         for vaccine in immunization_schedule.vaccines:
 
             for dose in vaccine.doses:
                 dose_number, dose_age, age_unit = dose.dose_number, \
                     dose.age_dose, dose.age_unit
 
-                p_age = [patient.age.split(' ')[0][:-1],
-                         patient.age.split(' ')[1][:-1],
-                         patient.age.split(' ')[2][:-1]]
-
-                # Age of the person in years and months
-                pyears, pmonths = int(p_age[0]), int(p_age[1])
-
-                pmonths = (pyears*12)+pmonths
-
                 if ((age_unit == 'months' and pmonths >= dose_age) or
                         (age_unit == 'years' and pyears >= dose_age)):
                     immunization_info = {
@@ -0,0 +1,35 @@
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                           HEALTH package                              #
+#     stub_server.py local HTTP server for the tests of the clients     #
+#     of remote services (Thalamus, Orthanc ...)                        #
+#########################################################################
+import threading
+from http.server import ThreadingHTTPServer
+
+
+def start_stub_server(test, handler, **attributes):
+    """ Serve the request handler on a free local port until the end
+        of the test. The attributes are set on the server, so the handler
+        can reach them as self.server.<name>.
+        Returns the server and its base URL """
+    server = ThreadingHTTPServer(('localhost', 0), handler)
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+    test.addCleanup(stop)
+    return server, 'http://localhost:%s' % server.server_port
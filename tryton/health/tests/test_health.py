@@ -12,8 +12,14 @@
 #                test_health.py health unittest file                    #
 #########################################################################
 import unittest
+from datetime import date, datetime
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+
+from trytond.modules.health.core import (
+    compute_age, compute_age_in_days, compute_age_from_dates, format_age,
+    is_childbearing_age)
 
 
 class HealthTestCase(ModuleTestCase):
@@ -22,6 +28,117 @@ class HealthTestCase(ModuleTestCase):
     '''
     module = 'health'
 
+    def test_compute_age(self):
+        'Test compute_age'
+        self.assertEqual(
+            compute_age(date(2000, 2, 29), date(2021, 3, 1)), (21, 0, 1))
+        self.assertEqual(
+            compute_age(date(2000, 1, 15), datetime(2000, 3, 14, 23, 0)),
+            (0, 1, 28))
+        self.assertIsNone(compute_age(None))
+        self.assertEqual(
+            compute_age_in_days(date(2000, 1, 1), date(2001, 1, 1)), 366)
+        self.assertEqual(format_age((21, 0, 1)), '21y 0m 1d')
+
+    def test_compute_age_from_dates(self):
+        'Test compute_age_from_dates'
+        dob = date(1980, 5, 10)
+        dod = datetime(2020, 5, 9, 10, 30)
+        self.assertEqual(
+            compute_age_from_dates(dob, True, dod, 'f', 'age', None),
+            '39y 11m 29d')
+        self.assertEqual(
+            compute_age_from_dates(dob, False, None, 'f', 'raw_age',
+                                   date(1990, 5, 10)),
+            [10, 0, 0])
+        self.assertTrue(
+            compute_age_from_dates(dob, True, dod, 'f', 'childbearing_age',
+                                   None))
+        self.assertFalse(
+            compute_age_from_dates(dob, True, dod, 'm', 'childbearing_age',
+                                   None))
+
+    @with_transaction()
+    def test_patient_data(self):
+        'Test get_patient_data for several patients'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Patient = pool.get('gnuhealth.patient')
+        Country = pool.get('country.country')
+        Pathology = pool.get('gnuhealth.pathology')
+        DeathCertificate = pool.get('gnuhealth.death_certificate')
+
+        ana, bob, carl = Party.create([{
+                    'name': name,
+                    'lastname': lastname,
+                    'is_person': True,
+                    'is_patient': True,
+                    'fed_country': 'XXX',
+                    'gender': gender,
+                    'dob': dob,
+                    } for name, lastname, gender, dob in [
+                    ('Ana', 'Betz', 'f', date(1990, 5, 10)),
+                    ('Bob', 'Cruz', 'm', date(1950, 1, 1)),
+                    ('Carl', 'Diaz', 'nb', None),
+                    ]])
+        country, = Country.create([{'name': 'Test', 'code': 'XT'}])
+        pathology, = Pathology.create([{'name': 'Test', 'code': 'T00'}])
+        certificate, = DeathCertificate.create([{
+                    'name': bob.id,
+                    'code': 'DC-1',
+                    'dod': datetime(2020, 1, 1, 10),
+                    'type_of_death': 'natural',
+                    'place_of_death': 'home',
+                    'country': country.id,
+                    'cod': pathology.id,
+                    }])
+        Party.write([bob], {
+                'deceased': True,
+                'death_certificate': certificate.id,
+                })
+        patients = Patient.create([
+                {'name': ana.id},
+                {'name': bob.id},
+                {'name': carl.id, 'biological_sex': 'm'},
+                ])
+
+        names = ['dob', 'gender', 'age', 'age_years', 'puid', 'lastname',
+            'deceased', 'dod', 'cod', 'childbearing_age']
+        data = Patient.get_patient_data(patients, names)
+        ana_id, bob_id, carl_id = [p.id for p in patients]
+        ana_age = compute_age(date(1990, 5, 10))
+
+        self.assertEqual(
+            [data['lastname'][i] for i in (ana_id, bob_id, carl_id)],
+            ['Betz', 'Cruz', 'Diaz'])
+        self.assertEqual(
+            [data['puid'][i] for i in (ana_id, bob_id, carl_id)],
+            [ana.ref, bob.ref, carl.ref])
+        self.assertEqual(
+            [data['gender'][i] for i in (ana_id, bob_id, carl_id)],
+            ['f', 'm', 'm-nb'])
+
+        self.assertEqual(data['dob'][ana_id], date(1990, 5, 10))
+        self.assertEqual(data['age'][ana_id], format_age(ana_age))
+        self.assertEqual(data['age_years'][ana_id], ana_age[0])
+        self.assertEqual(data['childbearing_age'][ana_id],
+            is_childbearing_age(ana_age[0], 'f'))
+        self.assertFalse(data['deceased'][ana_id])
+        self.assertIsNone(data['dod'][ana_id])
+        self.assertIsNone(data['cod'][ana_id])
+
+        # The age of a deceased patient is its age at the date of death
+        self.assertTrue(data['deceased'][bob_id])
+        self.assertEqual(data['dod'][bob_id], datetime(2020, 1, 1, 10))
+        self.assertEqual(data['cod'][bob_id], pathology.id)
+        self.assertEqual(data['age'][bob_id], '70y 0m 0d')
+        self.assertEqual(data['age_years'][bob_id], 70)
+        self.assertFalse(data['childbearing_age'][bob_id])
+
+        self.assertIsNone(data['dob'][carl_id])
+        self.assertIsNone(data['age'][carl_id])
+        self.assertIsNone(data['age_years'][carl_id])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
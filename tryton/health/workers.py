@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                           HEALTH package                              #
+#       workers.py: pools of processes for CPU bound rendering          #
+#########################################################################
+import importlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+__all__ = ['WorkerPool']
+
+
+def _import_modules(modules):
+    for module in modules:
+        importlib.import_module(module)
+
+
+class WorkerPool(object):
+    """ Lazily started pool of processes, shared by the threads of the
+        server. Forking the threaded server would copy the locks held by
+        its other threads, so the workers are started from a forkserver
+        (or spawned where it is not available). Each worker imports the
+        preload modules once, before its first task.
+    """
+
+    def __init__(self, workers, preload=()):
+        self.workers = workers
+        self.preload = list(preload)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        "Return the executor, or None if the pool has less than 2 workers"
+        with self._lock:
+            if self._executor is None and self.workers > 1:
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    # Only taken into account by the first pool started
+                    context.set_forkserver_preload(self.preload)
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context,
+                    initializer=_import_modules, initargs=(self.preload,))
+            return self._executor
+
+    def reset(self):
+        "Forget a broken executor, a new one is started on the next get"
+        with self._lock:
+            self._executor = None
@@ -36,6 +36,9 @@ def register():
         calendar_.Category,
         calendar_.Location,
         calendar_.Event,
+        calendar_.EventInterval,
+        calendar_.EventChange,
+        calendar_.EventICal,
         calendar_.EventCategory,
         calendar_.EventAlarm,
         calendar_.EventAttendee,
@@ -43,5 +46,6 @@ def register():
         calendar_.EventExDate,
         calendar_.EventRRule,
         calendar_.EventExRule,
+        calendar_.CalendarCron,
         res.User,
         module='health_caldav', type_='model')
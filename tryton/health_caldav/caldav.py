@@ -12,6 +12,7 @@ import urllib.request, urllib.parse, urllib.error
 import string
 import xml.dom.minidom
 from pywebdav.lib import propfind
+from pywebdav.lib.report import REPORT
 from pywebdav.lib.errors import DAV_NotFound, DAV_Error, DAV_Forbidden
 from pywebdav.lib.utils import get_uriparentpath
 from pywebdav.lib.constants import DAV_VERSION_1, DAV_VERSION_2
@@ -20,6 +21,8 @@ from trytond.modules.health_webdav3_server.protocol import TrytonDAVInterface, L
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 
+from .webdav import VALID_SYNC_TOKEN
+
 domimpl = xml.dom.minidom.getDOMImplementation()
 
 TrytonDAVInterface.PROPS['urn:ietf:params:xml:ns:caldav'] = (
@@ -31,8 +34,12 @@ TrytonDAVInterface.PROPS['urn:ietf:params:xml:ns:caldav'] = (
     'schedule-outbox-URL',
     )
 TrytonDAVInterface.PROPS['DAV:'] = tuple(list(TrytonDAVInterface.PROPS['DAV:'])
-    + ['principal-collection-set'])
+    + ['principal-collection-set', 'sync-token', 'supported-report-set'])
+TrytonDAVInterface.PROPS['http://calendarserver.org/ns/'] = (
+    'getctag',
+    )
 TrytonDAVInterface.M_NS['urn:ietf:params:xml:ns:caldav'] = '_get_caldav'
+TrytonDAVInterface.M_NS['http://calendarserver.org/ns/'] = '_get_cs'
 DAV_VERSION_1['version'] += ',calendar-access,calendar-schedule'
 DAV_VERSION_2['version'] += ',calendar-access,calendar-schedule'
 
@@ -313,3 +320,155 @@ def do_POST(self):
     return _prev_do_POST(self)
 
 WebDAVAuthRequestHandler.do_POST = do_POST
+
+
+def _get_dav_sync_token(self, uri):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname:
+        raise DAV_NotFound
+    pool = Pool(Transaction().database.name)
+    try:
+        Collection = pool.get('webdav.collection')
+    except KeyError:
+        raise DAV_NotFound
+    if not getattr(Collection, 'get_sync_token', None):
+        raise DAV_NotFound
+    try:
+        res = Collection.get_sync_token(dburi, cache=LOCAL.cache)
+    except DAV_Error as exception:
+        self._log_exception(exception)
+        raise
+    except Exception as exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    return res
+
+TrytonDAVInterface._get_dav_sync_token = _get_dav_sync_token
+TrytonDAVInterface._get_cs_getctag = _get_dav_sync_token
+
+
+def _get_dav_supported_report_set(self, uri):
+    # Only the calendars have a sync token
+    self._get_dav_sync_token(uri)
+    doc = domimpl.createDocument(None, 'supported-report-set', None)
+    reports = []
+    for ns, name in [
+            ('D:', 'sync-collection'),
+            ('C:', 'calendar-query'),
+            ('C:', 'calendar-multiget'),
+            ]:
+        supported = doc.createElement('D:supported-report')
+        report = doc.createElement('D:report')
+        element = doc.createElement(ns + name)
+        if ns == 'C:':
+            element.setAttribute('xmlns:C', 'urn:ietf:params:xml:ns:caldav')
+        report.appendChild(element)
+        supported.appendChild(report)
+        reports.append(supported)
+    return reports
+
+TrytonDAVInterface._get_dav_supported_report_set = \
+    _get_dav_supported_report_set
+
+
+def get_sync_changes(self, uri, token):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname:
+        raise DAV_Forbidden
+    pool = Pool(Transaction().database.name)
+    Collection = pool.get('webdav.collection')
+    try:
+        res = Collection.get_sync_changes(dburi, token, cache=LOCAL.cache)
+    except DAV_Error as exception:
+        self._log_exception(exception)
+        raise
+    except Exception as exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    return res
+
+TrytonDAVInterface.get_sync_changes = get_sync_changes
+
+
+class SyncCollection(REPORT):
+    "The sync-collection REPORT of RFC 6578"
+
+    def createResponse(self):
+        token = ''
+        for element in self.filter.getElementsByTagNameNS(
+                'DAV:', 'sync-token'):
+            token = ''.join(n.data for n in element.childNodes
+                if n.nodeType == n.TEXT_NODE).strip()
+        changed, removed, new_token = self._dataclass.get_sync_changes(
+            self._uri, token)
+
+        doc = domimpl.createDocument(None, 'multistatus', None)
+        ms = doc.documentElement
+        ms.setAttribute('xmlns:D', 'DAV:')
+        ms.tagName = 'D:multistatus'
+        for child in changed:
+            uri = self._uri + '/' + child
+            gp, bp = self.get_propvalues(uri)
+            ms.appendChild(self.mk_prop_response(uri, gp, bp, doc))
+        for child in removed:
+            ms.appendChild(self.mk_removed_response(
+                    self._uri + '/' + child, doc))
+        sync_token = doc.createElement('D:sync-token')
+        sync_token.appendChild(doc.createTextNode(new_token))
+        ms.appendChild(sync_token)
+        return doc.toxml(encoding='utf-8') + b'\n'
+
+    def mk_removed_response(self, uri, doc):
+        re = doc.createElement('D:response')
+        if self._dataclass.baseurl:
+            uri = self._dataclass.baseurl + '/' + '/'.join(uri.split('/')[3:])
+        uparts = urllib.parse.urlparse(uri)
+        href = doc.createElement('D:href')
+        href.appendChild(doc.createTextNode(uparts[0] + '://' + uparts[1]
+                + urllib.parse.quote(uparts[2])))
+        re.appendChild(href)
+        status = doc.createElement('D:status')
+        status.appendChild(doc.createTextNode('HTTP/1.1 404 Not Found'))
+        re.appendChild(status)
+        return re
+
+
+def do_REPORT(self):
+    dc = self.IFACE_CLASS
+
+    # read the body containing the xml request
+    body = None
+    if 'Content-Length' in self.headers:
+        l = self.headers['Content-Length']
+        body = self.rfile.read(int(l))
+
+    uri = urllib.parse.unquote(
+        urllib.parse.urljoin(self.get_baseuri(dc), self.path))
+
+    report_class = REPORT
+    if body:
+        root = xml.dom.minidom.parseString(body).documentElement
+        if (root.namespaceURI == 'DAV:'
+                and root.localName == 'sync-collection'):
+            report_class = SyncCollection
+    rp = report_class(uri, dc, self.headers.get('Depth', '0'), body)
+
+    try:
+        DATA = rp.createResponse()
+    except DAV_Error as error:
+        (ec, dd) = error.args
+        if ec == 403 and dd == VALID_SYNC_TOKEN:
+            # The precondition tells the client to sync again (RFC 6578)
+            doc = domimpl.createDocument(None, 'error', None)
+            root = doc.documentElement
+            root.setAttribute('xmlns:D', 'DAV:')
+            root.tagName = 'D:error'
+            root.appendChild(doc.createElement('D:' + VALID_SYNC_TOKEN))
+            return self.send_body(doc.toxml(encoding='utf-8'), 403,
+                'Forbidden', 'Forbidden', ctype='text/xml; charset="utf-8"')
+        return self.send_status(ec)
+
+    self.send_body_chunks_if_http11(DATA, 207, 'Multi-Status',
+        'Multiple responses')
+
+WebDAVAuthRequestHandler.do_REPORT = do_REPORT
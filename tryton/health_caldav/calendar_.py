@@ -14,13 +14,17 @@ import pytz
 import datetime
 import xml.dom.minidom
 from sql import Null
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
 
+from trytond import backend
+from trytond.config import config
 from trytond.model import Model, ModelSQL, ModelView, fields, Check, Unique
 from trytond.tools import reduce_ids, grouped_slice
 from trytond.pyson import If, Bool, Eval
 from trytond.transaction import Transaction
 from trytond.cache import Cache
-from trytond.pool import Pool
+from trytond.pool import Pool, PoolMeta
 from trytond.i18n import gettext
 
 from .exceptions import (
@@ -32,17 +36,44 @@ from .exceptions import (
     InvalidByMonth, InvalidBySetPosition)
 
 __all__ = ['Calendar', 'ReadUser', 'WriteUser', 'Category', 'Location',
-           'Event', 'EventCategory', 'AlarmMixin', 'EventAlarm',
+           'Event', 'EventInterval', 'EventChange', 'EventICal',
+           'EventCategory',
+           'AlarmMixin',
+           'EventAlarm',
            'AttendeeMixin',
            'EventAttendee', 'DateMixin', 'EventRDate', 'EventExDate',
            'RRuleMixin',
-           'EventRRule', 'EventExRule']
+           'EventRRule', 'EventExRule', 'CalendarCron']
 
 
 tzlocal = dateutil.tz.tzlocal()
 tzutc = dateutil.tz.tzutc()
 domimpl = xml.dom.minidom.getDOMImplementation()
 
+# The occurences of the recurrent events are stored in the interval table
+# up to this number of days from now
+EXPANSION_DAYS = config.getint('health_caldav', 'expansion_days', default=730)
+# Expanded until value of the events whose intervals are not stored at all
+NOT_EXPANDED = datetime.datetime(1900, 1, 1)
+# The changes of the events are kept this number of days for the
+# synchronization of the clients
+SYNC_DAYS = config.getint('health_caldav', 'sync_days', default=90)
+# Fields of the events that change their busy intervals
+INTERVAL_FIELDS = {
+    'dtstart', 'dtend', 'all_day', 'timezone', 'transp', 'status',
+    'calendar', 'parent', 'recurrence', 'rdates', 'rrules', 'exdates',
+    'exrules', 'occurences',
+    }
+
+
+def to_local(value):
+    """ Return the datetime as naive local time, as stored """
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    if value.tzinfo:
+        return value.astimezone(tzlocal).replace(tzinfo=None)
+    return value
+
 
 class Calendar(ModelSQL, ModelView):
     "Calendar"
@@ -59,6 +90,10 @@ class Calendar(ModelSQL, ModelView):
     write_users = fields.Many2Many(
         'calendar.calendar-write-res.user',
         'calendar', 'user', 'Write Users')
+    sync_counter = fields.Integer('Sync Counter', readonly=True,
+        help='The number of the last change of the events')
+    sync_expired = fields.Integer('Expired Sync Counter', readonly=True,
+        help='The number of the last change removed from the log')
     _get_name_cache = Cache('calendar_calendar.get_name')
 
     @classmethod
@@ -73,6 +108,14 @@ class Calendar(ModelSQL, ModelView):
             ]
         cls._order.insert(0, ('name', 'ASC'))
 
+    @staticmethod
+    def default_sync_counter():
+        return 0
+
+    @staticmethod
+    def default_sync_expired():
+        return 0
+
     @classmethod
     def create(cls, vlist):
         calendars = super(Calendar, cls).create(vlist)
@@ -141,13 +184,39 @@ class Calendar(ModelSQL, ModelView):
             ical.vevent_list.extend(ical2.vevent_list)
         return ical
 
+    def calendar2ics(self):
+        '''
+        Return the serialized iCalendar of the calendar built from the
+        stored iCalendar of the events
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
+
+        events = Event.search([
+                ('calendar', '=', self.id),
+                ('parent', '=', None),
+                ])
+        data = ICal.get(events)
+        timezones, components = {}, []
+        for event in events:
+            event_timezones, event_components = ICal.components(
+                data[event.id])
+            timezones.update((t, None) for t in event_timezones)
+            components.extend(event_components)
+        header = vobject.iCalendar().serialize()
+        end = 'END:VCALENDAR'
+        header = header[:header.rindex(end)]
+        return ''.join([header] + list(timezones) + components
+            + [end + '\r\n'])
+
     @classmethod
     def freebusy(cls, calendar_id, dtstart, dtend):
         '''
         Return an iCalendar object for the given calendar_id with the
         vfreebusy objects between the two dates
         '''
-        Event = Pool().get('calendar.event')
+        Interval = Pool().get('calendar.event.interval')
 
         ical = vobject.iCalendar()
         ical.add('method').value = 'REPLY'
@@ -158,115 +227,27 @@ class Calendar(ModelSQL, ModelView):
                 .replace(tzinfo=tzlocal)
         else:
             ical.vfreebusy.add('dtstart').value = dtstart.astimezone(tzutc)
+            dtstart = dtstart.astimezone(tzlocal)
         if not isinstance(dtend, datetime.datetime):
             ical.vfreebusy.add('dtend').value = dtend
             dtend = datetime.datetime.combine(dtend, datetime.time.max)\
                 .replace(tzinfo=tzlocal)
         else:
             ical.vfreebusy.add('dtend').value = dtend.astimezone(tzutc)
+            dtend = dtend.astimezone(tzlocal)
 
-        with Transaction().set_user(0):
-            events = Event.search([
-                    ['OR',
-                        [('dtstart', '<=', dtstart),
-                            ('dtend', '>=', dtstart)],
-                        [('dtstart', '<=', dtend),
-                            ('dtend', '>=', dtend)],
-                        [('dtstart', '>=', dtstart),
-                            ('dtend', '<=', dtend)],
-                        [('dtstart', '>=', dtstart),
-                            ('dtstart', '<=', dtend),
-                            ('dtend', '=', None)]],
-                    ('parent', '=', None),
-                    ('rdates', '=', None),
-                    ('rrules', '=', None),
-                    ('exdates', '=', None),
-                    ('exrules', '=', None),
-                    ('occurences', '=', None),
-                    ('calendar', '=', calendar_id),
-                    ])
-
-        for event in events:
+        for calendar, freebusy_dtstart, freebusy_dtend, fbtype in \
+                Interval.search_overlap([calendar_id], dtstart, dtend):
             # Don't group freebusy as sunbird doesn't handle it
             freebusy = ical.vfreebusy.add('freebusy')
-            freebusy.fbtype_param = event._fbtype
-            if event.dtstart.replace(tzinfo=tzlocal) >= dtstart:
-                freebusy_dtstart = event.dtstart.replace(tzinfo=tzlocal)
-            else:
-                freebusy_dtstart = dtstart
-            if event.dtend.replace(tzinfo=tzlocal) <= dtend:
-                freebusy_dtend = event.dtend.replace(tzinfo=tzlocal)
-            else:
-                freebusy_dtend = dtend
+            freebusy.fbtype_param = fbtype
+            freebusy_dtstart = max(
+                freebusy_dtstart.replace(tzinfo=tzlocal), dtstart)
+            freebusy_dtend = min(
+                freebusy_dtend.replace(tzinfo=tzlocal), dtend)
             freebusy.value = [(
                 freebusy_dtstart.astimezone(tzutc),
                 freebusy_dtend.astimezone(tzutc))]
-
-        with Transaction().set_user(0):
-            events = Event.search([
-                    ('parent', '=', None),
-                    ('dtstart', '<=', dtend),
-                    ['OR',
-                        ('rdates', '!=', None),
-                        ('rrules', '!=', None),
-                        ('exdates', '!=', None),
-                        ('exrules', '!=', None),
-                        ('occurences', '!=', None),
-                     ],
-                    ('calendar', '=', calendar_id),
-                    ])
-
-        for event in events:
-            event_ical = event.event2ical()
-            if event_ical.vevent.rruleset:
-                for freebusy_dtstart in event_ical.vevent.rruleset:
-                    if freebusy_dtstart.replace(tzinfo=tzlocal) > dtend:
-                        break
-                    if not event.dtend:
-                        freebusy_dtend = freebusy_dtstart
-                    else:
-                        freebusy_dtend = event.dtend.replace(tzinfo=tzlocal)\
-                            - event.dtstart.replace(tzinfo=tzlocal) \
-                            + freebusy_dtstart
-                    f_dtstart_tz = freebusy_dtstart.replace(tzinfo=tzlocal)
-                    f_dtend_tz = freebusy_dtend.replace(tzinfo=tzlocal)
-                    if not ((f_dtstart_tz <= dtstart
-                             and f_dtend_tz >= dtstart)
-                            or (f_dtstart_tz <= dtend
-                                and f_dtend_tz >= dtend)
-                            or (f_dtstart_tz >= dtstart
-                                and f_dtend_tz <= dtend)):
-                        continue
-                    freebusy_fbtype = event._fbtype
-                    all_day = event.all_day
-                    for occurence in event.occurences:
-                        if (occurence.recurrence.replace(tzinfo=tzlocal)
-                                == f_dtstart_tz):
-                            freebusy_dtstart = \
-                                occurence.dtstart.replace(tzinfo=tzlocal)
-                            if occurence.dtend:
-                                freebusy_dtend = occurence.dtend\
-                                    .replace(tzinfo=tzlocal)
-                            else:
-                                freebusy_dtend = freebusy_dtstart
-                            all_day = occurence.all_day
-                            freebusy_fbtype = occurence._fbtype
-                            break
-                    freebusy = ical.vfreebusy.add('freebusy')
-                    freebusy.fbtype_param = freebusy_fbtype
-                    if f_dtstart_tz <= dtstart:
-                        freebusy_dtstart = dtstart
-                    if f_dtend_tz >= dtend:
-                        freebusy_dtend = dtend
-                    if all_day:
-                        freebusy.value = [(
-                                f_dtstart_tz.astimezone(tzutc),
-                                f_dtend_tz.astimezone(tzutc),
-                                )]
-                    else:
-                        freebusy.value = [(
-                            freebusy_dtstart.astimezone(tzutc),
-                            freebusy_dtend.astimezone(tzutc))]
         return ical
 
     @classmethod
@@ -493,6 +474,9 @@ class Event(ModelSQL, ModelView):
             'required': Bool(Eval('_parent_parent')),
             }, depends=['parent'])
     vevent = fields.Binary('vevent')
+    expanded_until = fields.DateTime('Expanded Until', readonly=True,
+        help="The occurences after this date are not stored yet in the"
+             " busy intervals")
 
     @classmethod
     def __setup__(cls):
@@ -572,6 +556,9 @@ class Event(ModelSQL, ModelView):
         pool = Pool()
         Calendar = pool.get('calendar.calendar')
         Collection = pool.get('webdav.collection')
+        Interval = pool.get('calendar.event.interval')
+        Change = pool.get('calendar.event.change')
+        ICal = pool.get('calendar.event.ical')
 
         events = super(Event, cls).create(vlist)
         for event in events:
@@ -620,6 +607,9 @@ class Event(ModelSQL, ModelView):
                                         'parent': parent.id,
                                         'uuid': event.uuid,
                                         })
+        Interval.refresh(events)
+        Change.record(events)
+        ICal.invalidate(events)
         # Restart the cache for event
         Collection._event_cache.clear()
         return events
@@ -653,18 +643,33 @@ class Event(ModelSQL, ModelView):
         pool = Pool()
         Calendar = pool.get('calendar.calendar')
         Collection = pool.get('webdav.collection')
+        Interval = pool.get('calendar.event.interval')
+        Change = pool.get('calendar.event.change')
+        ICal = pool.get('calendar.event.ical')
         transaction = Transaction()
         cursor = transaction.connection.cursor()
 
         actions = iter(args)
         args = []
+        to_refresh = []
+        changed = []
         for events, values in zip(actions, actions):
             values = values.copy()
             if 'sequence' in values:
                 del values['sequence']
             args.extend((events, values))
+            if INTERVAL_FIELDS.intersection(values):
+                to_refresh.extend(events)
+            changed.extend(events)
+            if 'calendar' in values or 'parent' in values:
+                # The events are removed from their previous calendar
+                Change.record(events)
+                ICal.invalidate(events)
 
         super(Event, cls).write(*args)
+        Interval.refresh(to_refresh)
+        Change.record(changed)
+        ICal.invalidate(changed)
 
         table = cls.__table__()
         for sub_ids in grouped_slice(events, transaction.database.IN_MAX):
@@ -762,6 +767,13 @@ class Event(ModelSQL, ModelView):
         pool = Pool()
         Attendee = pool.get('calendar.event.attendee')
         Collection = pool.get('webdav.collection')
+        Interval = pool.get('calendar.event.interval')
+        Change = pool.get('calendar.event.change')
+        ICal = pool.get('calendar.event.ical')
+
+        # The recurrence of a deleted occurence is busy again
+        parents = {e.parent.id for e in events if e.parent} - {
+            e.id for e in events}
 
         for event in events:
             if (event.calendar.owner
@@ -804,7 +816,10 @@ class Event(ModelSQL, ModelView):
                                 Attendee.write([attendee], {
                                         'status': 'declined',
                                         })
+        Change.record(events)
+        ICal.invalidate(events)
         super(Event, cls).delete(events)
+        Interval.refresh(cls.browse(list(parents)))
         # Restart the cache for event
         Collection._event_cache.clear()
 
@@ -1206,6 +1221,443 @@ class Event(ModelSQL, ModelView):
             ical.vevent_list.append(oical.vevent)
         return ical
 
+    @property
+    def recurrent(self):
+        return bool(self.rdates or self.rrules or self.exdates
+            or self.exrules or self.occurences)
+
+    def get_rruleset(self):
+        '''
+        Return the dateutil rruleset of the recurrence of the event
+        '''
+        if self.timezone:
+            tzevent = dateutil.tz.gettz(self.timezone)
+        else:
+            tzevent = tzlocal
+
+        vevent = vobject.iCalendar().add('vevent')
+        if self.all_day:
+            vevent.add('dtstart').value = self.dtstart.date()
+        else:
+            vevent.add('dtstart').value = self.dtstart.replace(
+                tzinfo=tzlocal).astimezone(tzevent)
+        if self.rdates:
+            vevent.add('rdate').value = [
+                rdate.date2date() for rdate in self.rdates]
+        if self.exdates:
+            vevent.add('exdate').value = [
+                exdate.date2date() for exdate in self.exdates]
+        for rrule in self.rrules:
+            vevent.add('rrule').value = rrule.rule2rule()
+        for exrule in self.exrules:
+            vevent.add('exrule').value = exrule.rule2rule()
+        return vevent.rruleset
+
+    def get_intervals(self, start=None, end=None):
+        '''
+        Return the busy intervals of the event as a list of
+        (dtstart, dtend, all_day, fbtype, occurence id) that overlap start
+        and end, and the last recurrence expanded if there are more after
+        end.
+        The occurences replace the intervals of their recurrence.
+        '''
+        duration = datetime.timedelta(0)
+        if self.dtend:
+            duration = self.dtend - self.dtstart
+
+        def overlap(dtstart, dtend):
+            return ((start is None or dtend >= start)
+                and (end is None or dtstart <= end))
+
+        rruleset = self.get_rruleset() if self.recurrent else None
+        if not rruleset:
+            intervals = [(self.dtstart, self.dtstart + duration,
+                    self.all_day, self._fbtype, None)]
+            intervals += [(o.dtstart, o.dtend or o.dtstart, o.all_day,
+                    o._fbtype, o.id) for o in self.occurences]
+            return [i for i in intervals if overlap(i[0], i[1])], None
+
+        occurences = {o.recurrence: o for o in self.occurences}
+        intervals = []
+        last = None
+        for recurrence in rruleset:
+            recurrence = to_local(recurrence)
+            if end is not None and recurrence > end:
+                return intervals, last
+            last = recurrence
+            occurence = occurences.get(recurrence)
+            if occurence:
+                interval = (occurence.dtstart,
+                    occurence.dtend or occurence.dtstart,
+                    occurence.all_day, occurence._fbtype, occurence.id)
+            else:
+                interval = (recurrence, recurrence + duration,
+                    self.all_day, self._fbtype, None)
+            if overlap(interval[0], interval[1]):
+                intervals.append(interval)
+        return intervals, None
+
+
+class EventInterval(ModelSQL):
+    'Event Busy Interval'
+    __name__ = 'calendar.event.interval'
+    event = fields.Many2One(
+        'calendar.event', 'Event', required=True, select=True,
+        ondelete='CASCADE')
+    occurence = fields.Many2One(
+        'calendar.event', 'Occurence', ondelete='CASCADE')
+    calendar = fields.Many2One(
+        'calendar.calendar', 'Calendar', required=True, select=True,
+        ondelete='CASCADE')
+    dtstart = fields.DateTime('Start Date', required=True)
+    dtend = fields.DateTime('End Date', required=True)
+    all_day = fields.Boolean('All Day')
+    fbtype = fields.Char('Free/Busy Type')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super(EventInterval, cls).__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['calendar', 'dtstart', 'dtend'], 'add')
+
+        # The existing events have no interval stored yet. They are marked
+        # as not expanded at all, so search_overlap expands them on the fly
+        # until the extend cron stores their intervals.
+        if not exist:
+            event = Event.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*event.update(
+                    [event.expanded_until], [NOT_EXPANDED],
+                    where=event.parent == Null))
+
+    @classmethod
+    def refresh(cls, events):
+        '''
+        Store again the busy intervals of the events, or of their parent
+        for the occurences
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        table = cls.__table__()
+        event_table = Event.__table__()
+        cursor = Transaction().connection.cursor()
+
+        events = {e.parent.id if e.parent else e.id for e in events}
+        if not events:
+            return
+        horizon = datetime.datetime.now() + datetime.timedelta(
+            days=EXPANSION_DAYS)
+        for sub_ids in grouped_slice(list(events)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.event, sub_ids)))
+            values = []
+            truncated = {}
+            for event in Event.browse(sub_ids):
+                intervals, last = event.get_intervals(end=horizon)
+                truncated[event.id] = last
+                values.extend([event.id, occurence, event.calendar.id,
+                        dtstart, dtend, all_day, fbtype]
+                    for dtstart, dtend, all_day, fbtype, occurence
+                    in intervals)
+            for sub_values in grouped_slice(values):
+                cursor.execute(*table.insert(
+                        [table.event, table.occurence, table.calendar,
+                            table.dtstart, table.dtend, table.all_day,
+                            table.fbtype],
+                        list(sub_values)))
+            # Update with SQL to not change the sequence of the events
+            for last in set(truncated.values()):
+                cursor.execute(*event_table.update(
+                        [event_table.expanded_until], [last],
+                        where=reduce_ids(event_table.id,
+                            [i for i, l in truncated.items() if l == last])))
+
+    @classmethod
+    def search_overlap(cls, calendars, dtstart, dtend):
+        '''
+        Return the busy intervals of the calendars as a list of
+        (calendar id, dtstart, dtend, fbtype) that overlap the dates
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        dtstart, dtend = to_local(dtstart), to_local(dtend)
+        cursor.execute(*table.select(
+                table.calendar, table.dtstart, table.dtend, table.fbtype,
+                where=table.calendar.in_(calendars)
+                & (table.dtstart <= dtend) & (table.dtend >= dtstart),
+                order_by=[table.dtstart]))
+        intervals = list(cursor)
+
+        # Expand the recurrences not stored yet
+        with Transaction().set_user(0):
+            events = Event.search([
+                    ('calendar', 'in', calendars),
+                    ('parent', '=', None),
+                    ('expanded_until', '!=', None),
+                    ('expanded_until', '<', dtend),
+                    ])
+        for event in events:
+            event_intervals, _ = event.get_intervals(
+                max(dtstart, event.expanded_until), dtend)
+            intervals.extend(
+                (event.calendar.id, start, end, fbtype)
+                for start, end, _, fbtype, _ in event_intervals
+                if start > event.expanded_until)
+        return intervals
+
+    @classmethod
+    def extend(cls):
+        '''
+        Store the occurences of the recurrent events up to the expansion
+        horizon, and the intervals of the events not expanded yet
+        '''
+        Event = Pool().get('calendar.event')
+        limit = datetime.datetime.now() + datetime.timedelta(
+            days=EXPANSION_DAYS - 30)
+        cls.refresh(Event.search([
+                    ('parent', '=', None),
+                    ('expanded_until', '!=', None),
+                    ('expanded_until', '<', limit),
+                    ]))
+
+
+class EventChange(ModelSQL):
+    'Event Change'
+    __name__ = 'calendar.event.change'
+    calendar = fields.Many2One(
+        'calendar.calendar', 'Calendar', required=True, select=True,
+        ondelete='CASCADE')
+    uuid = fields.Char('UUID', required=True)
+    counter = fields.Integer('Counter', required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(EventChange, cls).__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['calendar', 'counter'], 'add')
+
+    @classmethod
+    def record(cls, events):
+        '''
+        Log a change of the events in their calendar
+        The change is numbered by the sync counter of the calendar, which
+        stays locked until the commit. So the counters are committed in
+        order and the last counter of a calendar is its sync token.
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        table = cls.__table__()
+        calendar = Calendar.__table__()
+        cursor = Transaction().connection.cursor()
+
+        uuids = {}
+        for event in events:
+            uuids.setdefault(event.calendar.id, set()).add(
+                event.parent.uuid if event.parent else event.uuid)
+        # Lock the calendars always in the same order to avoid dead locks
+        for calendar_id in sorted(uuids):
+            cursor.execute(*calendar.update(
+                    [calendar.sync_counter],
+                    [Coalesce(calendar.sync_counter, 0) + 1],
+                    where=calendar.id == calendar_id))
+            cursor.execute(*calendar.select(calendar.sync_counter,
+                    where=calendar.id == calendar_id))
+            counter, = cursor.fetchone()
+            for sub_uuids in grouped_slice(list(uuids[calendar_id])):
+                cursor.execute(*table.insert(
+                        [table.calendar, table.uuid, table.counter],
+                        [[calendar_id, u, counter] for u in sub_uuids]))
+
+    @classmethod
+    def get_token(cls, calendar_id):
+        '''
+        Return the sync counter of the calendar and the counter up to which
+        the changes have been removed from the log
+        '''
+        Calendar = Pool().get('calendar.calendar')
+        calendar = Calendar.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*calendar.select(
+                Coalesce(calendar.sync_counter, 0),
+                Coalesce(calendar.sync_expired, 0),
+                where=calendar.id == calendar_id))
+        return cursor.fetchone() or (0, 0)
+
+    @classmethod
+    def get_changes(cls, calendar_id, start, end):
+        "Return the uuids of the events changed after start up to end"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.uuid,
+                where=(table.calendar == calendar_id)
+                & (table.counter > start) & (table.counter <= end),
+                group_by=[table.uuid]))
+        return {uuid for uuid, in cursor}
+
+    @classmethod
+    def purge(cls):
+        '''
+        Remove the changes older than the sync days from the log
+        The sync tokens older than the changes removed are no more valid.
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        table = cls.__table__()
+        calendar = Calendar.__table__()
+        cursor = Transaction().connection.cursor()
+
+        limit = datetime.datetime.now() - datetime.timedelta(days=SYNC_DAYS)
+        cursor.execute(*table.select(table.calendar, Max(table.counter),
+                where=table.create_date < limit,
+                group_by=[table.calendar]))
+        for calendar_id, counter in cursor.fetchall():
+            cursor.execute(*calendar.update(
+                    [calendar.sync_expired], [counter],
+                    where=(calendar.id == calendar_id)
+                    & (Coalesce(calendar.sync_expired, 0) < counter)))
+            cursor.execute(*table.delete(
+                    where=(table.calendar == calendar_id)
+                    & (table.counter <= counter)))
+
+
+class EventICal(ModelSQL):
+    'Event iCalendar'
+    __name__ = 'calendar.event.ical'
+    event = fields.Many2One(
+        'calendar.event', 'Event', required=True, select=True,
+        ondelete='CASCADE')
+    version = fields.Char('Version', required=True)
+    data = fields.Text('Data', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EventICal, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('event_uniq', Unique(t, t.event),
+                'The iCalendar of an event must be unique.'),
+            ]
+
+    @staticmethod
+    def _version(event):
+        '''
+        Return the version of the iCalendar of the event
+        The iCalendar of a recurrence contains its occurences, so their
+        number, sequences and dates are part of its version.
+        '''
+        events = [event] + list(event.occurences)
+        return '%s-%s-%s' % (len(events),
+            sum(e.sequence for e in events),
+            max((e.write_date or e.create_date) for e in events).isoformat())
+
+    @classmethod
+    def get(cls, events):
+        '''
+        Return a dictionary with the serialized iCalendar of the events
+        The iCalendars are built with event2ical only when the events have
+        been modified since they were stored.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        versions = {e.id: cls._version(e) for e in events}
+        result = {}
+        for sub_ids in grouped_slice(list(versions)):
+            cursor.execute(*table.select(table.event, table.version,
+                    table.data, where=reduce_ids(table.event, sub_ids)))
+            for event_id, version, data in cursor:
+                if versions[event_id] == version:
+                    result[event_id] = data
+        to_store = [e for e in events if e.id not in result]
+        for event in to_store:
+            result[event.id] = event.event2ical().serialize()
+        if to_store and not Transaction().readonly:
+            cls.store([(e.id, versions[e.id], result[e.id])
+                    for e in to_store])
+        return result
+
+    @classmethod
+    def store(cls, values):
+        '''
+        Update or insert the iCalendars from the list of
+        (event id, version, data)
+        The iCalendars are mostly built while reading, so another request
+        may store the same events at the same time. Its changes are kept
+        and the savepoint lets the transaction go on.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute('SAVEPOINT calendar_event_ical')
+        try:
+            existing = set()
+            for sub_values in grouped_slice(values):
+                cursor.execute(*table.select(table.event,
+                        where=reduce_ids(table.event,
+                            [v[0] for v in sub_values])))
+                existing.update(event_id for event_id, in cursor)
+            for event_id, version, data in values:
+                if event_id in existing:
+                    cursor.execute(*table.update(
+                            [table.version, table.data], [version, data],
+                            where=table.event == event_id))
+            for sub_values in grouped_slice(
+                    [v for v in values if v[0] not in existing]):
+                cursor.execute(*table.insert(
+                        [table.event, table.version, table.data],
+                        [list(v) for v in sub_values]))
+        except (backend.DatabaseIntegrityError,
+                backend.DatabaseOperationalError):
+            cursor.execute('ROLLBACK TO SAVEPOINT calendar_event_ical')
+        else:
+            cursor.execute('RELEASE SAVEPOINT calendar_event_ical')
+
+    @classmethod
+    def invalidate(cls, events):
+        "Remove the iCalendar of the events and of their parent"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = {e.id for e in events} | {e.parent.id for e in events
+            if e.parent}
+        for sub_ids in grouped_slice(list(ids)):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.event, sub_ids)))
+
+    @staticmethod
+    def components(data):
+        '''
+        Return the VTIMEZONE and the other components of a serialized
+        iCalendar as two lists of strings
+        '''
+        timezones, components = [], []
+        lines, name = [], None
+        for line in data.splitlines(True):
+            if name is None:
+                if line.startswith('BEGIN:') and line.strip() != \
+                        'BEGIN:VCALENDAR':
+                    name = line.strip()[6:]
+                    lines = [line]
+                continue
+            lines.append(line)
+            if line.strip() == 'END:' + name:
+                if name == 'VTIMEZONE':
+                    timezones.append(''.join(lines))
+                else:
+                    components.append(''.join(lines))
+                name = None
+        return timezones, components
+
 
 class EventCategory(ModelSQL):
     'Event - Category'
@@ -1247,7 +1699,9 @@ class EventAlarm(AlarmMixin, ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
         to_write = []
         for values in vlist:
             if values.get('event'):
@@ -1255,11 +1709,15 @@ class EventAlarm(AlarmMixin, ModelSQL, ModelView):
                 to_write.append(values['event'])
         if to_write:
             Event.write(Event.browse(to_write), {})
-        return super(EventAlarm, cls).create(vlist)
+        alarms = super(EventAlarm, cls).create(vlist)
+        ICal.invalidate([x.event for x in alarms])
+        return alarms
 
     @classmethod
     def write(cls, *args):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
 
         actions = iter(args)
         events = []
@@ -1271,16 +1729,19 @@ class EventAlarm(AlarmMixin, ModelSQL, ModelView):
             # Update write_date of event
             Event.write(events, {})
         super(EventAlarm, cls).write(*args)
+        ICal.invalidate(events)
 
     @classmethod
     def delete(cls, event_alarms):
         pool = Pool()
         Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
         events = [x.event for x in event_alarms]
         if events:
             # Update write_date of event
             Event.write(events, {})
         super(EventAlarm, cls).delete(event_alarms)
+        ICal.invalidate(events)
 
 
 class AttendeeMixin:
@@ -1358,7 +1819,9 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
         to_write = []
         for values in vlist:
             if values.get('event'):
@@ -1368,6 +1831,7 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
         if to_write:
             Event.write(Event.browse(to_write), {})
         event_attendees = super(EventAttendee, cls).create(vlist)
+        ICal.invalidate([x.event for x in event_attendees])
         for event_attendee in event_attendees:
             event = event_attendee.event
             if (event.calendar.owner
@@ -1398,7 +1862,9 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
 
         actions = iter(args)
         args = []
@@ -1417,6 +1883,7 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
             Event.write(events, {})
 
         super(EventAttendee, cls).write(*args)
+        ICal.invalidate(events)
 
         for event_attendee in sum(args[::2], []):
             event = event_attendee.event
@@ -1449,6 +1916,7 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
     def delete(cls, event_attendees):
         pool = Pool()
         Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
 
         events = [x.event for x in event_attendees]
         if events:
@@ -1501,6 +1969,7 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
                                 'status': 'declined',
                                 })
         super(EventAttendee, cls).delete(event_attendees)
+        ICal.invalidate(events)
 
 
 class DateMixin:
@@ -1539,7 +2008,7 @@ class DateMixin:
         Return a datetime for date
         '''
         if self.date:
-            return self.date.datetime.date()
+            return self.datetime.date()
         else:
             # Convert to UTC as sunbird doesn't handle tzid
             return self.datetime.replace(tzinfo=tzlocal).astimezone(tzutc)
@@ -1555,7 +2024,9 @@ class EventRDate(DateMixin, ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Interval = pool.get('calendar.event.interval')
         to_write = []
         for values in vlist:
             if values.get('event'):
@@ -1563,11 +2034,15 @@ class EventRDate(DateMixin, ModelSQL, ModelView):
                 to_write.append(values['event'])
         if to_write:
             Event.write(Event.browse(to_write), {})
-        return super(EventRDate, cls).create(vlist)
+        rdates = super(EventRDate, cls).create(vlist)
+        Interval.refresh([x.event for x in rdates])
+        return rdates
 
     @classmethod
     def write(cls, *args):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Interval = pool.get('calendar.event.interval')
 
         actions = iter(args)
         events = []
@@ -1579,16 +2054,19 @@ class EventRDate(DateMixin, ModelSQL, ModelView):
             # Update write_date of event
             Event.write(events, {})
         super(EventRDate, cls).write(*args)
+        Interval.refresh(events)
 
     @classmethod
     def delete(cls, event_rdates):
         pool = Pool()
         Event = pool.get('calendar.event')
+        Interval = pool.get('calendar.event.interval')
         events = [x.event for x in event_rdates]
         if events:
             # Update write_date of event
             Event.write(events, {})
         super(EventRDate, cls).delete(event_rdates)
+        Interval.refresh(events)
 
 
 class EventExDate(EventRDate):
@@ -1841,7 +2319,9 @@ class EventRRule(RRuleMixin, ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Interval = pool.get('calendar.event.interval')
         to_write = []
         for values in vlist:
             if values.get('event'):
@@ -1849,11 +2329,15 @@ class EventRRule(RRuleMixin, ModelSQL, ModelView):
                 to_write.append(values['event'])
         if to_write:
             Event.write(Event.browse(to_write), {})
-        return super(EventRRule, cls).create(vlist)
+        rrules = super(EventRRule, cls).create(vlist)
+        Interval.refresh([x.event for x in rrules])
+        return rrules
 
     @classmethod
     def write(cls, *args):
-        Event = Pool().get('calendar.event')
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Interval = pool.get('calendar.event.interval')
 
         actions = iter(args)
         events = []
@@ -1865,19 +2349,36 @@ class EventRRule(RRuleMixin, ModelSQL, ModelView):
             # Update write_date of event
             Event.write(events, {})
         super(EventRRule, cls).write(*args)
+        Interval.refresh(events)
 
     @classmethod
     def delete(cls, event_rrules):
         pool = Pool()
         Event = pool.get('calendar.event')
+        Interval = pool.get('calendar.event.interval')
         events = [x.event for x in event_rrules]
         if events:
             # Update write_date of event
             Event.write(events, {})
         super(EventRRule, cls).delete(event_rrules)
+        Interval.refresh(events)
 
 
 class EventExRule(EventRRule):
     'Exception Rule'
     __name__ = 'calendar.event.exrule'
     _table = 'calendar_event_exrule'  # Needed to override EventRRule._table
+
+
+class CalendarCron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(CalendarCron, cls).__setup__()
+        cls.method.selection.extend([
+            ('calendar.event.interval|extend',
+                "Extend Calendar Busy Intervals"),
+            ('calendar.event.change|purge',
+                "Purge Calendar Event Changes"),
+            ])
@@ -5,15 +5,228 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import datetime
 import unittest
+from unittest.mock import patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class CalendarTestCase(ModuleTestCase):
     'Test Calendar module'
     module = 'health_caldav'
 
+    def event(self, **values):
+        "Create an event in a new calendar"
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        Event = pool.get('calendar.event')
+        calendar, = Calendar.create([{'name': 'Test'}])
+        event, = Event.create([dict(calendar=calendar.id, **values)])
+        return event
+
+    def daily(self, rule=None, **values):
+        "Create a daily event of an hour from the 3rd of January 2022"
+        rule = dict(rule or {}, freq='daily')
+        return self.event(
+            dtstart=datetime.datetime(2022, 1, 3, 9),
+            dtend=datetime.datetime(2022, 1, 3, 10),
+            rrules=[('create', [rule])], **values)
+
+    @with_transaction()
+    def test_intervals_single(self):
+        'Test get_intervals of an event without recurrence'
+        event = self.event(
+            dtstart=datetime.datetime(2022, 1, 3, 9),
+            dtend=datetime.datetime(2022, 1, 3, 10))
+
+        intervals, last = event.get_intervals()
+        self.assertEqual(intervals, [(
+                    datetime.datetime(2022, 1, 3, 9),
+                    datetime.datetime(2022, 1, 3, 10),
+                    False, 'BUSY', None)])
+        self.assertIsNone(last)
+        intervals, _ = event.get_intervals(
+            start=datetime.datetime(2022, 1, 4))
+        self.assertEqual(intervals, [])
+
+    @with_transaction()
+    def test_intervals_recurrence(self):
+        'Test get_intervals of a recurrent event'
+        event = self.daily(rule={'count': 5})
+
+        intervals, last = event.get_intervals()
+        self.assertEqual(
+            [i[0] for i in intervals],
+            [datetime.datetime(2022, 1, d, 9) for d in range(3, 8)])
+        self.assertTrue(all(
+                i[1] - i[0] == datetime.timedelta(hours=1)
+                for i in intervals))
+        self.assertIsNone(last)
+
+    @with_transaction()
+    def test_intervals_exdate(self):
+        'Test get_intervals skips the excluded dates'
+        event = self.daily(rule={'count': 5}, exdates=[('create', [{
+                            'date': False,
+                            'datetime': datetime.datetime(2022, 1, 5, 9),
+                            }])])
+
+        intervals, _ = event.get_intervals()
+        self.assertEqual(
+            [i[0].day for i in intervals], [3, 4, 6, 7])
+
+    @with_transaction()
+    def test_intervals_moved_occurence(self):
+        'Test get_intervals replaces a recurrence by its moved occurence'
+        Event = Pool().get('calendar.event')
+        event = self.daily(rule={'count': 3})
+        occurence, = Event.create([{
+                    'calendar': event.calendar.id,
+                    'uuid': event.uuid,
+                    'parent': event.id,
+                    'recurrence': datetime.datetime(2022, 1, 4, 9),
+                    'dtstart': datetime.datetime(2022, 1, 4, 15),
+                    'dtend': datetime.datetime(2022, 1, 4, 16),
+                    'status': 'tentative',
+                    }])
+        event = Event(event.id)
+
+        intervals, _ = event.get_intervals()
+        self.assertEqual(intervals, [
+                (datetime.datetime(2022, 1, 3, 9),
+                    datetime.datetime(2022, 1, 3, 10), False, 'BUSY', None),
+                (datetime.datetime(2022, 1, 4, 15),
+                    datetime.datetime(2022, 1, 4, 16), False,
+                    'BUSY-TENTATIVE', occurence.id),
+                (datetime.datetime(2022, 1, 5, 9),
+                    datetime.datetime(2022, 1, 5, 10), False, 'BUSY', None),
+                ])
+
+    @with_transaction()
+    def test_intervals_horizon(self):
+        'Test get_intervals stops at the horizon of an endless recurrence'
+        event = self.daily()
+
+        intervals, last = event.get_intervals(
+            end=datetime.datetime(2022, 1, 10))
+        self.assertEqual(
+            [i[0].day for i in intervals], list(range(3, 10)))
+        self.assertEqual(last, datetime.datetime(2022, 1, 9, 9))
+
+        intervals, last = event.get_intervals(
+            start=datetime.datetime(2022, 1, 8),
+            end=datetime.datetime(2022, 1, 10))
+        self.assertEqual([i[0].day for i in intervals], [8, 9])
+        self.assertEqual(last, datetime.datetime(2022, 1, 9, 9))
+
+    @with_transaction()
+    def test_intervals_all_day(self):
+        'Test get_intervals of a recurrent all day event'
+        event = self.event(
+            dtstart=datetime.datetime(2022, 1, 3),
+            dtend=datetime.datetime(2022, 1, 4),
+            all_day=True,
+            rrules=[('create', [{'freq': 'weekly', 'count': 3}])])
+
+        intervals, _ = event.get_intervals()
+        self.assertEqual(intervals, [
+                (datetime.datetime(2022, 1, day),
+                    datetime.datetime(2022, 1, day + 1), True, 'BUSY', None)
+                for day in (3, 10, 17)])
+
+    @with_transaction()
+    def test_changes(self):
+        'Test the sync token and the changes of a calendar'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Change = pool.get('calendar.event.change')
+        event = self.event(
+            dtstart=datetime.datetime(2022, 1, 3, 9),
+            dtend=datetime.datetime(2022, 1, 3, 10))
+        calendar_id = event.calendar.id
+
+        self.assertEqual(Change.get_token(calendar_id), (1, 0))
+        Event.write([event], {'summary': 'Test'})
+        self.assertEqual(Change.get_token(calendar_id), (2, 0))
+        self.assertEqual(
+            Change.get_changes(calendar_id, 1, 2), {event.uuid})
+        self.assertEqual(Change.get_changes(calendar_id, 2, 2), set())
+
+    @with_transaction()
+    def test_changes_purge(self):
+        'Test the purge of the changes expires the sync tokens'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Change = pool.get('calendar.event.change')
+        event = self.event(
+            dtstart=datetime.datetime(2022, 1, 3, 9),
+            dtend=datetime.datetime(2022, 1, 3, 10))
+        calendar_id = event.calendar.id
+        Event.write([event], {'summary': 'Test'})
+
+        with patch('trytond.modules.health_caldav.calendar_.SYNC_DAYS', -1):
+            Change.purge()
+        self.assertEqual(Change.get_token(calendar_id), (2, 2))
+        self.assertEqual(Change.get_changes(calendar_id, 0, 2), set())
+
+    @with_transaction()
+    def test_ical_store(self):
+        'Test the iCalendars of the events are stored once'
+        pool = Pool()
+        ICal = pool.get('calendar.event.ical')
+        event = self.event(
+            dtstart=datetime.datetime(2022, 1, 3, 9),
+            dtend=datetime.datetime(2022, 1, 3, 10))
+
+        data = ICal.get([event])[event.id]
+        ICal.store([(event.id, 'old', 'old data')])
+        ICal.store([(event.id, ICal._version(event), data)])
+        icals = ICal.search([('event', '=', event.id)])
+        self.assertEqual(len(icals), 1)
+        self.assertEqual(ICal.get([event]), {event.id: data})
+
+    @with_transaction()
+    def test_ical_occurence(self):
+        'Test the iCalendar of a recurrence follows its occurences'
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        ICal = pool.get('calendar.event.ical')
+        event = self.daily(rule={'count': 3})
+        occurence, = Event.create([{
+                    'calendar': event.calendar.id,
+                    'uuid': event.uuid,
+                    'parent': event.id,
+                    'recurrence': datetime.datetime(2022, 1, 4, 9),
+                    'dtstart': datetime.datetime(2022, 1, 4, 15),
+                    'dtend': datetime.datetime(2022, 1, 4, 16),
+                    'summary': 'Moved',
+                    }])
+        event = Event(event.id)
+        version = ICal._version(event)
+        data = ICal.get([event])[event.id]
+        self.assertIn('SUMMARY:Moved', data)
+
+        Event.write([occurence], {'summary': 'Renamed'})
+        Transaction().cache.clear()
+        event = Event(event.id)
+        self.assertNotEqual(ICal._version(event), version)
+
+        # A request that read the occurence before the write stores the
+        # previous iCalendar of the recurrence
+        ICal.store([(event.id, version, data)])
+        renamed = ICal.get([event])[event.id]
+        self.assertNotEqual(renamed, data)
+        self.assertIn('SUMMARY:Renamed', renamed)
+        self.assertNotIn('SUMMARY:Moved', renamed)
+
+        Event.delete([occurence])
+        Transaction().cache.clear()
+        event = Event(event.id)
+        self.assertNotIn('SUMMARY:Renamed', ICal.get([event])[event.id])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
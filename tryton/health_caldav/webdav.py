@@ -24,6 +24,10 @@ from trytond.pool import Pool, PoolMeta
 __all__ = ['Collection']
 
 CALDAV_NS = 'urn:ietf:params:xml:ns:caldav'
+# Prefix of the sync tokens, which must be URIs (RFC 6578)
+SYNC_TOKEN_PREFIX = 'http://gnuhealth.org/ns/sync/'
+# Precondition of the error returned for an invalid sync token
+VALID_SYNC_TOKEN = 'valid-sync-token'
 
 logger = logging.getLogger(__name__)
 
@@ -468,6 +472,7 @@ class Collection(metaclass=PoolMeta):
         pool = Pool()
         Event = pool.get('calendar.event')
         Calendar = pool.get('calendar.calendar')
+        ICal = pool.get('calendar.event.ical')
 
         calendar_id = cls.calendar(uri)
         if calendar_id:
@@ -476,12 +481,10 @@ class Collection(metaclass=PoolMeta):
             event_id = cls.event(uri, calendar_id=calendar_id)
             if not event_id:
                 raise DAV_NotFound
-            ical = Event(event_id).event2ical()
-            return ical.serialize()
+            return ICal.get([Event(event_id)])[event_id]
         calendar_ics_id = cls.calendar(uri, ics=True)
         if calendar_ics_id:
-            ical = Calendar(calendar_ics_id).calendar2ical()
-            return ical.serialize()
+            return Calendar(calendar_ics_id).calendar2ics()
         return super(Collection, cls).get_data(uri, cache=cache)
 
     @classmethod
@@ -524,6 +527,120 @@ class Collection(metaclass=PoolMeta):
         return cls.get_data(uri, cache=cache)
         # return cls.get_data(uri, cache=cache).decode('utf-8')
 
+    @classmethod
+    def get_sync_token(cls, uri, cache=None):
+        '''
+        Return the sync token of the calendar which is also its ctag
+        '''
+        Change = Pool().get('calendar.event.change')
+
+        calendar_id = cls.calendar(uri)
+        if calendar_id and not (uri[10:].split('/', 1) + [None])[1]:
+            if cache is not None:
+                cache.setdefault('_calendar', {})
+                cache['_calendar'].setdefault('sync_token', {})
+                if calendar_id in cache['_calendar']['sync_token']:
+                    return cache['_calendar']['sync_token'][calendar_id]
+            counter, _ = Change.get_token(calendar_id)
+            res = SYNC_TOKEN_PREFIX + str(counter)
+            if cache is not None:
+                cache['_calendar']['sync_token'][calendar_id] = res
+            return res
+        raise DAV_NotFound
+
+    @classmethod
+    def get_sync_changes(cls, uri, token, cache=None):
+        '''
+        Return the names of the events changed and removed from the calendar
+        since the sync token and the new sync token
+        An empty token returns all the events.
+        An unknown token or a token older than the changes kept in the log
+        raises the valid-sync-token error, so the client syncs again.
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Change = pool.get('calendar.event.change')
+
+        calendar_id = cls.calendar(uri)
+        if not calendar_id or (uri[10:].split('/', 1) + [None])[1]:
+            raise DAV_Forbidden
+        new_token, expired = Change.get_token(calendar_id)
+        if not token:
+            return (cls.get_childs(uri, cache=cache), [],
+                SYNC_TOKEN_PREFIX + str(new_token))
+        if not token.startswith(SYNC_TOKEN_PREFIX):
+            raise DAV_Forbidden(VALID_SYNC_TOKEN)
+        try:
+            start = int(token[len(SYNC_TOKEN_PREFIX):])
+        except ValueError:
+            raise DAV_Forbidden(VALID_SYNC_TOKEN)
+        if start > new_token or start < expired:
+            raise DAV_Forbidden(VALID_SYNC_TOKEN)
+
+        uuids = Change.get_changes(calendar_id, start, new_token)
+        events = []
+        for sub_uuids in grouped_slice(list(uuids)):
+            events.extend(Event.search([
+                        ('calendar', '=', calendar_id),
+                        ('uuid', 'in', list(sub_uuids)),
+                        ('parent', '=', None),
+                        ]))
+        if cache is not None:
+            cache.setdefault('_calendar', {})
+            cache['_calendar'].setdefault(Event.__name__, {})
+            for event in events:
+                cache['_calendar'][Event.__name__].setdefault(event.id, {})
+        existing = {e.uuid for e in events}
+        return ([u + '.ics' for u in sorted(existing)],
+            [u + '.ics' for u in sorted(uuids - existing)],
+            SYNC_TOKEN_PREFIX + str(new_token))
+
+    @classmethod
+    def get_etag(cls, uri, cache=None):
+        '''
+        Return the ETag of the events from their last modification and their
+        sequence, and the sync token for the calendars
+        '''
+        Event = Pool().get('calendar.event')
+        event = Event.__table__()
+
+        calendar_id = cls.calendar(uri)
+        if calendar_id:
+            if not (uri[10:].split('/', 1) + [None])[1]:
+                return '"%s"' % cls.get_sync_token(uri, cache=cache)
+            event_id = cls.event(uri, calendar_id=calendar_id)
+            if event_id:
+                lastmodified = cls.get_lastmodified(uri, cache=cache)
+                if cache is not None:
+                    cache.setdefault('_calendar', {})
+                    cache['_calendar'].setdefault(Event.__name__, {})
+                    ids = list(cache['_calendar'][Event.__name__].keys())
+                    if event_id not in ids:
+                        ids.append(event_id)
+                    elif 'sequence' in cache['_calendar'][
+                            Event.__name__][event_id]:
+                        return '"%s-%s"' % (lastmodified,
+                            cache['_calendar'][Event.__name__][event_id][
+                                'sequence'])
+                else:
+                    ids = [event_id]
+                res = None
+                cursor = Transaction().connection.cursor()
+                for sub_ids in grouped_slice(ids):
+                    red_sql = reduce_ids(event.id, sub_ids)
+                    cursor.execute(*event.select(event.id, event.sequence,
+                            where=red_sql))
+                    for event_id2, sequence in cursor.fetchall():
+                        if event_id2 == event_id:
+                            res = sequence
+                        if cache is not None:
+                            cache['_calendar'][Event.__name__]\
+                                .setdefault(event_id2, {})
+                            cache['_calendar'][Event.__name__][
+                                event_id2]['sequence'] = sequence
+                return '"%s-%s"' % (lastmodified, res or 0)
+        return super(Collection, cls).get_etag(uri, cache=cache)
+
     @staticmethod
     def get_calendar_home_set(uri, cache=None):
         return '/Calendars'
@@ -637,6 +754,9 @@ class Collection(metaclass=PoolMeta):
         if calendar_id:
             if not (uri[10:].split('/', 1) + [None])[1]:
                 raise DAV_Forbidden
+            # The request body may be received by chunks
+            if not isinstance(data, (bytes, str)):
+                data = b''.join(data)
             event_id = cls.event(uri, calendar_id=calendar_id)
             if not event_id:
                 #Create a new event 
@@ -22,4 +22,5 @@ def register():
         health_crypto.BirthCertificate,
         health_crypto.DeathCertificate,
         health_crypto.PatientEvaluation,
+        health_crypto.CryptoCron,
         module='health_crypto', type_='model')
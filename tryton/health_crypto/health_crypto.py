@@ -5,15 +5,34 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from trytond.model import ModelView, ModelSQL, fields
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from sql import Null, NullsFirst
+from trytond.config import config
+from trytond.model import Model, ModelView, ModelSQL, fields
+from trytond.pool import PoolMeta
 from trytond.rpc import RPC
 from trytond.pyson import Eval, Not, Bool, Equal, Or
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 import hashlib
 import json
+import math
+from json.encoder import encode_basestring as encode_string
 
 
-__all__ = ['HealthCrypto', 'PatientPrescriptionOrder',
-           'BirthCertificate', 'DeathCertificate', 'PatientEvaluation']
+__all__ = ['HealthCrypto', 'DigestMixin', 'PatientPrescriptionOrder',
+           'BirthCertificate', 'DeathCertificate', 'PatientEvaluation',
+           'CryptoCron']
+
+# The integrity sweeper verifies again each signed document after
+# this number of days, and at most this number of documents of each
+# model per run
+VERIFY_INTERVAL = config.getint('health_crypto', 'verify_interval', default=7)
+VERIFY_BATCH = config.getint('health_crypto', 'verify_batch', default=10000)
+
+canonical_encoder = json.JSONEncoder(
+    ensure_ascii=False, sort_keys=True, separators=(',', ':'))
 
 
 class HealthCrypto:
@@ -29,13 +48,309 @@ class HealthCrypto:
     def gen_hash(self, serialized_doc):
         return str(hashlib.sha512(serialized_doc.encode('utf-8')).hexdigest())
 
+    def canonical_chunks(self, value, depth=1):
+        """ Yield the canonical JSON of the value by pieces.
+            Keys are sorted, there is no whitespace, numbers have no
+            trailing zeros and dates are in ISO 8601, so the same data
+            always gives the same bytes.
+            The first depth levels of the value (the fields of a section)
+            are yielded item by item, each item is encoded at once.
+        """
+        if depth and isinstance(value, dict):
+            yield '{'
+            for i, key in enumerate(sorted(value, key=str)):
+                yield (',' if i else '') + encode_string(str(key)) + ':'
+                yield from self.canonical_chunks(value[key], depth - 1)
+            yield '}'
+        elif depth and isinstance(value, (list, tuple)):
+            yield '['
+            for i, item in enumerate(value):
+                if i:
+                    yield ','
+                yield from self.canonical_chunks(item, depth - 1)
+            yield ']'
+        else:
+            yield canonical_encoder.encode(self.canonical_value(value))
+
+    def canonical_value(self, value):
+        """ Value with only JSON types and normalized numbers and dates """
+        if isinstance(value, (str, int)) or value is None:
+            return value
+        elif isinstance(value, dict):
+            return {str(key): self.canonical_value(item)
+                for key, item in value.items()}
+        elif isinstance(value, (list, tuple)):
+            return [self.canonical_value(item) for item in value]
+        elif isinstance(value, (float, Decimal)):
+            return self.canonical_number(value)
+        elif isinstance(value, (date, time)):
+            # datetime is a subclass of date
+            return value.isoformat()
+        return str(value)
+
+    def canonical_number(self, value):
+        # Integral values are written as integers, the others as the
+        # shortest decimal of their double
+        if isinstance(value, Decimal):
+            if not value.is_finite():
+                return str(value)
+            if value == value.to_integral_value():
+                return int(value)
+            value = float(value)
+        if not math.isfinite(value):
+            return str(value)
+        if value.is_integer():
+            return int(value)
+        return value
+
+    def serialize_canonical(self, value):
+        """ Canonical JSON of the value """
+        return ''.join(self.canonical_chunks(value))
+
+    def gen_digest(self, value):
+        """ SHA-512 of the canonical JSON of the value.
+            The JSON is hashed by blocks while it is generated, without
+            building the whole string.
+        """
+        digest = hashlib.sha512()
+        block = []
+        for chunk in self.canonical_chunks(value):
+            block.append(chunk)
+            if len(block) >= 512:
+                digest.update(''.join(block).encode('utf-8'))
+                block = []
+        digest.update(''.join(block).encode('utf-8'))
+        return digest.hexdigest()
+
+    def gen_section_digests(self, sections):
+        """ Merkle digests of the document sections.
+            Returns the root digest, that is the digest of the digests
+            of each section, and the digest of each section
+        """
+        section_digests = {
+            name: self.gen_digest(section)
+            for name, section in sections.items()}
+        return self.gen_digest(section_digests), section_digests
+
+
+def get_digest_value(value, names=None):
+    """ Value of a document field, as stored in the canonical document.
+        Records are represented by their name, or by the values of the
+        given field names
+    """
+    if isinstance(value, Model):
+        if names:
+            return {name: get_digest_value(getattr(value, name))
+                for name in names}
+        return value.rec_name
+    if isinstance(value, (list, tuple)):
+        return [get_digest_value(item, names) for item in value]
+    return value
+
+
+class DigestMixin(object):
+    """ Batch serialization, signing and verification of the documents.
+
+        The documents signed before the canonical serialization keep their
+        legacy digest, given by get_serial. The others are serialized in
+        canonical JSON by the sections of _digest_sections, and
+        document_digest is the root of the digests of the sections.
+    """
+    __slots__ = ()
+
+    # Section name: list of field names, or (field name, field names of
+    # the related records)
+    _digest_sections = {}
+
+    digest_scheme = fields.Selection([
+        (None, ''),
+        ('legacy', 'Legacy'),
+        ('canonical', 'Canonical'),
+        ], 'Digest scheme', readonly=True, sort=False,
+        help="Serialization of the document used to compute its digest")
+
+    section_digests = fields.Text('Section Digests', readonly=True,
+        help="Digest of each section of the original document")
+
+    altered_sections = fields.Function(
+        fields.Char('Altered sections',
+            states={
+                'invisible': Not(Bool(Eval('digest_status'))),
+                }),
+        'check_digest')
+
+    digest_verified = fields.DateTime('Verified', readonly=True,
+        help="Last time the digest of the document was verified")
+
+    digest_altered = fields.Boolean('Digest mismatch', readonly=True,
+        select=True,
+        help="The document did not match its original digest on the"
+             " last verification")
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        migrate_scheme = not table_h.column_exist('digest_scheme')
+
+        super(DigestMixin, cls).__register__(module_name)
+
+        # Migration from 4.1: the documents signed so far keep their
+        # legacy digest
+        if migrate_scheme:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update(
+                    [table.digest_scheme], ['legacy'],
+                    where=table.document_digest != Null))
+
+    @classmethod
+    def browse_documents(cls, records):
+        """ Browse the documents by slices, so the relations are read for
+            the whole slice instead of once per document
+        """
+        for sub_records in grouped_slice(records):
+            yield from cls.browse([r.id for r in sub_records])
+
+    @classmethod
+    def get_sections(cls, record):
+        return {
+            section: {
+                name: get_digest_value(getattr(record, name), names)
+                for name, names in (
+                    field if isinstance(field, tuple) else (field, None)
+                    for field in fields_)}
+            for section, fields_ in cls._digest_sections.items()}
+
+    @classmethod
+    def get_serials(cls, records):
+        """ Return the current serialized documents, by id """
+        serials = {}
+        for record in cls.browse_documents(records):
+            if record.document_digest and record.digest_scheme != 'canonical':
+                serials[record.id] = cls.get_serial(record)
+            else:
+                serials[record.id] = HealthCrypto().serialize_canonical(
+                    cls.get_sections(record))
+        return serials
+
+    @classmethod
+    def get_current_digests(cls, records):
+        """ Return the current digest and section digests of the
+            documents, by id. The legacy documents have no section digests.
+        """
+        crypto = HealthCrypto()
+        digests = {}
+        for record in cls.browse_documents(records):
+            if record.document_digest and record.digest_scheme != 'canonical':
+                digests[record.id] = (
+                    crypto.gen_hash(cls.get_serial(record)), None)
+            else:
+                digests[record.id] = crypto.gen_section_digests(
+                    cls.get_sections(record))
+        return digests
 
-class PatientPrescriptionOrder(ModelSQL, ModelView):
+    @classmethod
+    def sign_documents(cls, records, values):
+        """ Store the serialized document and its digests of all the
+            records, with the other values to write
+        """
+        crypto = HealthCrypto()
+        now = datetime.now()
+        to_write = []
+        for record in cls.browse_documents(records):
+            sections = cls.get_sections(record)
+            digest, section_digests = crypto.gen_section_digests(sections)
+            to_write.extend(([record], dict(values,
+                        serializer=crypto.serialize_canonical(sections),
+                        document_digest=digest,
+                        digest_scheme='canonical',
+                        section_digests=crypto.serialize_canonical(
+                            section_digests),
+                        digest_verified=now,
+                        digest_altered=False)))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def check_digest(cls, records, names):
+        result = {name: {} for name in names}
+        digests = cls.get_current_digests(records)
+        if 'serializer_current' in names:
+            result['serializer_current'] = cls.get_serials(records)
+        for record in records:
+            digest, section_digests = digests[record.id]
+            altered = bool(
+                record.document_digest and digest != record.document_digest)
+            if 'digest_status' in names:
+                # True if the document has been altered
+                result['digest_status'][record.id] = altered
+            if 'digest_current' in names:
+                result['digest_current'][record.id] = digest
+            if 'altered_sections' in names:
+                sections = None
+                if altered and section_digests and record.section_digests:
+                    original = json.loads(record.section_digests)
+                    sections = ', '.join(sorted(
+                            name for name in set(original) | set(
+                                section_digests)
+                            if original.get(name)
+                            != section_digests.get(name)))
+                result['altered_sections'][record.id] = sections
+        return result
+
+    @classmethod
+    def verify_digests(cls, records=None):
+        """ Verify the digest of the signed documents and store the result.
+            Without records, verify the documents never verified or not
+            verified in the last days, the oldest first.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        now = datetime.now()
+
+        if records is None:
+            cursor.execute(*table.select(table.id,
+                    where=(table.document_digest != Null)
+                    & ((table.digest_verified == Null)
+                        | (table.digest_verified
+                            < now - timedelta(days=VERIFY_INTERVAL))),
+                    order_by=[NullsFirst(table.digest_verified.asc)],
+                    limit=VERIFY_BATCH))
+            records = cls.browse([row[0] for row in cursor])
+
+        records = [r for r in records if r.document_digest]
+        digests = cls.get_current_digests(records)
+        altered = {False: [], True: []}
+        for record in records:
+            digest, _ = digests[record.id]
+            altered[digest != record.document_digest].append(record.id)
+
+        # Update with SQL, so the verification does not change the
+        # write date of the documents
+        for status, ids in altered.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.digest_verified, table.digest_altered],
+                        [now, status],
+                        where=reduce_ids(table.id, sub_ids)))
+
+
+class PatientPrescriptionOrder(DigestMixin, ModelSQL, ModelView):
     """ Add the serialized and hash fields to the
     prescription order document"""
 
     __name__ = 'gnuhealth.prescription.order'
 
+    _digest_sections = {
+        'prescription': [
+            'prescription_id', 'prescription_date', 'healthprof',
+            ('patient', ['rec_name', 'puid']), 'notes'],
+        'lines': [
+            ('prescription_line', [
+                'medicament', 'dose', 'dose_unit', 'route', 'form',
+                'indication', 'short_comment'])],
+        }
+
     serializer = fields.Text('Doc String', readonly=True)
 
     document_digest = fields.Char('Digest', readonly=True,
@@ -92,15 +407,8 @@ class PatientPrescriptionOrder(ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def generate_prescription(cls, prescriptions):
-        prescription = prescriptions[0]
-
-        # Change the state of the prescription to "Validated"
-        serial_doc = cls.get_serial(prescription)
-
-        cls.write(prescriptions, {
-            'serializer': serial_doc,
-            'document_digest': HealthCrypto().gen_hash(serial_doc),
-            'state': 'validated', })
+        # Change the state of the prescriptions to "Validated"
+        cls.sign_documents(prescriptions, {'state': 'validated'})
 
     @classmethod
     def get_serial(cls, prescription):
@@ -145,23 +453,6 @@ class PatientPrescriptionOrder(ModelSQL, ModelView):
             'digital_signature': signature,
             })
 
-    def check_digest(self, name):
-        result = ''
-        serial_doc = self.get_serial(self)
-        if (name == 'digest_status' and self.document_digest):
-            if (HealthCrypto().gen_hash(serial_doc) == self.document_digest):
-                result = False
-            else:
-                ''' Return true if the document has been altered'''
-                result = True
-        if (name == 'digest_current'):
-            result = HealthCrypto().gen_hash(serial_doc)
-
-        if (name == 'serializer_current'):
-            result = serial_doc
-
-        return result
-
     # Hide the group holding validation information when state is
     # not validated
 
@@ -172,10 +463,17 @@ class PatientPrescriptionOrder(ModelSQL, ModelView):
                 })]
 
 
-class BirthCertificate(ModelSQL, ModelView):
+class BirthCertificate(DigestMixin, ModelSQL, ModelView):
 
     __name__ = 'gnuhealth.birth_certificate'
 
+    _digest_sections = {
+        'certificate': [
+            'code', 'dob', 'signed_by', 'country', 'country_subdivision',
+            'observations'],
+        'person': [('name', ['rec_name', 'dob', 'ref']), 'mother', 'father'],
+        }
+
     serializer = fields.Text('Doc String', readonly=True)
 
     document_digest = fields.Char('Digest', readonly=True,
@@ -224,16 +522,8 @@ class BirthCertificate(ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def generate_birth_certificate(cls, certificates):
-        certificate = certificates[0]
-
-        # Change the state of the certificate to "Done"
-
-        serial_doc = cls.get_serial(certificate)
-
-        cls.write(certificates, {
-            'serializer': serial_doc,
-            'document_digest': HealthCrypto().gen_hash(serial_doc),
-            'state': 'done', })
+        # Change the state of the certificates to "Done"
+        cls.sign_documents(certificates, {'state': 'done'})
 
     @classmethod
     def get_serial(cls, certificate):
@@ -271,23 +561,6 @@ class BirthCertificate(ModelSQL, ModelView):
             'digital_signature': signature,
             })
 
-    def check_digest(self, name):
-        result = ''
-        serial_doc = self.get_serial(self)
-        if (name == 'digest_status' and self.document_digest):
-            if (HealthCrypto().gen_hash(serial_doc) == self.document_digest):
-                result = False
-            else:
-                ''' Return true if the document has been altered'''
-                result = True
-        if (name == 'digest_current'):
-            result = HealthCrypto().gen_hash(serial_doc)
-
-        if (name == 'serializer_current'):
-            result = serial_doc
-
-        return result
-
     # Hide the group holding all the digital signature until signed
 
     @classmethod
@@ -297,10 +570,22 @@ class BirthCertificate(ModelSQL, ModelView):
                 })]
 
 
-class DeathCertificate(ModelSQL, ModelView):
+class DeathCertificate(DigestMixin, ModelSQL, ModelView):
 
     __name__ = 'gnuhealth.death_certificate'
 
+    _digest_sections = {
+        'certificate': [
+            'code', 'dod', 'signed_by', 'country', 'country_subdivision',
+            'observations'],
+        'person': [('name', ['rec_name', 'dob', 'ref'])],
+        'cause_of_death': [
+            'cod',
+            ('underlying_conditions', [
+                'condition', 'interval', 'unit_of_time']),
+            'autopsy', 'type_of_death', 'place_of_death'],
+        }
+
     serializer = fields.Text('Doc String', readonly=True)
 
     document_digest = fields.Char('Digest', readonly=True,
@@ -349,16 +634,8 @@ class DeathCertificate(ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def generate_death_certificate(cls, certificates):
-        certificate = certificates[0]
-
-        # Change the state of the certificate to "Done"
-
-        serial_doc = cls.get_serial(certificate)
-
-        cls.write(certificates, {
-            'serializer': serial_doc,
-            'document_digest': HealthCrypto().gen_hash(serial_doc),
-            'state': 'done', })
+        # Change the state of the certificates to "Done"
+        cls.sign_documents(certificates, {'state': 'done'})
 
     @classmethod
     def get_serial(cls, certificate):
@@ -407,23 +684,6 @@ class DeathCertificate(ModelSQL, ModelView):
             'digital_signature': signature,
             })
 
-    def check_digest(self, name):
-        result = ''
-        serial_doc = self.get_serial(self)
-        if (name == 'digest_status' and self.document_digest):
-            if (HealthCrypto().gen_hash(serial_doc) == self.document_digest):
-                result = False
-            else:
-                ''' Return true if the document has been altered'''
-                result = True
-        if (name == 'digest_current'):
-            result = HealthCrypto().gen_hash(serial_doc)
-
-        if (name == 'serializer_current'):
-            result = serial_doc
-
-        return result
-
     # Hide the group holding all the digital signature until signed
 
     @classmethod
@@ -433,9 +693,38 @@ class DeathCertificate(ModelSQL, ModelView):
                 })]
 
 
-class PatientEvaluation(ModelSQL, ModelView):
+class PatientEvaluation(DigestMixin, ModelSQL, ModelView):
     __name__ = 'gnuhealth.patient.evaluation'
 
+    _digest_sections = {
+        'encounter': [
+            'patient', 'evaluation_start', 'evaluation_endtime',
+            'healthprof', 'signed_by', 'specialty', 'visit_type', 'urgency',
+            'institution', 'derived_from', 'derived_to'],
+        'anamnesis': [
+            'information_source', 'reliable_info', 'chief_complaint',
+            'present_illness', 'evaluation_summary',
+            ('signs_and_symptoms', ['clinical', 'sign_or_symptom'])],
+        'clinical': [
+            'glycemia', 'hba1c', 'cholesterol_total', 'hdl', 'ldl', 'tag',
+            'systolic', 'diastolic', 'bpm', 'respiratory_rate', 'osat',
+            'malnutrition', 'dehydration', 'temperature', 'weight',
+            'height', 'bmi', 'head_circumference', 'abdominal_circ', 'hip',
+            'whr'],
+        'mental_status': [
+            'loc', 'loc_eyes', 'loc_verbal', 'loc_motor', 'tremor',
+            'violent', 'mood', 'orientation', 'memory',
+            'knowledge_current_events', 'judgment', 'abstraction',
+            'vocabulary', 'calculation_ability', 'object_recognition',
+            'praxis'],
+        'diagnosis': [
+            'diagnosis',
+            ('secondary_conditions', ['pathology']),
+            ('diagnostic_hypothesis', ['pathology']),
+            'info_diagnosis'],
+        'treatment': ['directions', ('actions', ['procedure'])],
+        }
+
     serializer = fields.Text('Doc String', readonly=True)
 
     document_digest = fields.Char('Digest', readonly=True,
@@ -484,16 +773,8 @@ class PatientEvaluation(ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def sign_evaluation(cls, evaluations):
-        evaluation = evaluations[0]
-
-        # Change the state of the evaluation to "Signed"
-
-        serial_doc = cls.get_serial(evaluation)
-
-        cls.write(evaluations, {
-            'serializer': serial_doc,
-            'document_digest': HealthCrypto().gen_hash(serial_doc),
-            'state': 'signed', })
+        # Change the state of the evaluations to "Signed"
+        cls.sign_documents(evaluations, {'state': 'signed'})
 
     @classmethod
     def get_serial(cls, evaluation):
@@ -613,22 +894,6 @@ class PatientEvaluation(ModelSQL, ModelView):
             'digital_signature': signature,
             })
 
-    def check_digest(self, name):
-        result = ''
-        serial_doc = str(self.get_serial(self))
-        if (name == 'digest_status' and self.document_digest):
-            if (HealthCrypto().gen_hash(serial_doc) == self.document_digest):
-                result = False
-            else:
-                ''' Return true if the document has been altered'''
-                result = True
-        if (name == 'digest_current'):
-            result = HealthCrypto().gen_hash(serial_doc)
-
-        if (name == 'serializer_current'):
-            result = serial_doc
-
-        return result
     # Hide the group holding all the digital signature until signed
 
     @classmethod
@@ -638,3 +903,21 @@ class PatientEvaluation(ModelSQL, ModelView):
                 ('//group[@id="group_current_string"]', 'states', {
                  'invisible': ~Eval('digest_status'),
                  })]
+
+
+class CryptoCron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(CryptoCron, cls).__setup__()
+        cls.method.selection.extend([
+            ('gnuhealth.prescription.order|verify_digests',
+                "Verify Prescription Digests"),
+            ('gnuhealth.birth_certificate|verify_digests',
+                "Verify Birth Certificate Digests"),
+            ('gnuhealth.death_certificate|verify_digests',
+                "Verify Death Certificate Digests"),
+            ('gnuhealth.patient.evaluation|verify_digests',
+                "Verify Evaluation Digests"),
+            ])
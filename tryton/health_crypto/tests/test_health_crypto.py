@@ -3,9 +3,16 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import hashlib
 import unittest
+from datetime import date, datetime
+from decimal import Decimal
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from trytond.modules.health_crypto.health_crypto import HealthCrypto
 
 
 class HealthCryptoTestCase(ModuleTestCase):
@@ -14,6 +21,113 @@ class HealthCryptoTestCase(ModuleTestCase):
     '''
     module = 'health_crypto'
 
+    def test_canonical_serialization(self):
+        'Test canonical serialization'
+        crypto = HealthCrypto()
+        self.assertEqual(
+            crypto.serialize_canonical({
+                    'b': [Decimal('36.50'), 1.0, 0.0, None],
+                    'a': {'y': True, 'x': date(2022, 3, 1)},
+                    'c': datetime(2022, 3, 1, 10, 5),
+                    }),
+            '{"a":{"x":"2022-03-01","y":true},'
+            '"b":[36.5,1,0,null],"c":"2022-03-01T10:05:00"}')
+        self.assertEqual(
+            crypto.serialize_canonical({'x': 36.5, 'y': 'á'}),
+            crypto.serialize_canonical({'y': 'á', 'x': Decimal('36.500')}))
+
+        document = {'text': 'á' * 10000, 'values': list(range(1000))}
+        self.assertEqual(
+            crypto.gen_digest(document),
+            hashlib.sha512(crypto.serialize_canonical(document).encode(
+                    'utf-8')).hexdigest())
+
+    def test_section_digests(self):
+        'Test section digests'
+        crypto = HealthCrypto()
+        sections = {
+            'clinical': {'systolic': 120, 'diastolic': 80},
+            'diagnosis': {'diagnosis': 'A01'},
+            }
+        root, digests = crypto.gen_section_digests(sections)
+        self.assertEqual(root, crypto.gen_digest(digests))
+
+        sections['clinical']['systolic'] = 140
+        altered_root, altered_digests = crypto.gen_section_digests(sections)
+        self.assertNotEqual(root, altered_root)
+        self.assertNotEqual(digests['clinical'], altered_digests['clinical'])
+        self.assertEqual(digests['diagnosis'], altered_digests['diagnosis'])
+
+    def death_certificates(self, count):
+        "Create the death certificates of new persons"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Country = pool.get('country.country')
+        Pathology = pool.get('gnuhealth.pathology')
+        DeathCertificate = pool.get('gnuhealth.death_certificate')
+
+        country, = Country.create([{'name': 'Test', 'code': 'XT'}])
+        pathology, = Pathology.create([{'name': 'Test', 'code': 'T00'}])
+        persons = Party.create([{
+                    'name': 'Person %s' % n,
+                    'is_person': True,
+                    'fed_country': 'XXX',
+                    'gender': 'f',
+                    'dob': date(1950, 1, 1),
+                    } for n in range(count)])
+        return DeathCertificate.create([{
+                    'name': person.id,
+                    'code': 'DC-%s' % person.id,
+                    'dod': datetime(2020, 1, 1, 10),
+                    'type_of_death': 'natural',
+                    'place_of_death': 'home',
+                    'country': country.id,
+                    'cod': pathology.id,
+                    } for person in persons])
+
+    @with_transaction()
+    def test_sign_documents(self):
+        'Test sign_documents signs several documents at once'
+        DeathCertificate = Pool().get('gnuhealth.death_certificate')
+        certificates = self.death_certificates(3)
+
+        DeathCertificate.sign_documents(certificates, {'state': 'done'})
+
+        certificates = DeathCertificate.browse([c.id for c in certificates])
+        self.assertEqual({c.state for c in certificates}, {'done'})
+        self.assertEqual(
+            {c.digest_scheme for c in certificates}, {'canonical'})
+        self.assertEqual(len({c.document_digest for c in certificates}), 3)
+        self.assertTrue(all(c.digest_verified for c in certificates))
+        self.assertFalse(any(c.digest_altered for c in certificates))
+        self.assertFalse(any(c.digest_status for c in certificates))
+
+    @with_transaction()
+    def test_verify_digests(self):
+        'Test verify_digests stores the result without writing the documents'
+        DeathCertificate = Pool().get('gnuhealth.death_certificate')
+        certificates = self.death_certificates(3)
+        DeathCertificate.sign_documents(certificates, {'state': 'done'})
+        DeathCertificate.write([certificates[0]], {
+                'observations': 'Altered',
+                })
+        certificates = DeathCertificate.browse([c.id for c in certificates])
+        write_dates = [c.write_date for c in certificates]
+        signed = [c.digest_verified for c in certificates]
+
+        DeathCertificate.verify_digests(certificates)
+
+        # The result is stored with SQL, so read it again from the database
+        Transaction().cache.clear()
+        certificates = DeathCertificate.browse([c.id for c in certificates])
+        self.assertEqual(
+            [c.digest_altered for c in certificates], [True, False, False])
+        self.assertEqual(certificates[0].altered_sections, 'certificate')
+        self.assertTrue(all(
+                c.digest_verified >= s
+                for c, s in zip(certificates, signed)))
+        self.assertEqual([c.write_date for c in certificates], write_dates)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -24,6 +24,7 @@ from . import report
 
 def register():
     Pool.register(
+        health_dentistry.DentalTooth,
         health_dentistry.PatientData,
         health_dentistry.DentistryTreatment,
         health_dentistry.DentistryProcedure,
@@ -18,14 +18,19 @@ import json
 from datetime import date
 from collections import defaultdict
 
+from sql import Column, Null
+from sql.functions import CurrentTimestamp
+
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.pyson import Eval, Equal
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 from trytond.modules.health.core import get_health_professional
 
-__all__ = ['PatientData', 'DentistryTreatment', 'DentistryProcedure',
-           'TreatmentProcedure']
+__all__ = ['DentalTooth', 'PatientData', 'DentistryTreatment',
+           'DentistryProcedure', 'TreatmentProcedure']
 
 
 TOOTH_STATE = [
@@ -61,6 +66,72 @@ TEETH = [
 
 TREATMENT_TEETH = TEETH + [(None, '')]
 
+# Tooth surfaces, as stored in the dental schema
+SURFACES = [
+    ('v', 'vestibular'),
+    ('i', 'incisal'),
+    ('o', 'occlusal'),
+    ('m', 'mesial'),
+    ('d', 'distal'),
+    ('p', 'palatine'),
+    ('l', 'lingual'),
+    ]
+
+PERMANENT_QUADRANTS = ['1', '2', '3', '4']
+PRIMARY_QUADRANTS = ['5', '6', '7', '8']
+
+
+def compute_dmft(teeth, quadrants):
+    """ Return the DMFT index (decayed, missing and filled teeth) of the
+        quadrants of the parsed dental schema
+    """
+    if teeth is None:
+        return None
+    return len([
+            tooth for tooth, values in teeth.items()
+            if tooth[0] in quadrants and values.get('ts') in ['D', 'M', 'F']])
+
+
+class DentalTooth(ModelSQL, ModelView):
+    'Dental Tooth'
+    __name__ = 'gnuhealth.dentistry.tooth'
+
+    patient = fields.Many2One(
+        'gnuhealth.patient', 'Patient', required=True, readonly=True,
+        ondelete='CASCADE', select=True)
+    tooth = fields.Selection(TEETH, 'Tooth', readonly=True, select=True)
+    primary = fields.Boolean('Primary', readonly=True)
+    state = fields.Selection(TOOTH_STATE, 'State', readonly=True,
+                             select=True)
+    vestibular = fields.Boolean('Vestibular', readonly=True)
+    incisal = fields.Boolean('Incisal', readonly=True)
+    occlusal = fields.Boolean('Occlusal', readonly=True)
+    mesial = fields.Boolean('Mesial', readonly=True)
+    distal = fields.Boolean('Distal', readonly=True)
+    palatine = fields.Boolean('Palatine', readonly=True)
+    lingual = fields.Boolean('Lingual', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(DentalTooth, cls).__setup__()
+        cls._order.insert(0, ('tooth', 'ASC'))
+
+    @classmethod
+    def get_values(cls, patient_id, teeth, primary):
+        """ Return the values of the rows of the parsed dental schema """
+        vlist = []
+        for tooth, values in teeth.items():
+            row = {
+                'patient': patient_id,
+                'tooth': tooth,
+                'primary': primary,
+                'state': values.get('ts') or '',
+                }
+            for key, name in SURFACES:
+                row[name] = bool(values.get(key))
+            vlist.append(row)
+        return vlist
+
 
 class PatientData (metaclass=PoolMeta):
     __name__ = 'gnuhealth.patient'
@@ -70,22 +141,23 @@ class PatientData (metaclass=PoolMeta):
         'patient', 'Treatment', readonly=True)
     dental_schema = fields.Text('Dental Schema')
     dental_schema_primary = fields.Text('Primary Schema')
-    teeth1 = fields.Function(fields.Char('Quadrant 1'), 'get_status')
-    teeth2 = fields.Function(fields.Char('Quadrant 2'), 'get_status')
-    teeth3 = fields.Function(fields.Char('Quadrant 3'), 'get_status')
-    teeth4 = fields.Function(fields.Char('Quadrant 4'), 'get_status')
+    teeth = fields.One2Many(
+        'gnuhealth.dentistry.tooth', 'patient', 'Teeth', readonly=True,
+        help="State of each tooth, as set in the dental schemas")
+    teeth1 = fields.Function(fields.Char('Quadrant 1'), 'get_teeth_status')
+    teeth2 = fields.Function(fields.Char('Quadrant 2'), 'get_teeth_status')
+    teeth3 = fields.Function(fields.Char('Quadrant 3'), 'get_teeth_status')
+    teeth4 = fields.Function(fields.Char('Quadrant 4'), 'get_teeth_status')
     use_primary_schema = fields.Boolean('Primary Schema',
                                         help='Use Primary Schema')
-    teeth5 = fields.Function(fields.Char('Quadrant 5'), 'get_status_primary')
-    teeth6 = fields.Function(fields.Char('Quadrant 6'), 'get_status_primary')
-    teeth7 = fields.Function(fields.Char('Quadrant 7'), 'get_status_primary')
-    teeth8 = fields.Function(fields.Char('Quadrant 8'), 'get_status_primary')
-    dmft_index = fields.Function(fields.Integer('DMFT Index'),
-                                 'get_dmft_index')
-    dmft_index_primary = fields.Function(
-        fields.Integer('dmft index', help='dmft index for primary teeth',
-                       states={'invisible': ~Eval('use_primary_schema')}),
-        'get_dmft_index_primary')
+    teeth5 = fields.Function(fields.Char('Quadrant 5'), 'get_teeth_status')
+    teeth6 = fields.Function(fields.Char('Quadrant 6'), 'get_teeth_status')
+    teeth7 = fields.Function(fields.Char('Quadrant 7'), 'get_teeth_status')
+    teeth8 = fields.Function(fields.Char('Quadrant 8'), 'get_teeth_status')
+    dmft_index = fields.Integer('DMFT Index', readonly=True, select=True)
+    dmft_index_primary = fields.Integer(
+        'dmft index', help='dmft index for primary teeth', readonly=True,
+        select=True, states={'invisible': ~Eval('use_primary_schema')})
 
     @classmethod
     def __setup__(cls):
@@ -110,61 +182,123 @@ class PatientData (metaclass=PoolMeta):
     def default_use_primary_schema():
         return False
 
-    @fields.depends('dental_schema')
-    def get_status(self, name=None):
-        if not self.dental_schema:
-            return ''
-        quad = name[5:]
-        teeth = json.loads(self.dental_schema)
-        res = ''
-        loop = list(range(1, 9)) if quad in ['2', '3'] \
-            else list(range(8, 0, -1))
-        for i in loop:
-            res += ' ' * 6 + quad + str(i) + ':' + \
-                STATE_LEGENDS[teeth[quad + str(i)]['ts']]
-        return res
-
-    @fields.depends('dental_schema_primary')
-    def get_status_primary(self, name=None):
-        if not self.dental_schema_primary:
-            return ''
-        quad = name[5:]
-        teeth = json.loads(self.dental_schema_primary)
-        res = ' ' * 24
-        loop = list(range(1, 6)) if quad in ['6', '7'] \
-            else list(range(5, 0, -1))
-        for i in loop:
-            res += ' ' * 6 + quad + str(i) + ':' + \
-                STATE_LEGENDS[teeth[quad + str(i)]['ts']]
-        return res
-
-    @fields.depends('dental_schema')
-    def get_dmft_index(self, name=None):
-        if not self.dental_schema:
-            return None
-        teeth = json.loads(self.dental_schema)
-        res = 0
-        quadrant = ['1', '2', '3', '4']
-        tooth = ['1', '2', '3', '4', '5', '6', '7', '8']
-        for q in quadrant:
-            for t in tooth:
-                if teeth[q + t]['ts'] in ['D', 'M', 'F']:
-                    res += 1
-        return res
-
-    @fields.depends('dental_schema_primary')
-    def get_dmft_index_primary(self, name=None):
-        if not self.dental_schema_primary:
-            return None
-        teeth = json.loads(self.dental_schema_primary)
-        res = 0
-        quadrant = ['5', '6', '7', '8']
-        tooth = ['1', '2', '3', '4', '5']
-        for q in quadrant:
-            for t in tooth:
-                if teeth[q + t]['ts'] in ['D', 'M', 'F']:
-                    res += 1
-        return res
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        migrate_dmft = not table_h.column_exist('dmft_index')
+
+        super(PatientData, cls).__register__(module_name)
+
+        # Migration from 4.0: DMFT index stored and teeth table
+        if migrate_dmft:
+            cursor.execute(*table.select(
+                    table.id, table.dental_schema, table.dental_schema_primary,
+                    where=(table.dental_schema != Null)
+                    | (table.dental_schema_primary != Null)))
+            cls._store_dental_state(cursor.fetchall())
+
+    @classmethod
+    def get_teeth_status(cls, patients, names):
+        result = {name: {} for name in names}
+        for patient in patients:
+            # Parse each schema once for all the quadrants
+            teeth = json.loads(patient.dental_schema or 'null')
+            teeth_primary = json.loads(
+                patient.dental_schema_primary or 'null')
+            for name in names:
+                quad = name[5:]
+                if quad in PERMANENT_QUADRANTS:
+                    schema, res = teeth, ''
+                    loop = list(range(1, 9)) if quad in ['2', '3'] \
+                        else list(range(8, 0, -1))
+                else:
+                    schema, res = teeth_primary, ' ' * 24
+                    loop = list(range(1, 6)) if quad in ['6', '7'] \
+                        else list(range(5, 0, -1))
+                if not schema:
+                    result[name][patient.id] = ''
+                    continue
+                for i in loop:
+                    res += ' ' * 6 + quad + str(i) + ':' + \
+                        STATE_LEGENDS[schema[quad + str(i)]['ts']]
+                result[name][patient.id] = res
+        return result
+
+    @classmethod
+    def update_dental_state(cls, patients):
+        """ Store the teeth and DMFT indexes of the patients
+            from their dental schemas
+        """
+        cls._store_dental_state([
+                (p.id, p.dental_schema, p.dental_schema_primary)
+                for p in patients])
+
+    @classmethod
+    def _store_dental_state(cls, schemas):
+        # schemas: list of (patient id, dental schema, primary schema)
+        # The teeth rows are derived from the schemas, so they are written
+        # in SQL whatever the access of the user to them. It is also used
+        # by the migration, when the ORM can not be used yet.
+        pool = Pool()
+        Tooth = pool.get('gnuhealth.dentistry.tooth')
+        table = cls.__table__()
+        tooth = Tooth.__table__()
+        cursor = Transaction().connection.cursor()
+        columns = ['patient', 'tooth', 'primary', 'state'] + [
+            name for _, name in SURFACES]
+
+        for sub_schemas in grouped_slice(schemas):
+            sub_schemas = list(sub_schemas)
+            cursor.execute(*tooth.delete(
+                    where=reduce_ids(
+                        tooth.patient, [s[0] for s in sub_schemas])))
+            to_create = []
+            indexes = {}
+            for patient_id, schema, schema_primary in sub_schemas:
+                teeth = json.loads(schema or 'null')
+                teeth_primary = json.loads(schema_primary or 'null')
+                if teeth:
+                    to_create += Tooth.get_values(patient_id, teeth, False)
+                if teeth_primary:
+                    to_create += Tooth.get_values(
+                        patient_id, teeth_primary, True)
+                dmft = (
+                    compute_dmft(teeth, PERMANENT_QUADRANTS),
+                    compute_dmft(teeth_primary, PRIMARY_QUADRANTS))
+                indexes.setdefault(dmft, []).append(patient_id)
+            if to_create:
+                cursor.execute(*tooth.insert(
+                        [Column(tooth, c) for c in columns]
+                        + [tooth.create_uid, tooth.create_date],
+                        [[row[c] for c in columns]
+                            + [Transaction().user, CurrentTimestamp()]
+                            for row in to_create]))
+            for (dmft, dmft_primary), ids in indexes.items():
+                cursor.execute(*table.update(
+                        [table.dmft_index, table.dmft_index_primary],
+                        [dmft, dmft_primary],
+                        where=reduce_ids(table.id, ids)))
+
+    @classmethod
+    def create(cls, vlist):
+        patients = super(PatientData, cls).create(vlist)
+        cls.update_dental_state([
+                p for p in patients
+                if p.dental_schema or p.dental_schema_primary])
+        return patients
+
+    @classmethod
+    def write(cls, *args):
+        super(PatientData, cls).write(*args)
+        to_update = []
+        for patients, values in zip(args[::2], args[1::2]):
+            if ('dental_schema' in values
+                    or 'dental_schema_primary' in values):
+                to_update.extend(patients)
+        if to_update:
+            cls.update_dental_state(cls.browse([p.id for p in to_update]))
 
     @classmethod
     @ModelView.button_action('health_dentistry.wizard_set_odontogram')
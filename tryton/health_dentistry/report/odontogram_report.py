@@ -14,20 +14,47 @@
 #                         HEALTH DENTISTRY package                      #
 #                odontogram_report.py: odontogram report                #
 #########################################################################
+import hashlib
 import io
 import os
 import json
+import threading
 from PIL import Image, ImageDraw
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.report import Report
 from trytond.pool import Pool
 
 
 __all__ = ['Odontogram']
 
+# Template of the odontogram, loaded once per process
+_template = None
+_template_lock = threading.Lock()
+
+
+def get_template():
+    global _template
+    with _template_lock:
+        if _template is None:
+            report_dir = os.path.dirname(os.path.abspath(__file__))
+            filename = os.path.join(report_dir, 'odontogram_template.png')
+            with Image.open(filename) as im:
+                im.load()
+                _template = im.copy()
+        return _template
+
 
 class Odontogram(Report):
     __name__ = 'health_dentistry.odontogram.report'
 
+    # Rendered images, by hash of the dental schema. Writing a new schema
+    # changes its hash, so a stale image is never used.
+    _odontogram_cache = Cache(
+        'health_dentistry.odontogram',
+        size_limit=config.getint(
+            'health_dentistry', 'odontogram_cache_size', default=256))
+
     radius = 37
     pieces = {
         '18': (37, 37), '17': (119, 37), '16': (201, 37), '15': (282, 37),
@@ -50,7 +77,7 @@ class Odontogram(Report):
         }
 
     @classmethod
-    def plot_extraction(cls, piece_center, status, im):
+    def plot_extraction(cls, piece_center, status, im, draw=None):
         missing_color = "#0000ff"  # blue
         for_extraction_color = "#ff0000"  # red
         if (status == 'M'):
@@ -63,7 +90,8 @@ class Odontogram(Report):
         urc = {'x': xcenter + 30, 'y': ycenter - 30}
         ulc = {'x': xcenter - 30, 'y': ycenter - 30}
         lrc = {'x': xcenter + 30, 'y': ycenter + 30}
-        draw = ImageDraw.Draw(im)
+        if draw is None:
+            draw = ImageDraw.Draw(im)
         draw.line((llc['x'], llc['y'], urc['x'], urc['y']),
                   fill=color, width=10)
 
@@ -85,7 +113,6 @@ class Odontogram(Report):
             color = filling
 
         position = (x, y)  # Center of the tooth
-        draw = ImageDraw.Draw(im)
 
         tregions = status.copy()
         tregions.pop('ts')  # Delete ts element and focus on the tooth areas
@@ -93,7 +120,6 @@ class Odontogram(Report):
         # Set the section of the filling / decay
         # Maxillar / upper region
         if (tooth in range(11, 28) or tooth in range(51, 65)):
-            print(tooth, tregions)
             for key in tregions.keys():
                 if (key in ['o', 'i']):  # Occlusal or Incisal
                     position = (x, y)  # Center of the tooth
@@ -126,13 +152,32 @@ class Odontogram(Report):
 
         return (im)
 
+    @classmethod
+    def get_schema_hash(cls, dental_schema):
+        dschema = json.loads(dental_schema)
+        canonical = json.dumps(dschema, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_odontogram(cls, dental_schema):
+        """ Return the PNG image of the odontogram from the cache,
+            rendering it the first time
+        """
+        if not dental_schema:
+            dental_schema = '{}'
+        key = cls.get_schema_hash(dental_schema)
+        image_png = cls._odontogram_cache.get(key)
+        if image_png is None:
+            image_png = cls.plot_odontogram(dental_schema)
+            cls._odontogram_cache.set(key, image_png)
+        return image_png
+
     @classmethod
     def plot_odontogram(cls, dental_schema):
 
-        # Get the template file from current module dir
-        report_dir = os.path.dirname(os.path.abspath(__file__))
-        filename = os.path.join(report_dir, 'odontogram_template.png')
-        im = Image.open(filename)
+        # Draw on a copy of the preloaded template
+        im = get_template().copy()
+        draw = ImageDraw.Draw(im)
 
         dschema = json.loads(dental_schema)
 
@@ -147,10 +192,10 @@ class Odontogram(Report):
             # Missing or set for extraction tooth
             if (values['ts'] in ('M', 'E')):
                 status = values['ts']
-                cls.plot_extraction(cls.pieces[tooth], status, im)
+                cls.plot_extraction(cls.pieces[tooth], status, im, draw)
 
         holder = io.BytesIO()
-        im.save(holder, 'png')
+        im.save(holder, 'png', optimize=True)
         image_png = holder.getvalue()
         holder.close()
         return (image_png)
@@ -163,6 +208,6 @@ class Odontogram(Report):
         dental_schema = \
             Pool().get('gnuhealth.patient')(data['id']).dental_schema
 
-        context['patient_odontogram'] = cls.plot_odontogram(dental_schema)
+        context['patient_odontogram'] = cls.get_odontogram(dental_schema)
 
         return context
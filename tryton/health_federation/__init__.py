@@ -36,4 +36,5 @@ def register():
         health_federation.FederationObject,
         health_federation.PartyFed,
         health_federation.PoLFed,
+        health_federation.FederationCron,
         module='health_federation', type_='model')
@@ -13,13 +13,26 @@
 #########################################################################
 
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields, Unique
-from trytond.pool import Pool
+from trytond.cache import Cache
+from trytond.tools import grouped_slice
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Equal
+from trytond.transaction import Transaction
+from trytond.config import config
+from trytond import backend
+from sql import Null
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+from sql.operators import Exists, Or
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from trytond.rpc import RPC
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from trytond.modules.health.core import get_institution
 from trytond.i18n import gettext
 
@@ -30,7 +43,16 @@ from .exceptions import (
 
 __all__ = [
     'FederationNodeConfig', 'FederationQueue', 'FederationObject',
-    'PartyFed', 'PoLFed']
+    'PartyFed', 'PoLFed', 'FederationCron']
+
+logger = logging.getLogger(__name__)
+
+# Federation queue worker settings ([health_federation] section of trytond.conf)
+QUEUE_BATCH = config.getint('health_federation', 'queue_batch', default=500)
+MAX_ATTEMPTS = config.getint('health_federation', 'max_attempts', default=10)
+RETRY_DELAY = config.getint('health_federation', 'retry_delay', default=60)
+MAX_RETRY_DELAY = config.getint(
+    'health_federation', 'max_retry_delay', default=86400)
 
 
 def set_fsync(model, records, flag):
@@ -40,6 +62,54 @@ def set_fsync(model, records, flag):
     model.write(records, vals)
 
 
+def thalamus_session(user, password, verify_ssl, pool_size=1):
+    # Returns a keep-alive HTTP session to Thalamus, with a connection
+    # pool large enough to serve each of the sending workers
+    session = requests.Session()
+    session.auth = (user, password)
+    session.verify = verify_ssl
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def send_chains(session, base_url, chains, workers=1):
+    """ Send the chains of requests to Thalamus using a pool of workers.
+        Each chain holds the requests of a single federation locator,
+        and it is sent sequentially to keep the order of the operations
+        (eg, a POST must reach Thalamus before the PATCHes on it).
+        Different chains are sent in parallel.
+
+        chain: list of (method, path, vals, msgids)
+
+        Returns the set of message IDs that could not be delivered
+    """
+
+    def send_chain(chain):
+        failed = set()
+        for method, path, vals, msgids in chain:
+            # Once a request on the locator fails, skip the following
+            # ones, since they depend on it.
+            if failed:
+                failed.update(msgids)
+                continue
+            try:
+                send_data = session.request(
+                    method, base_url + path, data=json.dumps(vals))
+            except requests.RequestException:
+                send_data = None
+            if not send_data:
+                failed.update(msgids)
+        return failed
+
+    failed_msgs = set()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for failed in executor.map(send_chain, chains):
+            failed_msgs.update(failed)
+    return failed_msgs
+
+
 class FederationNodeConfig(ModelSingleton, ModelSQL, ModelView):
     'Federation Node Configuration'
     __name__ = 'gnuhealth.federation.config'
@@ -63,6 +133,10 @@ class FederationNodeConfig(ModelSingleton, ModelSQL, ModelView):
     enabled = fields.Boolean(
         'Enabled', help="Mark if the node is active"
         " in the Federation")
+    workers = fields.Integer(
+        'Workers',
+        help="Number of parallel connections used to send the queued"
+             " messages to Thalamus")
 
     # TODO: Check the associated institution and use as
     # a default value its id
@@ -87,6 +161,10 @@ class FederationNodeConfig(ModelSingleton, ModelSQL, ModelView):
     def default_verify_ssl():
         return False
 
+    @staticmethod
+    def default_workers():
+        return 4
+
     @staticmethod
     def default_database():
         return 'federation'
@@ -164,6 +242,12 @@ class FederationNodeConfig(ModelSingleton, ModelSQL, ModelView):
 
         return host, port, user, password, ssl_conn, verify_ssl, protocol
 
+    @classmethod
+    def get_workers(cls):
+        # Number of parallel connections to Thalamus for bulk sending
+        TInfo = Pool().get(cls.__name__)(1)
+        return TInfo.workers or 1
+
 
 class FederationQueue(ModelSQL, ModelView):
     'Federation Queue'
@@ -209,6 +293,19 @@ class FederationQueue(ModelSQL, ModelView):
         'URL suffix',
         help="suffix to be passed to the URL")
 
+    attempts = fields.Integer(
+        'Attempts', readonly=True,
+        help="Number of failed attempts to send the message")
+
+    next_try = fields.DateTime(
+        'Next try', readonly=True,
+        help="The queue worker will not retry to send the message"
+             " before this time")
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
     @staticmethod
     def default_node():
         # Get the Institution code as the originating node.
@@ -227,188 +324,162 @@ class FederationQueue(ModelSQL, ModelView):
         return institution_code
 
     @classmethod
-    def send_record(cls, record):
-        rc = False
-
-        host, port, user, password, ssl_conn, verify_ssl, protocol = \
-            FederationNodeConfig.get_conn_params()
-
-        if (record.method == 'PATCH'):
-            if (record.federation_locator):
-                # Traverse each resource and its data fields.
-                # arg : Dictionary for each of the data elements in the
-                #       list of values
-                # [{resource, fields[{name, value}]
-
-                for arg in json.loads(record.args):
-                    vals = {}
-                    modification_info = {}
-
-                    # Include the modification information
-                    modification_info = {
-                        'user': user,
-                        'timestamp': record.time_stamp,
-                        'node': record.node}
-
-                    vals['modification_info'] = modification_info
-
-                    url = protocol + host + ':' + str(port)
-
-                    resource, fields = arg['resource'],\
-                        arg['fields']
-
-                    # Add resource and instance to URL
-                    url = url + '/' + resource + '/' + record.url_suffix
-
-                    for field in fields:
-                        fname, fvalue = field['name'], field['value']
-                        vals[fname] = fvalue
-
-                    send_data = requests.request(
-                        'PATCH', url,
-                        data=json.dumps(vals),
-                        auth=(user, password), verify=verify_ssl)
-
-                    if (send_data):
-                        rc = True
-            else:
-                print("No federation record locator found .. no update")
-
-        # Create the record on the Federation
-        if (record.method == 'POST'):
-            if (record.federation_locator):
-                # Traverse each resource and its data fields.
-                # arg : Dictionary for each of the data elements in the
-                #       list of values
-                # [{resource, fields[{name, value}]
-
-                for arg in json.loads(record.args):
-                    vals = {}
-                    creation_info = {}
-
-                    # Include the creation information
-                    creation_info = {
-                        'user': user,
-                        'timestamp': record.time_stamp,
-                        'node': record.node}
-
-                    vals['creation_info'] = creation_info
-
-                    url = protocol + host + ':' + str(port)
-
-                    resource, fields = arg['resource'],\
-                        arg['fields']
-
-                    # Add resource and instance to URL
-                    url = url + '/' + resource + '/' + record.url_suffix
-
-                    for field in fields:
-                        fname, fvalue = field['name'], field['value']
-                        vals[fname] = fvalue
-
-                    send_data = requests.request(
-                        'POST', url,
-                        data=json.dumps(vals),
-                        auth=(user, password), verify=verify_ssl)
-
-                    if (send_data):
-                        rc = True
-            else:
-                print("No federation record locator found .. no update")
-
-        return rc
-
-    @classmethod
-    def parse_fields(cls, values, action, fields):
+    def parse_fields(cls, values, action, mapping):
         ''' Returns, depending on the action, the fields that will be
             passed as arguments to Thalamus
+            mapping: list of (field, fed_resource, fed_field) of the model
         '''
         # Fedvals : Values to send to the federation, that contain the
         # resource, the field, and the value of such field.
-
-        field_mapping = fields.split(',')
-        resources = []
+        # Each resource will appear just once, with the list of
+        # its fields.
         fedvals = []
+        resources = {}
 
-        fed_key = {}
-        n = 0
-        for val in field_mapping:
-            # Retrieve the field name, the federation resource name
-            # and the associated federation resource field .
-            # string of the form field:fed_resource:fed_field
-            field, fed_resource, fed_field = val.split(':')
+        for field, fed_resource, fed_field in mapping:
+            # Check that the local field is on shared federation list
             if (field in values.keys()):
-                # Check that the local field is on shared federation list
-                # and retrieve the equivalent federation field name
-
-                # Optimize the process, by not duplicating the resources
-                # Each resource will appear just once, with the list of
-                # its fields.
-                # Create a new item in the resource list
-                # to be returned, if this is not yet there.
-
+                value = values[field]
                 # Serialize the date, datetime objects to be JSON compat
-                if isinstance(values[field], (datetime, date)):
-                    values[field] = values[field].isoformat()
+                if isinstance(value, (datetime, date)):
+                    value = value.isoformat()
 
                 if fed_resource not in resources:
-                    fed_key = {
+                    resources[fed_resource] = {
                         "resource": fed_resource,
-                        "fields": [
-                            {
-                                "name": fed_field,
-                                "value": values[field]
-                            }]
-                        }
+                        "fields": []}
+                    fedvals.append(resources[fed_resource])
 
-                    resources.append(fed_resource)
-                    fedvals.append(fed_key)
+                resources[fed_resource]['fields'].append(
+                    {"name": fed_field,
+                     "value": value})
 
-                else:
-                    # Otherwise, if the resource exists on the list,
-                    # we add the new field values to it.
+        return fedvals
 
-                    n = 0
-                    for record in fedvals:
-                        if fed_resource == record['resource']:
-                            fedvals[n]['fields'].append(
-                                {"name": fed_field,
-                                 "value": values[field]})
-                        n = n+1
+    @staticmethod
+    def merge_args(args, new_args):
+        ''' Merge the federation arguments of a new message into the
+            ones of a pending message. The latest value of each field wins.
+        '''
+        resources = {}
+        for arg in args + new_args:
+            fed_fields = resources.setdefault(arg['resource'], {})
+            for field in arg['fields']:
+                fed_fields[field['name']] = field['value']
+
+        return [{
+            "resource": resource,
+            "fields": [
+                {"name": name, "value": value}
+                for name, value in fed_fields.items()]}
+            for resource, fed_fields in resources.items()]
 
-        return fedvals
+    @classmethod
+    def get_pending(cls, model, locators):
+        ''' Returns, for each locator, its latest message if it is still
+            waiting in the queue, locked so no queue worker takes it
+            while it is being updated.
+        '''
+        table = cls.__table__()
+        latest = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        pending = {}
+        for sub_locators in grouped_slice(locators):
+            query = table.select(
+                table.id, table.federation_locator,
+                where=(table.state == 'queued')
+                & table.id.in_(latest.select(
+                    Max(latest.id),
+                    where=(latest.model == model)
+                    & latest.federation_locator.in_(list(sub_locators))
+                    & latest.state.in_(['queued', 'failed']),
+                    group_by=latest.federation_locator)))
+            query, params = tuple(query)
+            if backend.name == 'postgresql':
+                query += ' FOR UPDATE SKIP LOCKED'
+            cursor.execute(query, params)
+            for msg_id, locator in cursor:
+                pending[locator] = cls(msg_id)
+        return pending
 
     @classmethod
     def enqueue(cls, model, federation_loc, time_stamp, node, values,
                 action, url_suffix):
+        cls.enqueue_bulk(model, [
+            (federation_loc, time_stamp, node, values, action, url_suffix)])
 
-        fields = FederationObject.get_object_fields(model)
+    @classmethod
+    def enqueue_bulk(cls, model, messages):
+        ''' Enqueue the messages of a model with a single create
+            messages: list of (federation_loc, time_stamp, node, values,
+                action, url_suffix)
+        '''
         # Federation locator : Unique ID of the resource
         # such as personal federation account or institution ID
         # it depends on the resource (people, PoL, institution, ... )
-
-        # Remove spaces and newlines from fields
-        fields = fields.replace(" ", "").replace("\n", "")
-
-        if (fields):
+        mapping = FederationObject.get_field_mapping(model)
+        if not mapping:
+            return
+
+        # Coalesce the changes of the same locator. The new messages are
+        # merged with each other and with the message of the locator that
+        # is still in the queue. A pending creation (POST) takes the
+        # latest values of the record.
+        to_queue = []
+        first, latest = {}, {}
+        for federation_loc, time_stamp, node, values, action, url_suffix \
+                in messages:
             # retrieve the federation field names and values in a dict
-            fields_to_enqueue = cls.parse_fields(values, action, fields)
-            # Continue the enqueue process with the fields
-
-            if fields_to_enqueue:
-                rec = []
-                vals = {}
-                vals['msgid'] = str(uuid4())
-                vals['model'] = model
-                vals['time_stamp'] = str(time_stamp)
-                vals['args'] = json.dumps(fields_to_enqueue)
-                vals['method'] = action
-                vals['state'] = 'queued'
-                vals['federation_locator'] = federation_loc
-                vals['url_suffix'] = url_suffix
-                rec.append(vals)
-                # Write the record to the enqueue list
-                cls.create(rec)
+            fields_to_enqueue = cls.parse_fields(values, action, mapping)
+            if not fields_to_enqueue:
+                continue
+
+            queued = latest.get(federation_loc)
+            if (queued and action == 'PATCH'):
+                queued['args'] = cls.merge_args(
+                    queued['args'], fields_to_enqueue)
+                queued['time_stamp'] = str(time_stamp)
+                continue
+
+            vals = {
+                'msgid': str(uuid4()),
+                'model': model,
+                'time_stamp': str(time_stamp),
+                'args': fields_to_enqueue,
+                'method': action,
+                'state': 'queued',
+                'federation_locator': federation_loc,
+                'url_suffix': url_suffix,
+                }
+            to_queue.append(vals)
+            latest[federation_loc] = vals
+            first.setdefault(federation_loc, vals)
+
+        patched = [
+            loc for loc, vals in first.items() if vals['method'] == 'PATCH']
+        pending = cls.get_pending(model, patched) if patched else {}
+
+        to_write = []
+        to_create = []
+        for vals in to_queue:
+            loc = vals['federation_locator']
+            message = pending.get(loc)
+            if message and first[loc] is vals:
+                to_write.extend(([message], {
+                    'time_stamp': vals['time_stamp'],
+                    'args': json.dumps(cls.merge_args(
+                        json.loads(message.args), vals['args'])),
+                    }))
+            else:
+                vals['args'] = json.dumps(vals['args'])
+                to_create.append(vals)
+
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            # Write the records to the enqueue list
+            cls.create(to_create)
 
     @classmethod
     def __setup__(cls):
@@ -421,21 +492,226 @@ class FederationQueue(ModelSQL, ModelView):
         cls._buttons.update({
             'send': {'invisible': Equal(Eval('state'), 'sent')}
             })
+        cls.__rpc__.update({
+                'send_bulk': RPC(readonly=False, instantiate=0),
+                })
 
     @classmethod
     @ModelView.button
     def send(cls, records):
-        # Verify and send each record to Thalamus individually
-        # It allows to get specific status on each operation
+        # Send the selected records to Thalamus.
+        # Each record gets its own sent / failed status
         # record: individual record on gnuhealth.federation.queue model
+        cls.send_bulk(records)
+
+    @classmethod
+    def build_chains(cls, records, user):
+        """ Translate the queued messages into the requests to Thalamus,
+            grouped in one chain per federation locator.
+
+            PATCHes of the same locator and resource that are not
+            separated by another operation on it are coalesced into a
+            single request. The latest value of each field wins.
+
+            Returns the list of chains and the IDs of the messages
+            that can not be sent (no locator or unsupported method)
+        """
+        chains = {}
+        pending = {}
+        invalid = []
+
+        for record in sorted(records, key=lambda r: r.id):
+            if (record.method not in ('PATCH', 'POST')
+                    or not record.federation_locator):
+                invalid.append(record.msgid)
+                continue
+
+            chain = chains.setdefault(record.url_suffix, [])
+            if (record.method == 'PATCH'):
+                info_key = 'modification_info'
+            else:
+                info_key = 'creation_info'
+
+            for arg in json.loads(record.args):
+                resource, fields = arg['resource'], arg['fields']
+                key = (record.url_suffix, resource)
+
+                info = {
+                    'user': user,
+                    'timestamp': record.time_stamp,
+                    'node': record.node}
+
+                if (record.method == 'PATCH' and key in pending):
+                    # Merge the fields on the pending PATCH request
+                    method, path, vals, msgids = pending[key]
+                    vals[info_key] = info
+                    msgids.append(record.msgid)
+                else:
+                    vals = {info_key: info}
+                    path = '/' + resource + '/' + record.url_suffix
+                    request = (record.method, path, vals, [record.msgid])
+                    chain.append(request)
+                    if (record.method == 'PATCH'):
+                        pending[key] = request
+                    else:
+                        # Later PATCHes must go after the POST
+                        pending.pop(key, None)
+
+                for field in fields:
+                    vals[field['name']] = field['value']
+
+        return list(chains.values()), invalid
+
+    @classmethod
+    def send_bulk(cls, records, workers=None):
+        """ Send the queued messages to Thalamus in bulk, using a
+            pooled keep-alive session and a bounded set of workers.
+
+            The status of the messages is updated with one write per state.
+            Returns the throughput information of the operation.
+        """
+        host, port, user, password, ssl_conn, verify_ssl, protocol = \
+            FederationNodeConfig.get_conn_params()
+
+        if workers is None:
+            workers = FederationNodeConfig.get_workers()
+
+        start = time.monotonic()
+        chains, failed_msgs = cls.build_chains(records, user)
+        failed_msgs = set(failed_msgs)
+
+        session = thalamus_session(user, password, verify_ssl, workers)
+        try:
+            failed_msgs.update(send_chains(
+                session, protocol + host + ':' + str(port), chains, workers))
+        finally:
+            session.close()
+
+        sent, failed = [], []
         for record in records:
-            rec = []
-            res = cls.send_record(record)
-            if res:
-                rec.append(record)
-                cls.write(rec, {'state': 'sent'})
+            if record.msgid in failed_msgs:
+                failed.append(record)
             else:
-                cls.write(rec, {'state': 'failed'})
+                sent.append(record)
+
+        to_write = []
+        if sent:
+            to_write.extend((sent, {'state': 'sent', 'next_try': None}))
+        to_write.extend(cls.get_retry_values(failed))
+        if to_write:
+            cls.write(*to_write)
+
+        elapsed = time.monotonic() - start
+        n_requests = sum(len(chain) for chain in chains)
+        stats = {
+            'sent': len(sent),
+            'failed': len(failed),
+            'requests': n_requests,
+            'elapsed': elapsed,
+            'rate': len(records) / elapsed if elapsed else 0.0,
+            }
+        logger.info(
+            "Federation queue: %(sent)s sent, %(failed)s failed, "
+            "%(requests)s requests in %(elapsed).2fs "
+            "(%(rate).1f messages/s)", stats)
+        return stats
+
+    @classmethod
+    def get_retry_values(cls, records):
+        """ Returns the write arguments that mark the records as failed
+            and schedule their next try with exponential backoff.
+        """
+        now = datetime.utcnow()
+        by_attempts = {}
+        for record in records:
+            attempts = (record.attempts or 0) + 1
+            by_attempts.setdefault(attempts, []).append(record)
+
+        to_write = []
+        for attempts, failed in by_attempts.items():
+            delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+            to_write.extend((failed, {
+                'state': 'failed',
+                'attempts': attempts,
+                'next_try': now + timedelta(seconds=delay),
+                }))
+        return to_write
+
+    @classmethod
+    def claim(cls, limit=QUEUE_BATCH):
+        """ Lock and return the next batch of messages ready to be sent.
+            The messages of a locator are claimed by one worker at a time,
+            so several workers can drain the queue in parallel without
+            sending twice or out of order.
+        """
+        table = cls.__table__()
+        previous = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        now = datetime.utcnow()
+
+        # Messages of a locator must reach Thalamus in order, so skip those
+        # behind an older message waiting for a retry or out of attempts
+        blocking = previous.select(
+            previous.id,
+            where=((previous.url_suffix == table.url_suffix)
+                & (previous.id < table.id)
+                & previous.state.in_(['queued', 'failed'])
+                & ((Coalesce(previous.attempts, 0) >= MAX_ATTEMPTS)
+                    | (previous.next_try > now))))
+        ready = (table.state.in_(['queued', 'failed'])
+            & (Coalesce(table.attempts, 0) < MAX_ATTEMPTS)
+            & ((table.next_try == Null) | (table.next_try <= now))
+            & ~Exists(blocking))
+
+        cursor.execute(*table.select(table.url_suffix,
+                where=ready, order_by=table.id.asc, limit=limit))
+        locators = {url_suffix for url_suffix, in cursor}
+        if backend.name == 'postgresql':
+            # The lock of a locator is taken before its messages are
+            # selected, so no other worker can claim the newer messages
+            # while this one holds the older ones
+            locked = set()
+            for url_suffix in locators:
+                cursor.execute('SELECT pg_try_advisory_xact_lock('
+                    'hashtext(%s))', ('%s:%s' % (cls._table, url_suffix),))
+                if cursor.fetchone()[0]:
+                    locked.add(url_suffix)
+            locators = locked
+        if not locators:
+            return []
+
+        names = [l for l in locators if l is not None]
+        where = []
+        if names:
+            where.append(table.url_suffix.in_(names))
+        if None in locators:
+            where.append(table.url_suffix == Null)
+        query = table.select(
+            table.id,
+            where=ready & Or(where),
+            order_by=table.id.asc,
+            limit=limit)
+        query, params = tuple(query)
+        if backend.name == 'postgresql':
+            query += ' FOR UPDATE'
+        cursor.execute(query, params)
+        return cls.browse([r[0] for r in cursor])
+
+    @classmethod
+    def process_queue(cls):
+        """ Queue worker, executed by the scheduler.
+            Sends the queued messages in batches, committing the status
+            of each batch before claiming the next one.
+        """
+        transaction = Transaction()
+        while True:
+            records = cls.claim()
+            if not records:
+                break
+            cls.send_bulk(records)
+            transaction.commit()
+            if len(records) < QUEUE_BATCH:
+                break
 
 
 class FederationObject(ModelSQL, ModelView):
@@ -453,10 +729,52 @@ class FederationObject(ModelSQL, ModelView):
         "the local model fields that participate on the federation.\n"
         "Each line will have the format field:endpoint:key")
 
+    _field_mapping_cache = Cache('gnuhealth_federation_object.mapping')
+
     @staticmethod
     def default_enabled():
         return True
 
+    @classmethod
+    def create(cls, vlist):
+        objects = super(FederationObject, cls).create(vlist)
+        # Restart the cache of the parsed field mappings
+        cls._field_mapping_cache.clear()
+        return objects
+
+    @classmethod
+    def write(cls, *args):
+        super(FederationObject, cls).write(*args)
+        cls._field_mapping_cache.clear()
+
+    @classmethod
+    def delete(cls, objects):
+        super(FederationObject, cls).delete(objects)
+        cls._field_mapping_cache.clear()
+
+    @classmethod
+    def get_field_mapping(cls, obj):
+        """ Returns the parsed field mapping of the model as a list of
+            (field, fed_resource, fed_field). Empty if the model does
+            not participate on the Federation.
+        """
+        mapping = cls._field_mapping_cache.get(obj)
+        if mapping is None:
+            mapping = []
+            models = cls.search_read(
+                [("model", "=", obj), ("enabled", "=", True)],
+                limit=1, fields_names=['fields'])
+            if (models and models[0]['fields']):
+                # Remove spaces and newlines from fields
+                # string of the form field:fed_resource:fed_field
+                fields = models[0]['fields'].replace(" ", "").replace(
+                    "\n", "")
+                for val in fields.split(','):
+                    if val:
+                        mapping.append(tuple(val.split(':')))
+            cls._field_mapping_cache.set(obj, mapping)
+        return mapping
+
     @classmethod
     def get_object_fields(cls, obj):
         model, = cls.search_read(
@@ -504,35 +822,39 @@ class PartyFed(ModelSQL):
         return True
 
     @classmethod
-    def write(cls, parties, values):
+    def write(cls, *args):
         # First exec the Party class write method from health package
-        super(PartyFed, cls).write(parties, values)
+        super(PartyFed, cls).write(*args)
+
+        action = "PATCH"
+        node = None
+        messages = []
+        enqueued = []
+
+        actions = iter(args)
+        for parties, values in zip(actions, actions):
+            # Skip the records that are written with the fsync flag unset
+            # (eg, information imported from the Federation)
+            if (not values or ('fsync' in values and not values['fsync'])):
+                continue
 
-        for party in parties:
-            action = "PATCH"
             # Retrieve federation account (for people only)
-            fed_acct = party.federation_account
-            fsync = party.fsync
-            # Verify that the person has a Federation account.
-            # and the fsync flag is set for the record
-            if (fed_acct and values):
-                if (fsync or 'fsync' not in values.keys()):
-                    # Start Enqueue process
-                    node = None
-                    # Because du_address is a functional field
-                    # does not exist at DB level, we always pass the
-                    # latest / current value
-                    values['du_address'] = party.du_address
-                    time_stamp = party.write_date
-                    url_suffix = fed_acct
-                    FederationQueue.enqueue(
-                        cls.__name__,
-                        fed_acct, time_stamp, node, values, action,
-                        url_suffix)
-
-                    # Unset the fsync flag locally once the info has been
-                    # sent to the Federation queue
-                    set_fsync(cls, parties, False)
+            # Because du_address is a functional field
+            # does not exist at DB level, we always pass the
+            # latest / current value
+            for party in cls.read(
+                    [p.id for p in parties],
+                    ['federation_account', 'write_date']):
+                fed_acct = party['federation_account']
+                # Verify that the person has a Federation account.
+                if fed_acct:
+                    messages.append((
+                        fed_acct, party['write_date'], node, dict(values),
+                        action, fed_acct))
+                    enqueued.append(party['id'])
+
+        if messages:
+            cls.enqueue_fed(messages, enqueued)
 
     @classmethod
     def create(cls, vlist):
@@ -541,39 +863,49 @@ class PartyFed(ModelSQL):
         # Execute first the creation of party
         parties = super(PartyFed, cls).create(vlist)
 
-        for values in vlist:
-            fed_acct = parties[0].federation_account
+        action = "POST"
+        node = None
+        messages = []
+        enqueued = []
 
-            # Check if the record has just been imported of modified
-            # from the federation. In that case, skip sending it
-            # to the federation queue
+        # Check if the record has just been imported of modified
+        # from the federation. In that case, skip sending it
+        # to the federation queue
+        parties_info = cls.read(
+            [p.id for p in parties],
+            ['federation_account', 'fsync', 'create_date'])
 
-            fsync = parties[0].fsync
+        for party, values in zip(parties_info, vlist):
+            fed_acct = party['federation_account']
             # If the user has a federation ID, then enqueue the
             # record to be sent and created in the Federation
+            if fed_acct and party['fsync']:
+                messages.append((
+                    fed_acct, party['create_date'], node, values,
+                    action, fed_acct))
+                enqueued.append(party['id'])
 
-            if fed_acct and fsync:
-                action = "POST"
-                node = None
+        if messages:
+            cls.enqueue_fed(messages, enqueued)
 
-                # Because du_address is a functional field
-                # does not exist at DB level, we always pass the
-                # latest / current value
-                values['du_address'] = parties[0].du_address
+        return parties
 
-                url_suffix = fed_acct
-                time_stamp = parties[0].create_date
-                FederationQueue.enqueue(
-                    cls.__name__,
-                    fed_acct, time_stamp, node, values,
-                    action, url_suffix)
+    @classmethod
+    def enqueue_fed(cls, messages, party_ids):
+        # Because du_address is a functional field
+        # does not exist at DB level, we always pass the
+        # latest / current value, computed for the whole batch
+        du_addresses = {
+            p['id']: p['du_address']
+            for p in cls.read(party_ids, ['du_address'])}
+        for message, party_id in zip(messages, party_ids):
+            message[3]['du_address'] = du_addresses[party_id]
 
-                # Unset the fsync flag locally once the info has been
-                # sent to the Federation queue
-                if (fsync):
-                    set_fsync(cls, parties, False)
+        FederationQueue.enqueue_bulk(cls.__name__, messages)
 
-        return parties
+        # Unset the fsync flag locally once the info has been
+        # sent to the Federation queue
+        set_fsync(cls, cls.browse(party_ids), False)
 
 
 class PoLFed(ModelSQL):
@@ -598,32 +930,40 @@ class PoLFed(ModelSQL):
         return True
 
     @classmethod
-    def write(cls, pols, values):
-        super(PoLFed, cls).write(pols, values)
+    def write(cls, *args):
+        super(PoLFed, cls).write(*args)
+
+        action = "PATCH"
+        node = None
+        messages = []
+        enqueued = []
+
+        actions = iter(args)
+        for pols, values in zip(actions, actions):
+            # Skip the records that are written with the fsync flag unset
+            if (not values or ('fsync' in values and not values['fsync'])):
+                continue
 
-        for pol in pols:
-            action = "PATCH"
             # Retrieve page of life unique ID into fed_identifier
-            fed_identifier = pol.page
-            federation_account = pol.federation_account
-
-            fsync = pol.fsync
-            # Verify that the page has the federation identifier.
-            # and the fsync flag is set for the record
-            if (fed_identifier and values):
-                if (fsync or 'fsync' not in values.keys()):
-                    # Start Enqueue process
-                    node = None
-                    time_stamp = pol.write_date
-                    url_suffix = federation_account + '/' + fed_identifier
-                    FederationQueue.enqueue(
-                        cls.__name__,
-                        fed_identifier, time_stamp, node, values,
-                        action, url_suffix)
-
-                    # Unset the fsync flag locally once the info has been
-                    # sent to the Federation queue
-                    set_fsync(cls, pols, False)
+            for pol in cls.read(
+                    [p.id for p in pols],
+                    ['page', 'federation_account', 'write_date']):
+                fed_identifier = pol['page']
+                # Verify that the page has the federation identifier.
+                if fed_identifier:
+                    url_suffix = (
+                        pol['federation_account'] + '/' + fed_identifier)
+                    messages.append((
+                        fed_identifier, pol['write_date'], node, values,
+                        action, url_suffix))
+                    enqueued.append(pol['id'])
+
+        if messages:
+            FederationQueue.enqueue_bulk(cls.__name__, messages)
+
+            # Unset the fsync flag locally once the info has been
+            # sent to the Federation queue
+            set_fsync(cls, cls.browse(enqueued), False)
 
     @classmethod
     def create(cls, vlist):
@@ -632,30 +972,46 @@ class PoLFed(ModelSQL):
         # Execute first the creation of PoL
         pols = super(PoLFed, cls).create(vlist)
 
-        for values in vlist:
-            fed_identifier = pols[0].page
-            federation_account = pols[0].federation_account
-            # Check if the record has just been imported of modified
-            # from the federation. In that case, skip sending it
-            # to the federation queue
+        action = "POST"
+        node = None
+        messages = []
+        enqueued = []
 
-            fsync = pols[0].fsync
+        # Check if the record has just been imported of modified
+        # from the federation. In that case, skip sending it
+        # to the federation queue
+        pols_info = cls.read(
+            [p.id for p in pols],
+            ['page', 'federation_account', 'fsync', 'create_date'])
+
+        for pol, values in zip(pols_info, vlist):
+            fed_identifier = pol['page']
             # If the page has a federation ID, then enqueue the
             # record to be sent and created in the Federation
+            if fed_identifier and pol['fsync']:
+                url_suffix = pol['federation_account'] + '/' + fed_identifier
+                messages.append((
+                    fed_identifier, pol['create_date'], node, values,
+                    action, url_suffix))
+                enqueued.append(pol['id'])
+
+        if messages:
+            FederationQueue.enqueue_bulk(cls.__name__, messages)
 
-            if fed_identifier and fsync:
-                action = "POST"
-                node = None
-                time_stamp = pols[0].create_date
-                url_suffix = federation_account + '/' + fed_identifier
-                FederationQueue.enqueue(
-                    cls.__name__,
-                    fed_identifier, time_stamp, node, values,
-                    action, url_suffix)
-
-                # Unset the fsync flag locally once the info has been
-                # sent to the Federation queue
-                if (fsync):
-                    set_fsync(cls, pols, False)
+            # Unset the fsync flag locally once the info has been
+            # sent to the Federation queue
+            set_fsync(cls, cls.browse(enqueued), False)
 
         return pols
+
+
+class FederationCron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(FederationCron, cls).__setup__()
+        cls.method.selection.extend([
+            ('gnuhealth.federation.queue|process_queue',
+                "Send Federation Queue"),
+            ])
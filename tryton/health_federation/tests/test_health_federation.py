@@ -3,9 +3,20 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import json
 import unittest
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from trytond.modules.health.tests.stub_server import start_stub_server
+from trytond.modules.health_federation.health_federation import (
+    FederationQueue, send_chains, thalamus_session)
 
 
 class HealthArchivesTestCase(ModuleTestCase):
@@ -15,8 +26,121 @@ class HealthArchivesTestCase(ModuleTestCase):
     module = 'health_archives'
 
 
+class FederationQueueTestCase(ModuleTestCase):
+    '''
+    Test the claim of the Federation queue by concurrent workers
+    '''
+    module = 'health_federation'
+
+    @unittest.skipIf(backend.name != 'postgresql',
+        'The workers lock the messages only on PostgreSQL')
+    @with_transaction()
+    def test_claim_concurrent(self):
+        'Test a worker can not claim the newer messages of a locator'
+        Queue = Pool().get('gnuhealth.federation.queue')
+        transaction = Transaction()
+
+        # The other worker only sees the committed messages
+        messages = Queue.create([{
+                    'msgid': 'claim%s' % i,
+                    'model': 'party.party',
+                    'node': 'GH',
+                    'time_stamp': str(i),
+                    'args': '[]',
+                    'method': 'PATCH',
+                    'state': 'queued',
+                    'federation_locator': locator,
+                    'url_suffix': locator,
+                    } for i, locator in enumerate(['X', 'X', 'X', 'Y'])])
+        transaction.commit()
+        try:
+            claimed = Queue.claim(limit=2)
+            with transaction.new_transaction():
+                other = Queue.claim()
+                other_ids = [m.id for m in other]
+            self.assertEqual(
+                [m.id for m in claimed], [m.id for m in messages[:2]])
+            self.assertEqual(other_ids, [messages[3].id])
+        finally:
+            transaction.rollback()
+            Queue.delete(Queue.browse([m.id for m in messages]))
+            transaction.commit()
+
+
+class StubThalamusHandler(BaseHTTPRequestHandler):
+    # Minimal Thalamus: accepts every request except on /fail/ resources
+
+    def do_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length))
+        self.server.received.append((self.command, self.path, body))
+        if self.path.startswith('/fail/'):
+            self.send_response(500)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PATCH = do_POST = do_request
+
+    def log_message(self, *args):
+        pass
+
+
+class FederationBulkSendTestCase(unittest.TestCase):
+    '''
+    Test the bulk sender of the Federation queue against a stub Thalamus
+    '''
+
+    def setUp(self):
+        self.server, self.base_url = start_stub_server(
+            self, StubThalamusHandler, received=[])
+
+    def message(self, id_, method, suffix, resource, values):
+        return SimpleNamespace(
+            id=id_, msgid='msg%s' % id_, method=method, node='GH',
+            time_stamp='2022-01-0%s' % id_, federation_locator=suffix,
+            url_suffix=suffix,
+            args=json.dumps([{
+                'resource': resource,
+                'fields': [{'name': k, 'value': v}
+                    for k, v in values.items()]}]))
+
+    def test_coalesce_and_send(self):
+        records = [
+            self.message(1, 'POST', 'ESPGNU1', 'people', {'name': 'Ana'}),
+            self.message(2, 'PATCH', 'ESPGNU1', 'people', {'name': 'Anna'}),
+            self.message(3, 'PATCH', 'ESPGNU1', 'people', {'name': 'Ann'}),
+            self.message(4, 'PATCH', 'ESPGNU2', 'people', {'dob': 'x'}),
+            self.message(5, 'PATCH', 'ESPGNU3', 'fail', {'dob': 'y'}),
+            self.message(6, 'PATCH', None, 'people', {'dob': 'z'}),
+            ]
+        chains, invalid = FederationQueue.build_chains(records, 'admin')
+        self.assertEqual(invalid, ['msg6'])
+        self.assertEqual(sum(len(chain) for chain in chains), 4)
+
+        session = thalamus_session('admin', 'secret', False, 2)
+        failed = send_chains(session, self.base_url, chains, workers=2)
+        session.close()
+
+        self.assertEqual(failed, {'msg5'})
+        # The messages of a locator arrive in the order of the queue
+        received = [
+            r for r in self.server.received if r[1] == '/people/ESPGNU1']
+        self.assertEqual(
+            [(method, body['name']) for method, path, body in received],
+            [('POST', 'Ana'), ('PATCH', 'Ann')])
+        patch = received[1][2]
+        self.assertEqual(
+            patch['modification_info']['timestamp'], '2022-01-03')
+
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         HealthArchivesTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        FederationQueueTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        FederationBulkSendTestCase))
     return suite
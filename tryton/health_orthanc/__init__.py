@@ -22,8 +22,12 @@ def register():
         wizard.wizard.AddOrthancInit,
         wizard.wizard.AddOrthancResult,
         health_orthanc.OrthancServerConfig,
+        health_orthanc.OrthancCron,
         health_orthanc.OrthancStudy,
         health_orthanc.OrthancPatient,
+        health_orthanc.PatientIdentifier,
+        health_orthanc.Party,
+        health_orthanc.AlternativePersonID,
         health_orthanc.TestResult,
         health_orthanc.Patient,
         module="health_orthanc",
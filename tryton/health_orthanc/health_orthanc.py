@@ -13,25 +13,115 @@
 #########################################################################
 
 from trytond.model import ModelView, ModelSQL, fields, Unique
-from trytond.pool import Pool
+from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
+from trytond.config import config
+from trytond.tools import grouped_slice, reduce_ids
+from trytond import backend
 from beren import Orthanc as RestClient
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth as auth
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urljoin
 import logging
 import pendulum
+import requests
+import time
+from sql import Literal, Null, Union
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp
 
 __all__ = [
     "OrthancServerConfig",
+    "OrthancCron",
     "OrthancPatient",
     "OrthancStudy",
+    "PatientIdentifier",
+    "Party",
+    "AlternativePersonID",
     "Patient",
     "TestResult",
 ]
 
 logger = logging.getLogger(__name__)
 
+# Concurrent requests to the Orthanc server
+WORKERS = config.getint("health_orthanc", "workers", default=8)
+# Changes processed (and committed) at a time
+PAGE_SIZE = config.getint("health_orthanc", "page_size", default=1000)
+TIMEOUT = config.getint("health_orthanc", "timeout", default=60)
+# Resources created at a time by the initial import
+IMPORT_BATCH = config.getint("health_orthanc", "import_batch", default=500)
+# Servers synced at the same time
+SYNC_SERVERS = config.getint("health_orthanc", "sync_servers", default=4)
+
+
+def orthanc_session(user, password, pool_size=1):
+    """Return a keep-alive HTTP session to the Orthanc REST server, with
+    a connection pool large enough to serve each of the workers"""
+
+    session = requests.Session()
+    session.auth = auth(user, password)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def orthanc_url(domain, path):
+    return urljoin("".join([domain.rstrip("/"), "/"]), path)
+
+
+def get_changes(session, domain, since, limit):
+    """Return a page of the changes feed, after the change index since"""
+
+    response = session.get(
+        orthanc_url(domain, "changes"),
+        params={"since": since, "limit": limit}, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_last_change(session, domain):
+    """Return the index of the newest change of the server"""
+
+    response = session.get(
+        orthanc_url(domain, "changes"), params={"last": ""},
+        timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()["Last"]
+
+
+def get_resources(session, domain, kind, since, limit):
+    """Return a page of the expanded resources of the kind (patients,
+    studies), starting at the position since"""
+
+    response = session.get(
+        orthanc_url(domain, kind),
+        params={"expand": "", "since": since, "limit": limit},
+        timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_resources(session, domain, kind, uuids, workers=1):
+    """Fetch concurrently the resources of the kind (patients, studies)
+    with the given UUIDs. Resources deleted since the change was logged
+    are skipped. Any other error is raised."""
+
+    def fetch(uuid):
+        response = session.get(
+            orthanc_url(domain, "{}/{}".format(kind, uuid)), timeout=TIMEOUT)
+        if response.status_code == 404:
+            logger.info("{} {} no longer exists".format(kind, uuid))
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return [r for r in executor.map(fetch, uuids) if r]
+
 
 class OrthancServerConfig(ModelSQL, ModelView):
     """Orthanc server details"""
@@ -61,6 +151,54 @@ class OrthancServerConfig(ModelSQL, ModelView):
         "Validated", help="Whether the server details have been "
         "successfully checked")
 
+    import_state = fields.Selection([
+        (None, ""),
+        ("patients", "Importing patients"),
+        ("studies", "Importing studies"),
+        ("done", "Done"),
+        ], "Initial Import", readonly=True, sort=False,
+        help="Progress of the import of the patients and studies that "
+        "were stored on the server before it was added")
+
+    import_offset = fields.Integer(
+        "Import Position", readonly=True,
+        help="Position on the server of the next resource to import")
+
+    imported_patients = fields.Integer("Imported Patients", readonly=True)
+
+    imported_studies = fields.Integer("Imported Studies", readonly=True)
+
+    sync_timeout = fields.Integer(
+        "Sync Timeout", required=True,
+        help="Maximum duration of a sync of this server, in seconds. "
+        "Once reached, the sync stops after the current page of changes "
+        "and goes on in the next run")
+
+    health = fields.Selection([
+        (None, ""),
+        ("ok", "OK"),
+        ("late", "Late"),
+        ("down", "Down"),
+        ], "Health", readonly=True, sort=False,
+        help="Result of the last sync. Late means the sync timeout was "
+        "reached before the newest change")
+
+    last_error = fields.Text(
+        "Last Error", readonly=True, help="Error of the last failed sync")
+
+    latency = fields.Float(
+        "Latency", digits=(16, 1), readonly=True,
+        help="Mean response time of the changes feed in the last sync, "
+        "in milliseconds")
+
+    sync_changes = fields.Integer(
+        "Changes", readonly=True,
+        help="Number of changes processed in the last sync")
+
+    throughput = fields.Float(
+        "Throughput", digits=(16, 1), readonly=True,
+        help="Changes processed per second in the last sync")
+
     since_sync = fields.Function(
         fields.TimeDelta("Since last sync", help="Time since last sync"),
         "get_since_sync",)
@@ -83,6 +221,10 @@ class OrthancServerConfig(ModelSQL, ModelView):
         add = "app/explorer.html"
         return urljoin(pre, add)
 
+    @staticmethod
+    def default_sync_timeout():
+        return 600
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -99,86 +241,219 @@ class OrthancServerConfig(ModelSQL, ModelView):
 
     @classmethod
     def sync(cls, servers=None):
-        """Sync from changes endpoint"""
-
-        pool = Pool()
-        patient = pool.get("gnuhealth.orthanc.patient")
-        study = pool.get("gnuhealth.orthanc.study")
+        """Sync from changes endpoint.
+        Each server is synced in its own worker and transaction, so a slow
+        or broken server does not delay nor roll back the others"""
 
         if not servers:
             servers = cls.search([("domain", "!=", None),
                                   ("validated", "=", True)])
+        server_ids = [s.id for s in servers if s.validated]
+        if not server_ids:
+            return
+
+        transaction = Transaction()
+        database = transaction.database.name
+        user = transaction.user
+        context = transaction.context
+
+        def worker(server_id):
+            with Transaction().start(database, user, context=context):
+                cls.sync_one(cls(server_id))
 
         logger.info("Starting sync")
-        for server in servers:
-            if not server.validated:
-                continue
-            logger.info("Getting new changes for <{}>".format(server.label))
-            orthanc = RestClient(server.domain,
-                                 auth=auth(server.user, server.password))
-            curr = server.last
-            new_patients = set()
-            update_patients = set()
-            new_studies = set()
-            update_studies = set()
-
-            while True:
-                try:
-                    changes = orthanc.get_changes(since=curr)
-                except:
-                    server.validated = False
-                    logger.exception(
-                        "Invalid details for <{}>".format(server.label))
-                    break
-                for change in changes["Changes"]:
-                    type_ = change["ChangeType"]
-                    if type_ == "NewStudy":
-                        new_studies.add(change["ID"])
-                    elif type_ == "StableStudy":
-                        update_studies.add(change["ID"])
-                    elif type_ == "NewPatient":
-                        new_patients.add(change["ID"])
-                    elif type_ == "StablePatient":
-                        update_patients.add(change["ID"])
-                    else:
-                        pass
-                curr = changes["Last"]
-
-                if changes["Done"] is True:
-                    logger.info("<{}> at newest change".format(server.label))
-                    break
-
-            update_patients -= new_patients
-            update_studies -= new_studies
-            if new_patients:
-                patient.create_patients(
-                    [orthanc.get_patient(p) for p in new_patients], server
-                )
-            if update_patients:
-                patient.update_patients(
-                    [orthanc.get_patient(p) for p in update_patients], server
-                )
-            if new_studies:
-                study.create_studies(
-                    [orthanc.get_study(s) for s in new_studies], server
-                )
-            if update_studies:
-                study.update_studies(
-                    [orthanc.get_study(s) for s in update_studies], server
-                )
-            server.last = curr
-            server.sync_time = datetime.now()
+        with ThreadPoolExecutor(
+                max_workers=max(min(SYNC_SERVERS, len(server_ids)), 1)
+                ) as executor:
+            # Errors are logged and recorded by each worker
+            list(executor.map(worker, server_ids))
+
+    @classmethod
+    def sync_one(cls, server):
+        """Sync a server and record its health"""
+
+        transaction = Transaction()
+        logger.info("Getting new changes for <{}>".format(server.label))
+        session = orthanc_session(server.user, server.password, WORKERS)
+        deadline = None
+        if server.sync_timeout:
+            deadline = time.monotonic() + server.sync_timeout
+        try:
+            if server.import_state in ("patients", "studies"):
+                imported = cls.import_server(
+                    server, session, deadline=deadline)
+            else:
+                imported = True
+            if imported:
+                stats = cls.sync_server(server, session, deadline=deadline)
+            else:
+                stats = {
+                    "done": False,
+                    "changes": 0,
+                    "latency": None,
+                    "throughput": None,
+                    }
+        except Exception as exception:
+            transaction.rollback()
+            logger.exception("Unable to sync <{}>".format(server.label))
+            values = {
+                "health": "down",
+                "last_error": str(exception),
+                "sync_changes": 0,
+                "throughput": None,
+                }
+            response = getattr(exception, "response", None)
+            if response is not None and response.status_code in (401, 403):
+                values["validated"] = False
+            cls.write([server], values)
+        else:
+            cls.write([server], {
+                    "health": "ok" if stats["done"] else "late",
+                    "last_error": None,
+                    "latency": stats["latency"],
+                    "sync_changes": stats["changes"],
+                    "throughput": stats["throughput"],
+                    })
+        finally:
+            session.close()
+
+    @classmethod
+    def import_server(cls, server, session, deadline=None):
+        """Import the patients and then the studies stored on the server,
+        paging through them in batches of IMPORT_BATCH. Each batch is
+        committed with the position of the next one, so the memory used
+        does not depend on the size of the archive and an interrupted
+        import resumes from the last committed batch.
+        The import stops after the batch that reaches the deadline.
+
+        Returns True once the import is done"""
+
+        pool = Pool()
+        Patient = pool.get("gnuhealth.orthanc.patient")
+        Study = pool.get("gnuhealth.orthanc.study")
+        transaction = Transaction()
+
+        state = server.import_state
+        offset = server.import_offset or 0
+        imported = {
+            "patients": server.imported_patients or 0,
+            "studies": server.imported_studies or 0,
+            }
+        while state in ("patients", "studies"):
+            resources = get_resources(
+                session, server.domain, state, offset, IMPORT_BATCH)
+            if state == "patients":
+                Patient.upsert_patients(resources, server)
+            else:
+                Study.upsert_studies(resources, server)
+
+            offset += len(resources)
+            imported[state] += len(resources)
+            values = {"imported_" + state: imported[state]}
+            logger.info("<{}> imported {} {}".format(
+                    server.label, imported[state], state))
+            if len(resources) < IMPORT_BATCH:
+                state = "studies" if state == "patients" else "done"
+                offset = 0
+            values["import_state"] = state
+            values["import_offset"] = offset
+            cls.write([server], values)
+            transaction.commit()
+
+            if (state in ("patients", "studies")
+                    and deadline and time.monotonic() >= deadline):
+                logger.warning(
+                    "<{}> sync timeout reached while importing".format(
+                        server.label))
+                return False
+        return True
+
+    @classmethod
+    def sync_server(cls, server, session, deadline=None):
+        """Process the changes of the server in pages of PAGE_SIZE.
+        The resources of a page are fetched concurrently, and the page is
+        committed with its last change index as checkpoint, so an
+        interrupted sync resumes from the last committed page.
+        The sync stops after the page that reaches the deadline.
+
+        Returns the statistics of the sync"""
+
+        pool = Pool()
+        Patient = pool.get("gnuhealth.orthanc.patient")
+        Study = pool.get("gnuhealth.orthanc.study")
+        transaction = Transaction()
+
+        n_patients = n_studies = n_changes = 0
+        requests_time = 0
+        pages = 0
+        start = time.monotonic()
+        since = server.last or 0
+        while True:
+            request_start = time.monotonic()
+            changes = get_changes(session, server.domain, since, PAGE_SIZE)
+            requests_time += time.monotonic() - request_start
+            pages += 1
+
+            patients = set()
+            studies = set()
+            for change in changes["Changes"]:
+                type_ = change["ChangeType"]
+                if type_ in ("NewPatient", "StablePatient"):
+                    patients.add(change["ID"])
+                elif type_ in ("NewStudy", "StableStudy"):
+                    studies.add(change["ID"])
+
+            studies = fetch_resources(
+                session, server.domain, "studies", studies, WORKERS)
+
+            # Parent patients of the studies that are not known yet
+            parents = {s["ParentPatient"] for s in studies} - patients
+            known = set()
+            for sub_uuids in grouped_slice(list(parents)):
+                known.update(p.uuid for p in Patient.search([
+                            ("server", "=", server.id),
+                            ("uuid", "in", list(sub_uuids))]))
+            patients |= parents - known
+
+            patients = fetch_resources(
+                session, server.domain, "patients", patients, WORKERS)
+
+            Patient.upsert_patients(patients, server)
+            Study.upsert_studies(studies, server)
+            cls.write([server], {
+                    "last": changes["Last"],
+                    "sync_time": datetime.now(),
+                    })
+            transaction.commit()
+            since = changes["Last"]
+
+            n_patients += len(patients)
+            n_studies += len(studies)
+            n_changes += len(changes["Changes"])
             logger.info(
-                "<{}> sync complete: {} new patients, {} \
-                update patients, {} new studies, {} updated studies".format(
-                    server.label,
-                    len(new_patients),
-                    len(update_patients),
-                    len(new_studies),
-                    len(update_studies),
-                )
-            )
-        cls.save(servers)
+                "<{}> synced up to change {}".format(
+                    server.label, changes["Last"]))
+
+            done = changes["Done"] is True
+            if done:
+                logger.info("<{}> at newest change".format(server.label))
+                break
+            if deadline and time.monotonic() >= deadline:
+                logger.warning(
+                    "<{}> sync timeout reached at change {}".format(
+                        server.label, changes["Last"]))
+                break
+
+        elapsed = time.monotonic() - start
+        logger.info(
+            "<{}> sync complete: {} patients, {} studies".format(
+                server.label, n_patients, n_studies))
+        return {
+            "done": done,
+            "changes": n_changes,
+            "latency": requests_time * 1000 / pages,
+            "throughput": n_changes / elapsed if elapsed else None,
+            }
 
     @staticmethod
     def quick_check(domain, user, password):
@@ -207,6 +482,19 @@ class OrthancServerConfig(ModelSQL, ModelView):
             return ""
 
 
+class OrthancCron(metaclass=PoolMeta):
+    __name__ = "ir.cron"
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+            ("gnuhealth.orthanc.config|sync", "Sync Orthanc Servers"),
+            ("gnuhealth.orthanc.patient|relink",
+                "Link Orthanc Patients to Patients"),
+            ])
+
+
 class OrthancPatient(ModelSQL, ModelView):
     """Orthanc patient information"""
 
@@ -217,7 +505,7 @@ class OrthancPatient(ModelSQL, ModelView):
     )
     name = fields.Char("PatientName", readonly=True)
     bd = fields.Date("Birthdate", readonly=True)
-    ident = fields.Char("PatientID", readonly=True)
+    ident = fields.Char("PatientID", readonly=True, select=True)
     uuid = fields.Char("PatientUUID", readonly=True, required=True)
     studies = fields.One2Many(
         "gnuhealth.orthanc.study", "patient", "Studies", readonly=True
@@ -269,59 +557,95 @@ class OrthancPatient(ModelSQL, ModelView):
         return data
 
     @classmethod
-    def update_patients(cls, patients, server):
-        """Update patients"""
+    def upsert_patients(cls, patients, server):
+        """Create or update the patients. The existing records and the
+        matching patients are looked up in bulk for the whole list"""
+
+        pool = Pool()
+        Identifier = pool.get("gnuhealth.orthanc.identifier")
 
         entries = cls.get_info_from_dicom(patients)
-        updates = []
+
+        existing = {}
+        for sub_uuids in grouped_slice([e["uuid"] for e in entries]):
+            existing.update((p.uuid, p) for p in cls.search([
+                        ("server", "=", server.id),
+                        ("uuid", "in", list(sub_uuids))]))
+
+        matches = Identifier.resolve([e["ident"] for e in entries])
+
+        to_write = []
+        to_create = []
         for entry in entries:
-            try:
-                patient = cls.search(
-                    [("uuid", "=", entry["uuid"]),
-                     ("server", "=", server)], limit=1
-                )[0]
-                patient.name = entry["name"]
-                patient.bd = entry["bd"]
-                patient.ident = entry["ident"]
+            g_patient = matches.get(entry["ident"])
+            patient = existing.get(entry["uuid"])
+            if patient:
+                values = {
+                    "name": entry["name"],
+                    "bd": entry["bd"],
+                    "ident": entry["ident"],
+                    }
                 # don't update unless no patient attached
-                if not patient.patient:
-                    try:
-                        g_patient = Patient.search(
-                            [("puid", "=", entry["ident"])], limit=1
-                        )[0]
-                        patient.patient = g_patient
-                        logger.info(
-                            "New Matching PUID found for {}".
-                            format(entry["ident"])
-                        )
-                    except:
-                        pass
-                updates.append(patient)
+                if not patient.patient and g_patient:
+                    values["patient"] = g_patient
+                    logger.info(
+                        "New Matching PUID found for {}".format(
+                            entry["ident"]))
+                to_write.extend(([patient], values))
                 logger.info("Updating patient {}".format(entry["uuid"]))
-            except:
-                continue
-                logger.warning("Unable to update patient {}".
-                               format(entry["uuid"]))
-        cls.save(updates)
+            else:
+                if g_patient:
+                    logger.info(
+                        "Matching PUID found for {}".format(entry["uuid"]))
+                entry["server"] = server.id
+                entry["patient"] = g_patient
+                to_create.append(entry)
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
 
     @classmethod
-    def create_patients(cls, patients, server):
-        """Create patients"""
+    def relink(cls):
+        """Link the Orthanc patients that have no local patient yet to the
+        patients registered since, matching their PatientID"""
 
         pool = Pool()
-        Patient = pool.get("gnuhealth.patient")
+        Identifier = pool.get("gnuhealth.orthanc.identifier")
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(
+                table.id, table.ident,
+                where=(table.patient == Null) & (table.ident != Null)))
+        orphans = cursor.fetchall()
+
+        linked = 0
+        for sub_orphans in grouped_slice(orphans):
+            sub_orphans = list(sub_orphans)
+            matches = Identifier.resolve([o[1] for o in sub_orphans])
+            by_patient = {}
+            for orphan_id, ident in sub_orphans:
+                if ident in matches:
+                    by_patient.setdefault(
+                        matches[ident], []).append(orphan_id)
+            to_write = []
+            for patient, ids in by_patient.items():
+                to_write.extend((cls.browse(ids), {"patient": patient}))
+                linked += len(ids)
+            if to_write:
+                cls.write(*to_write)
+        logger.info("{} Orthanc patients linked".format(linked))
 
-        entries = cls.get_info_from_dicom(patients)
-        for entry in entries:
-            try:
-                g_patient = Patient.search(
-                    [("puid", "=", entry["ident"])], limit=1)[0]
-                logger.info("Matching PUID found for {}".format(entry["uuid"]))
-            except:
-                g_patient = None
-            entry["server"] = server
-            entry["patient"] = g_patient
-        cls.create(entries)
+    @classmethod
+    def update_patients(cls, patients, server):
+        """Update patients"""
+        cls.upsert_patients(patients, server)
+
+    @classmethod
+    def create_patients(cls, patients, server):
+        """Create patients"""
+        cls.upsert_patients(patients, server)
 
 
 class OrthancStudy(ModelSQL, ModelView):
@@ -408,55 +732,197 @@ class OrthancStudy(ModelSQL, ModelView):
         return data
 
     @classmethod
-    def update_studies(cls, studies, server):
-        """Update studies"""
+    def upsert_studies(cls, studies, server):
+        """Create or update the studies. The existing records and the
+        parent patients are looked up in bulk for the whole list"""
+
+        pool = Pool()
+        Patient = pool.get("gnuhealth.orthanc.patient")
 
         entries = cls.get_info_from_dicom(studies)
-        updates = []
+
+        existing = {}
+        for sub_uuids in grouped_slice([e["uuid"] for e in entries]):
+            existing.update((s.uuid, s) for s in cls.search([
+                        ("server", "=", server.id),
+                        ("uuid", "in", list(sub_uuids))]))
+
+        parents = {}
+        for sub_uuids in grouped_slice(
+                list({e["parent_patient"] for e in entries})):
+            parents.update((p.uuid, p.id) for p in Patient.search([
+                        ("server", "=", server.id),
+                        ("uuid", "in", list(sub_uuids))]))
+
+        to_write = []
+        to_create = []
         for entry in entries:
-            try:
-                study = cls.search(
-                    [("uuid", "=", entry["uuid"]),
-                        ("server", "=", server)], limit=1
-                )[0]
-                study.description = entry["description"]
-                study.date = entry["date"]
-                study.ident = entry["ident"]
-                study.institution = entry["institution"]
-                study.ref_phys = entry["ref_phys"]
-                study.req_phys = entry["req_phys"]
-                updates.append(study)
-                logger.info("Updating study {}".format(entry["uuid"]))
-            except:
-                continue
+            parent = entry.pop("parent_patient")  # remove non-model entry
+            patient = parents.get(parent)
+            if not patient:
                 logger.warning(
-                    "Unable to update study {}".format(entry["uuid"]))
-        cls.save(updates)
+                    "No parent patient found for study {}".format(
+                        entry["uuid"]))
+            study = existing.get(entry["uuid"])
+            if study:
+                if not study.patient and patient:
+                    entry["patient"] = patient
+                to_write.extend(([study], entry))
+                logger.info("Updating study {}".format(entry["uuid"]))
+            else:
+                entry["server"] = server.id
+                entry["patient"] = patient
+                to_create.append(entry)
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def update_studies(cls, studies, server):
+        """Update studies"""
+        cls.upsert_studies(studies, server)
 
     @classmethod
     def create_studies(cls, studies, server):
         """Create studies"""
+        cls.upsert_studies(studies, server)
+
+
+class PatientIdentifier(ModelSQL):
+    """Identifiers of the patients (PUID and alternative IDs), indexed to
+    match them with the DICOM PatientID"""
+
+    __name__ = "gnuhealth.orthanc.identifier"
+
+    code = fields.Char("Code", required=True, select=True)
+    patient = fields.Many2One(
+        "gnuhealth.patient", "Patient", required=True, ondelete="CASCADE",
+        select=True)
+    source = fields.Selection([
+        ("puid", "PUID"),
+        ("alternative", "Alternative ID"),
+        ], "Source", required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+        super().__register__(module_name)
+        if not exist:
+            cls.refresh()
+
+    @classmethod
+    def refresh(cls, parties=None):
+        """Rebuild the identifiers of the patients of the parties, or of
+        all the patients"""
 
         pool = Pool()
-        Patient = pool.get("gnuhealth.orthanc.patient")
+        Party = pool.get("party.party")
+        Patient = pool.get("gnuhealth.patient")
+        AlternativeID = pool.get("gnuhealth.person_alternative_identification")
+        table = cls.__table__()
+        party = Party.__table__()
+        patient = Patient.__table__()
+        alternative = AlternativeID.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if parties is None:
+            slices = [None]
+        else:
+            slices = grouped_slice([p.id for p in parties])
+
+        for sub_ids in slices:
+            if sub_ids is None:
+                party_where = patient_where = Literal(True)
+                cursor.execute(*table.delete())
+            else:
+                sub_ids = list(sub_ids)
+                party_where = reduce_ids(party.id, sub_ids)
+                patient_where = reduce_ids(patient.name, sub_ids)
+                cursor.execute(*table.delete(
+                        where=table.patient.in_(patient.select(
+                                patient.id, where=patient_where))))
+
+            puids = patient.join(party,
+                condition=party.id == patient.name
+                ).select(
+                party.ref.as_("code"), patient.id.as_("patient"),
+                Literal("puid").as_("source"),
+                where=party_where & (party.ref != Null))
+            alternatives = patient.join(alternative,
+                condition=alternative.name == patient.name
+                ).select(
+                alternative.code.as_("code"), patient.id.as_("patient"),
+                Literal("alternative").as_("source"),
+                where=patient_where & (alternative.code != Null))
+            identifiers = Union(puids, alternatives, all_=True)
+            cursor.execute(*table.insert(
+                    [table.code, table.patient, table.source,
+                        table.create_uid, table.create_date],
+                    identifiers.select(
+                        identifiers.code, identifiers.patient,
+                        identifiers.source,
+                        Literal(Transaction().user), CurrentTimestamp())))
+
+    @classmethod
+    def resolve(cls, codes):
+        """Return a dictionary of the patient matching each code.
+        The PUID takes precedence over the alternative IDs"""
+
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        priority = Case((table.source == "puid", 0), else_=1)
+        result = {}
+        for sub_codes in grouped_slice(list({c for c in codes if c})):
+            cursor.execute(*table.select(
+                    table.code, table.patient,
+                    where=table.code.in_(list(sub_codes)),
+                    order_by=[priority.desc, table.id.desc]))
+            # The last row of each code has the highest priority
+            result.update(cursor)
+        return result
 
-        entries = cls.get_info_from_dicom(studies)
-        for entry in entries:
-            try:
-                patient = Patient.search(
-                    [("uuid", "=",
-                      entry["parent_patient"]), ("server", "=", server)],
-                    limit=1,
-                )[0]
-            except:
-                patient = None
-                logger.warning(
-                    "No parent patient found for study {}".format(entry["ID"])
-                )
-            entry.pop("parent_patient")  # remove non-model entry
-            entry["server"] = server
-            entry["patient"] = patient
-        cls.create(entries)
+
+class Party(metaclass=PoolMeta):
+    __name__ = "party.party"
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Identifier = Pool().get("gnuhealth.orthanc.identifier")
+        parties = []
+        for records, values in zip(args[::2], args[1::2]):
+            if "ref" in values:
+                parties.extend(records)
+        if parties:
+            Identifier.refresh(parties)
+
+
+class AlternativePersonID(metaclass=PoolMeta):
+    __name__ = "gnuhealth.person_alternative_identification"
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Identifier = Pool().get("gnuhealth.orthanc.identifier")
+        Identifier.refresh([r.name for r in records if r.name])
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        parties = [r.name for r in sum(args[::2], []) if r.name]
+        super().write(*args)
+        Identifier = Pool().get("gnuhealth.orthanc.identifier")
+        parties += [r.name for r in sum(args[::2], []) if r.name]
+        Identifier.refresh(parties)
+
+    @classmethod
+    def delete(cls, records):
+        parties = [r.name for r in records if r.name]
+        super().delete(records)
+        Identifier = Pool().get("gnuhealth.orthanc.identifier")
+        Identifier.refresh(parties)
 
 
 class TestResult(ModelSQL, ModelView):
@@ -477,3 +943,21 @@ class Patient(ModelSQL, ModelView):
     orthanc_patients = fields.One2Many(
         "gnuhealth.orthanc.patient", "patient", "Orthanc patients"
     )
+
+    @classmethod
+    def create(cls, vlist):
+        patients = super().create(vlist)
+        Identifier = Pool().get("gnuhealth.orthanc.identifier")
+        Identifier.refresh([p.name for p in patients])
+        return patients
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Identifier = Pool().get("gnuhealth.orthanc.identifier")
+        parties = []
+        for records, values in zip(args[::2], args[1::2]):
+            if "name" in values:
+                parties.extend(p.name for p in records)
+        if parties:
+            Identifier.refresh(parties)
@@ -66,6 +66,7 @@ setup(
     package_dir={'trytond.modules.health_orthanc': '.'},
     packages=[
         'trytond.modules.health_orthanc',
+        'trytond.modules.health_orthanc.tests',
         'trytond.modules.health_orthanc.wizard',
         ],
 
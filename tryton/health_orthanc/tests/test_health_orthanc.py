@@ -0,0 +1,246 @@
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import unittest
+from http.server import BaseHTTPRequestHandler
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import trytond.tests.test_tryton
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from trytond.modules.health.tests.stub_server import start_stub_server
+from trytond.modules.health_orthanc import health_orthanc
+from trytond.modules.health_orthanc.health_orthanc import (
+    fetch_resources, get_changes, get_last_change, get_resources,
+    orthanc_session)
+
+
+def fake_orthanc(n_patients):
+    # Changes feed of n patients, each with a study
+    changes = []
+    patients = {}
+    studies = {}
+    for n in range(n_patients):
+        patient, study = 'patient%s' % n, 'study%s' % n
+        patients[patient] = {
+            'ID': patient, 'MainDicomTags': {'PatientID': 'P%s' % n}}
+        studies[study] = {
+            'ID': study, 'ParentPatient': patient, 'MainDicomTags': {}}
+        changes.append({'ChangeType': 'NewPatient', 'ID': patient})
+        changes.append({'ChangeType': 'NewStudy', 'ID': study})
+    for seq, change in enumerate(changes, 1):
+        change['Seq'] = seq
+    return {
+        'changes': changes, 'patients': patients, 'studies': studies,
+        'fail': set()}
+
+
+class FakeOrthancHandler(BaseHTTPRequestHandler):
+    # Minimal Orthanc REST API: changes feed, patients and studies
+
+    def reply(self, status, data=None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        orthanc = self.server.orthanc
+        query = parse_qs(url.query, keep_blank_values=True)
+        if url.path == '/changes' and 'last' in query:
+            self.reply(200, {
+                    'Changes': orthanc['changes'][-1:],
+                    'Done': True,
+                    'Last': orthanc['changes'][-1]['Seq'],
+                    })
+            return
+        if url.path == '/changes':
+            since = int(query['since'][0])
+            limit = int(query['limit'][0])
+            changes = [c for c in orthanc['changes'] if c['Seq'] > since]
+            page = changes[:limit]
+            self.reply(200, {
+                    'Changes': page,
+                    'Done': len(page) == len(changes),
+                    'Last': page[-1]['Seq'] if page else since,
+                    })
+            return
+        kind, _, uuid = url.path.strip('/').partition('/')
+        if not uuid and 'expand' in query:
+            since = int(query['since'][0])
+            limit = int(query['limit'][0])
+            resources = list(orthanc[kind].values())
+            self.reply(200, resources[since:since + limit])
+            return
+        if uuid in orthanc['fail']:
+            self.reply(500)
+        elif uuid in orthanc.get(kind, {}):
+            self.server.fetched.append(uuid)
+            self.reply(200, orthanc[kind][uuid])
+        else:
+            self.reply(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class HealthOrthancTestCase(ModuleTestCase):
+    '''
+    Test Health Orthanc module.
+    '''
+    module = 'health_orthanc'
+
+    @with_transaction()
+    def test_sync_server_resume(self):
+        'Test the sync commits each page and resumes from the checkpoint'
+        pool = Pool()
+        Server = pool.get('gnuhealth.orthanc.config')
+        Patient = pool.get('gnuhealth.orthanc.patient')
+        Study = pool.get('gnuhealth.orthanc.study')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        def commit():
+            # A savepoint stands for the commit of each page, so the test
+            # leaves nothing in the database
+            cursor.execute('SAVEPOINT orthanc_page')
+
+        def rollback():
+            cursor.execute('ROLLBACK TO SAVEPOINT orthanc_page')
+            transaction.cache.clear()
+
+        orthanc, domain = start_stub_server(
+            self, FakeOrthancHandler, orthanc=fake_orthanc(10), fetched=[])
+        server, = Server.create([{
+                    'label': 'fake',
+                    'domain': domain,
+                    'user': 'orthanc',
+                    'password': 'orthanc',
+                    'validated': True,
+                    }])
+        commit()
+        session = orthanc_session('orthanc', 'orthanc', 4)
+        self.addCleanup(session.close)
+
+        # The second page (changes 7 to 12) can not be fetched
+        orthanc.orthanc['fail'].add('study4')
+        with patch.object(health_orthanc, 'PAGE_SIZE', 6), \
+                patch.object(transaction, 'commit', commit):
+            with self.assertRaises(requests.HTTPError):
+                Server.sync_server(server, session)
+        rollback()
+
+        # The first page survives the rollback with its checkpoint
+        server = Server(server.id)
+        self.assertEqual(server.last, 6)
+        self.assertEqual(
+            sorted(p.uuid for p in Patient.search([
+                        ('server', '=', server.id)])),
+            ['patient0', 'patient1', 'patient2'])
+        self.assertEqual(
+            Study.search([('server', '=', server.id)], count=True), 3)
+
+        orthanc.orthanc['fail'].clear()
+        del orthanc.fetched[:]
+        with patch.object(health_orthanc, 'PAGE_SIZE', 6), \
+                patch.object(transaction, 'commit', commit):
+            stats = Server.sync_server(server, session)
+
+        self.assertTrue(stats['done'])
+        self.assertEqual(stats['changes'], 14)
+        server = Server(server.id)
+        self.assertEqual(server.last, 20)
+        patients = Patient.search([('server', '=', server.id)])
+        self.assertEqual(len(patients), 10)
+        studies = Study.search([('server', '=', server.id)])
+        self.assertEqual(len(studies), 10)
+        self.assertTrue(all(
+                s.patient.uuid == s.uuid.replace('study', 'patient')
+                for s in studies))
+        # Only the resources after the checkpoint are fetched again
+        self.assertEqual(
+            sorted(orthanc.fetched),
+            sorted(['patient%s' % n for n in range(3, 10)]
+                + ['study%s' % n for n in range(3, 10)]))
+
+
+class OrthancSyncTestCase(unittest.TestCase):
+    '''
+    Test the Orthanc sync requests against a fake Orthanc server
+    '''
+
+    def setUp(self):
+        self.server, self.domain = start_stub_server(
+            self, FakeOrthancHandler, orthanc=fake_orthanc(10), fetched=[])
+        self.session = orthanc_session('orthanc', 'orthanc', 4)
+        self.addCleanup(self.session.close)
+
+    def test_changes_pages(self):
+        since, pages, seen = 0, 0, []
+        while True:
+            changes = get_changes(self.session, self.domain, since, 6)
+            seen.extend(c['ID'] for c in changes['Changes'])
+            since = changes['Last']
+            pages += 1
+            if changes['Done']:
+                break
+        self.assertEqual(pages, 4)
+        self.assertEqual(since, 20)
+        self.assertEqual(len(seen), 20)
+
+        # Resuming from the checkpoint returns only the newer changes
+        changes = get_changes(self.session, self.domain, 18, 6)
+        self.assertEqual(
+            [c['ID'] for c in changes['Changes']], ['patient9', 'study9'])
+
+    def test_last_change(self):
+        self.assertEqual(get_last_change(self.session, self.domain), 20)
+
+    def test_resources_pages(self):
+        since, pages, seen = 0, 0, []
+        while True:
+            patients = get_resources(
+                self.session, self.domain, 'patients', since, 4)
+            seen.extend(p['ID'] for p in patients)
+            since += len(patients)
+            pages += 1
+            if len(patients) < 4:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, ['patient%s' % n for n in range(10)])
+
+    def test_fetch_resources(self):
+        uuids = ['study%s' % n for n in range(10)] + ['deleted']
+        studies = fetch_resources(
+            self.session, self.domain, 'studies', uuids, workers=4)
+        self.assertEqual(
+            sorted(s['ID'] for s in studies),
+            sorted('study%s' % n for n in range(10)))
+        self.assertEqual(len(self.server.fetched), 10)
+
+    def test_fetch_resources_error(self):
+        self.server.orthanc['fail'].add('patient3')
+        with self.assertRaises(requests.HTTPError):
+            fetch_resources(
+                self.session, self.domain, 'patients',
+                ['patient%s' % n for n in range(10)], workers=4)
+
+
+def suite():
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        HealthOrthancTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        OrthancSyncTestCase))
+    return suite
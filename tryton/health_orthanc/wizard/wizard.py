@@ -4,15 +4,14 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from datetime import datetime
 from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond.pool import Pool
-from requests.auth import HTTPBasicAuth as auth
 from requests.exceptions import HTTPError
-from beren import Orthanc as RestClient
 import logging
 
+from ..health_orthanc import get_last_change, orthanc_session
+
 logger = logging.getLogger(__name__)
 
 __all__ = ["AddOrthancInit", "FullSyncOrthanc", "AddOrthancResult"]
@@ -67,21 +66,18 @@ class FullSyncOrthanc(Wizard):
     )
 
     def transition_first_sync(self):
-        """ Import and create all current patients
-            and studies on remote DICOM server
+        """ Add the server and schedule the import of all current patients
+            and studies on remote DICOM server. The import runs in
+            background with the sync of the servers.
         """
 
         pool = Pool()
-        Patient = pool.get("gnuhealth.orthanc.patient")
-        Study = pool.get("gnuhealth.orthanc.study")
         Config = pool.get("gnuhealth.orthanc.config")
 
-        orthanc = RestClient(
-            self.start.domain, auth=auth(self.start.user, self.start.password)
-        )
+        session = orthanc_session(self.start.user, self.start.password)
         try:
-            patients = orthanc.get_patients(expand=True)
-            studies = orthanc.get_studies(expand=True)
+            # Changes after this index are left to the incremental sync
+            last = get_last_change(session, self.start.domain)
         except HTTPError as err:
             if err.response.status_code == 401:
                 self.result.result = "Invalid credentials provided"
@@ -98,23 +94,19 @@ class FullSyncOrthanc(Wizard):
                 "domain": self.start.domain,
                 "user": self.start.user,
                 "password": self.start.password,
+                "last": last,
+                "validated": True,
+                "import_state": "patients",
+                "import_offset": 0,
             }
             server, = Config.create([new_server])
-            Patient.create_patients(patients, server)
-            Study.create_studies(studies, server)
-            server.last = orthanc.get_changes(last=True).get("Last")
-            server.sync_time = datetime.now()
-            server.validated = True
-            Config.save([server])
-            self.result.result = "Successfully added and synced <{}>".format(
-                server.label
-            )
-            logger.info(
-                "<{}> sync complete: {} new patients, {} new studies".format(
-                    server.label, len(patients), len(studies)
-                )
-            )
+            self.result.result = (
+                "Successfully added <{}>. The import of its patients and "
+                "studies runs in background, and its progress is shown "
+                "on the server".format(server.label))
+            logger.info("<{}> added, import scheduled".format(server.label))
         finally:
+            session.close()
             return "result"
 
     def default_result(self, fields):
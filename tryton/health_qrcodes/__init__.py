@@ -17,8 +17,10 @@ from .import health_qrcodes
 
 def register():
     Pool.register(
+        health_qrcodes.ImageCache,
         health_qrcodes.Patient,
         health_qrcodes.Appointment,
         health_qrcodes.Newborn,
         health_qrcodes.LabTest,
+        health_qrcodes.QRCodesCron,
         module='health_qrcodes', type_='model')
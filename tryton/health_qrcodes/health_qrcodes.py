@@ -10,27 +10,156 @@
 #                         HEALTH QR_CODES PACKAGE                       #
 #                      health_qrcodes.py: Main module                   #
 #########################################################################
-import qrcode
-import barcode
-import io
-from trytond.model import ModelView, ModelSQL, fields
-
-
-__all__ = ['Patient', 'Appointment', 'Newborn', 'LabTest']
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .images import get_digest, render_images
+
+
+__all__ = ['ImageCache', 'QRCodeMixin', 'Patient', 'Appointment',
+    'Newborn', 'LabTest', 'QRCodesCron']
+
+# Days the images are kept in the cache table
+CACHE_DAYS = config.getint('health_qrcodes', 'cache_days', default=30)
+
+
+class ImageCache(ModelSQL):
+    'QR and Bar Code Image Cache'
+    __name__ = 'gnuhealth.qrcode.image'
+
+    digest = fields.Char('Digest', required=True, select=True,
+        help="Digest of the kind and the payload of the image")
+    kind = fields.Char('Kind', required=True)
+    image = fields.Binary('Image', required=True)
+
+    # Images most recently read, by digest
+    _images = Cache('health_qrcodes.image',
+        size_limit=config.getint(
+            'health_qrcodes', 'cache_size', default=1024),
+        context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(ImageCache, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('digest_uniq', Unique(t, t.digest),
+                'The image digest must be unique'),
+            ]
+
+    @classmethod
+    def get_images(cls, kind, payloads):
+        """ Return the PNG images of the payloads, as a list in the
+            same order. Each image is built only once for a given payload:
+            it is looked up in the memory cache, then in the cache table,
+            and the missing ones are rendered together and stored.
+        """
+        digests = [get_digest(kind, payload) for payload in payloads]
+        images = {}
+
+        missing = []
+        for digest in set(digests):
+            image = cls._images.get(digest)
+            if image is not None:
+                images[digest] = image
+            else:
+                missing.append(digest)
+
+        if missing:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            for sub_digests in grouped_slice(missing):
+                cursor.execute(*table.select(table.digest, table.image,
+                        where=table.digest.in_(list(sub_digests))))
+                for digest, image in cursor:
+                    images[digest] = bytes(image)
+                    cls._images.set(digest, images[digest])
+
+        to_render = {}
+        for digest, payload in zip(digests, payloads):
+            if digest not in images:
+                to_render[digest] = payload
+        if to_render:
+            rendered = dict(zip(to_render,
+                    render_images(kind, to_render.values())))
+            cls.store_images(kind, rendered)
+            for digest, image in rendered.items():
+                cls._images.set(digest, image)
+            images.update(rendered)
+
+        return [images[digest] for digest in digests]
+
+    @classmethod
+    def store_images(cls, kind, images):
+        # The images are mostly built while reading, so they are stored in
+        # their own transaction. Another process storing the same images
+        # at the same time only means they are not stored twice.
+        table = cls.__table__()
+        now = datetime.now()
+        user = Transaction().user
+        try:
+            with Transaction().new_transaction() as transaction:
+                cursor = transaction.connection.cursor()
+                for sub_images in grouped_slice(list(images.items())):
+                    cursor.execute(*table.insert(
+                            [table.digest, table.kind, table.image,
+                                table.create_uid, table.create_date],
+                            [[digest, kind, cls.image.sql_format(image),
+                                    user, now]
+                                for digest, image in sub_images]))
+        except backend.DatabaseIntegrityError:
+            pass
+
+    @classmethod
+    def purge(cls):
+        """ Delete the images stored more than CACHE_DAYS ago.
+            They hold patient data and the payloads they were built from
+            may have changed since, so they are rendered again if needed.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete(
+                where=table.create_date
+                < datetime.now() - timedelta(days=CACHE_DAYS)))
+        # Do not keep the purged images in memory until the restart
+        cls._images.clear()
+
+
+class QRCodeMixin(object):
+    """ Function fields getters of the QR code images.
+        Each model defines get_qr_payload, that returns the text encoded
+        in the QR code of a record
+    """
+    __slots__ = ()
+
+    @classmethod
+    def make_qrcode(cls, records, name):
+        # Render all the QR codes at once, for list views and
+        # the labels of many records
+        ImageCache = Pool().get('gnuhealth.qrcode.image')
+        images = ImageCache.get_images('qr',
+            [record.get_qr_payload() for record in records])
+        return {record.id: bytearray(image)
+            for record, image in zip(records, images)}
 
 
 # Add the QR field and QR image in the patient model
 
-class Patient(ModelSQL, ModelView):
+class Patient(QRCodeMixin, ModelSQL, ModelView):
     'Patient'
     __name__ = 'gnuhealth.patient'
 
     # Add the QR Code to the Patient
     qr = fields.Function(fields.Binary('QR Code'), 'make_qrcode')
 
-    def make_qrcode(self, name):
-        # Create the QR code
-
+    def get_qr_payload(self):
         patient_puid = self.puid or ''
         patient_blood_type = self.blood_type or ''
         patient_rh = self.rh or ''
@@ -40,35 +169,22 @@ class Patient(ModelSQL, ModelView):
         if (self.dob):
             patient_dob = str(self.dob)
 
-        qr_string = f'{patient_puid}\n' \
+        return f'{patient_puid}\n' \
             f'Name: {self.name.rec_name}\n' \
             f'Gender: {patient_gender}\n' \
             f'DoB: {patient_dob}\n' \
             f'Blood Type: {patient_blood_type} {patient_rh}'
 
-        qr_image = qrcode.make(qr_string)
-
-        # Make a PNG image from PIL without the need to create a temp file
-
-        holder = io.BytesIO()
-        qr_image.save(holder)
-        qr_png = holder.getvalue()
-        holder.close()
-
-        return bytearray(qr_png)
-
 
 # Add the QR field and QR image in the appointment model
 
-class Appointment(ModelSQL, ModelView):
+class Appointment(QRCodeMixin, ModelSQL, ModelView):
     __name__ = 'gnuhealth.appointment'
 
     # Add the QR Code to the Appointment
     qr = fields.Function(fields.Binary('QR Code'), 'make_qrcode')
 
-    def make_qrcode(self, name):
-        # Create the QR code
-
+    def get_qr_payload(self):
         appointment_healthprof = ''
         appointment_patient = ''
         patient_puid = ''
@@ -92,35 +208,22 @@ class Appointment(ModelSQL, ModelView):
         if (self.speciality):
             appointment_specialty = str(self.speciality.rec_name) or ''
 
-        qr_string = f'{appointment}\n' \
+        return f'{appointment}\n' \
             f'Name: {appointment_patient}\n' \
             f'PUID: {patient_puid}\n' \
             f'Specialty: {appointment_specialty}\n' \
             f'Health Prof: {appointment_healthprof}\n' \
             f'Date: {appointment_date}'
 
-        qr_image = qrcode.make(qr_string)
-
-        # Make a PNG image from PIL without the need to create a temp file
-
-        holder = io.BytesIO()
-        qr_image.save(holder)
-        qr_png = holder.getvalue()
-        holder.close()
-
-        return bytearray(qr_png)
 
-
-class Newborn(ModelSQL, ModelView):
+class Newborn(QRCodeMixin, ModelSQL, ModelView):
     'NewBorn'
     __name__ = 'gnuhealth.newborn'
 
     # Add the QR Code to the Newborn
     qr = fields.Function(fields.Binary('QR Code'), 'make_qrcode')
 
-    def make_qrcode(self, name):
-        # Create the QR code
-
+    def get_qr_payload(self):
         if self.mother:
             if self.mother.name.lastname:
                 newborn_mother_lastname = self.mother.name.lastname + ', '
@@ -142,34 +245,21 @@ class Newborn(ModelSQL, ModelView):
 
         newborn_birth_date = self.birth_date or ''
 
-        qr_string = f'{newborn_name}\n' \
+        return f'{newborn_name}\n' \
             f'Mother: {newborn_mother_lastname} {newborn_mother_name}\n' \
             f'Mother\'s PUID: {newborn_mother_id}\n' \
             f'Sex: {newborn_sex}\n' \
             f'DoB: {str(newborn_birth_date)}'
 
-        qr_image = qrcode.make(qr_string)
-
-        # Make a PNG image from PIL without the need to create a temp file
 
-        holder = io.BytesIO()
-        qr_image.save(holder)
-        qr_png = holder.getvalue()
-        holder.close()
-
-        return bytearray(qr_png)
-
-
-class LabTest(ModelSQL, ModelView):
+class LabTest(QRCodeMixin, ModelSQL, ModelView):
     __name__ = 'gnuhealth.lab'
 
     # Add the QR Code to the Lab Test
     qr = fields.Function(fields.Binary('QR Code'), 'make_qrcode')
     bar = fields.Function(fields.Binary('Bar Code39'), 'make_barcode')
 
-    def make_qrcode(self, name):
-        # Create the QR code
-
+    def get_qr_payload(self):
         labtest_id = self.name or ''
         labtest_type = self.test or ''
 
@@ -178,37 +268,28 @@ class LabTest(ModelSQL, ModelView):
 
         requestor_name = self.requestor.rec_name or ''
 
-        qr_string = f'{labtest_id}\n' \
+        return f'{labtest_id}\n' \
             f'Test: {labtest_type.rec_name}\n' \
             f'Patient ID: {patient_puid}\n' \
             f'Patient: {patient_name}\n' \
             f'Requestor: {requestor_name}'
 
-        qr_image = qrcode.make(qr_string)
-
-        # Make a PNG image from PIL without the need to create a temp file
-
-        holder = io.BytesIO()
-        qr_image.save(holder)
-        qr_png = holder.getvalue()
-        holder.close()
-
-        return bytearray(qr_png)
-
-    def make_barcode(self, name):
-        # Create the Code39 bar code to encode the TEST ID
-
-        labtest_id = self.name or ''
-
-        CODE39 = barcode.get_barcode_class('code39')
-
-        code39 = CODE39(labtest_id, add_checksum=False)
-
-        # Make a PNG image from PIL without the need to create a temp file
-
-        holder = io.BytesIO()
-        code39.write(holder)
-        code39_png = holder.getvalue()
-        holder.close()
-
-        return bytearray(code39_png)
+    @classmethod
+    def make_barcode(cls, tests, name):
+        # Create the Code39 bar codes to encode the TEST IDs
+        ImageCache = Pool().get('gnuhealth.qrcode.image')
+        images = ImageCache.get_images('code39',
+            [test.name or '' for test in tests])
+        return {test.id: bytearray(image)
+            for test, image in zip(tests, images)}
+
+
+class QRCodesCron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(QRCodesCron, cls).__setup__()
+        cls.method.selection.extend([
+            ('gnuhealth.qrcode.image|purge', "Purge QR and Bar Code Images"),
+            ])
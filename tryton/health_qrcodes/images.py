@@ -0,0 +1,89 @@
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                         HEALTH QR_CODES PACKAGE                       #
+#                  images.py: rendering of the QR and bar codes         #
+#########################################################################
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import qrcode
+import barcode
+
+from trytond.config import config
+
+from trytond.modules.health.workers import WorkerPool
+
+__all__ = ['render_image', 'render_images', 'get_digest']
+
+logger = logging.getLogger(__name__)
+
+RENDER_WORKERS = config.getint(
+    'health_qrcodes', 'render_workers', default=min(4, os.cpu_count() or 1))
+# Minimum number of images to render them in the pool of processes
+POOL_THRESHOLD = config.getint(
+    'health_qrcodes', 'pool_threshold', default=16)
+
+_workers = WorkerPool(RENDER_WORKERS, preload=['qrcode', 'barcode'])
+
+
+def get_digest(kind, payload):
+    """ Return the digest that identifies the image of the payload """
+    return hashlib.sha256(
+        ('%s\n%s' % (kind, payload)).encode('utf-8')).hexdigest()
+
+
+def render_image(kind, payload):
+    """ Return the PNG image of the payload
+
+        kind: 'qr' for QR codes or 'code39' for Code39 bar codes
+    """
+    holder = io.BytesIO()
+    if kind == 'qr':
+        qr_image = qrcode.make(payload)
+        qr_image.save(holder)
+    else:
+        CODE39 = barcode.get_barcode_class('code39')
+        code39 = CODE39(payload, add_checksum=False)
+        code39.write(holder)
+    image = holder.getvalue()
+    holder.close()
+    return image
+
+
+def _render_chunk(kind, payloads):
+    return [render_image(kind, payload) for payload in payloads]
+
+
+def render_images(kind, payloads):
+    """ Render the images of the payloads in one pass.
+        Large batches (eg, labels of many lab tests) are split among a
+        pool of processes.
+
+        Returns the list of PNG images, in the order of the payloads
+    """
+    payloads = list(payloads)
+    executor = _workers.get()
+    if executor and len(payloads) >= POOL_THRESHOLD:
+        size = -(-len(payloads) // RENDER_WORKERS)
+        chunks = [payloads[i:i + size]
+            for i in range(0, len(payloads), size)]
+        try:
+            images = []
+            for chunk_images in executor.map(
+                    _render_chunk, [kind] * len(chunks), chunks):
+                images.extend(chunk_images)
+            return images
+        except BrokenProcessPool:
+            logger.warning("Render workers unavailable, rendering locally")
+            _workers.reset()
+    return _render_chunk(kind, payloads)
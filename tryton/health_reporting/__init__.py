@@ -13,12 +13,19 @@
 #########################################################################
 
 from trytond.pool import Pool
+from . import health_reporting
 from . import wizard
 from . import report
 
 
 def register():
     Pool.register(
+        health_reporting.EpidemiologyCube,
+        health_reporting.EpidemiologyCubeState,
+        health_reporting.EpidemiologyCubeStaleDay,
+        health_reporting.PatientEvaluation,
+        health_reporting.PatientDiseaseInfo,
+        health_reporting.ReportingCron,
         wizard.wizard_top_diseases.TopDiseases,
         wizard.wizard_top_diseases.OpenTopDiseasesStart,
         wizard.wizard_evaluations.OpenEvaluationsStart,
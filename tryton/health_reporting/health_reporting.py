@@ -0,0 +1,315 @@
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#########################################################################
+#   Hospital Management Information System (HMIS) component of the      #
+#                       GNU Health project                              #
+#                   https://www.gnuhealth.org                           #
+#########################################################################
+#                         HEALTH REPORTING package                      #
+#          health_reporting.py: epidemiology cube (pre-aggregated)      #
+#########################################################################
+
+from datetime import datetime, timedelta
+from sql import Literal, Null
+from sql.aggregate import Count
+from sql.conditionals import Coalesce, Least
+from sql.functions import (
+    Age, AtTimeZone, CurrentTimestamp, Extract, Floor)
+from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from trytond.modules.health.core import get_institution_timezone
+
+__all__ = ['EpidemiologyCube', 'EpidemiologyCubeState',
+    'EpidemiologyCubeStaleDay', 'PatientEvaluation', 'PatientDiseaseInfo',
+    'ReportingCron']
+
+# Rows written by transactions that were still running when the last
+# refresh started are caught by looking back this margin
+REFRESH_MARGIN = timedelta(minutes=10)
+
+# Last age band of 5 years (105 years and over)
+MAX_AGE_BAND = 21
+
+
+class EpidemiologyCube(ModelSQL, ModelView):
+    'Epidemiology Cube'
+    __name__ = 'gnuhealth.epidemiology.cube'
+
+    source = fields.Selection([
+        ('evaluation', 'Evaluation'),
+        ('condition', 'Condition'),
+        ], 'Source', readonly=True, select=True,
+        help="Evaluations are counted by their main diagnosis and"
+             " conditions by their pathology")
+    day = fields.Date(
+        'Day', readonly=True, select=True,
+        help="Day of the evaluation or diagnosis, in the institution"
+             " timezone")
+    pathology = fields.Many2One(
+        'gnuhealth.pathology', 'Health Condition', readonly=True,
+        select=True)
+    operational_sector = fields.Many2One(
+        'gnuhealth.operational_sector', 'Operational Sector', readonly=True)
+    gender = fields.Char('Gender', readonly=True)
+    age_band = fields.Integer(
+        'Age band', readonly=True,
+        help="Age group of 5 years of the person at the day"
+             " (0: 0-4, 1: 5-9 ... 21: 105 and over)")
+    ethnic_group = fields.Many2One(
+        'gnuhealth.ethnicity', 'Ethnicity', readonly=True)
+    cases = fields.Integer('Cases', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EpidemiologyCube, cls).__setup__()
+        cls._order.insert(0, ('day', 'DESC'))
+
+    @classmethod
+    def covers(cls, end_date):
+        """ Return True if the cube holds the facts up to end_date """
+        State = Pool().get('gnuhealth.epidemiology.cube.state')
+        watermark = State(1).watermark
+        return bool(end_date and watermark
+                    and end_date < watermark.date())
+
+    @classmethod
+    def fact_day(cls, source, fact=None):
+        """ Return the table of the facts of the source and the expression
+            of their day in the institution timezone.
+            The raw reporting queries use it to apply the same day
+            boundaries as the cube """
+        pool = Pool()
+        if source == 'evaluation':
+            Evaluation = pool.get('gnuhealth.patient.evaluation')
+            if fact is None:
+                fact = Evaluation.__table__()
+            # evaluation_start is stored in UTC
+            day = AtTimeZone(
+                AtTimeZone(fact.evaluation_start, 'UTC'),
+                get_institution_timezone()).cast('DATE')
+        else:
+            Condition = pool.get('gnuhealth.patient.disease')
+            if fact is None:
+                fact = Condition.__table__()
+            day = fact.diagnosed_date
+        return fact, day
+
+    @classmethod
+    def source_query(cls, source, days=None):
+        """ Return the query that aggregates the facts of the source
+            (optionally restricted to some days), and the function that
+            builds the query of the days changed since a given time """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Patient = pool.get('gnuhealth.patient')
+        DU = pool.get('gnuhealth.du')
+        party = Party.__table__()
+        patient = Patient.__table__()
+        du = DU.__table__()
+
+        fact, day = cls.fact_day(source)
+        if source == 'evaluation':
+            pathology = fact.diagnosis
+        else:
+            pathology = fact.pathology
+
+        age_band = Least(
+            Floor(Extract('YEAR', Age(day, party.dob)) / 5),
+            MAX_AGE_BAND)
+
+        join = fact.join(patient, condition=(patient.id == fact.patient)
+            if source == 'evaluation' else (patient.id == fact.name)
+            ).join(party, condition=(party.id == patient.name)
+            ).join(du, 'LEFT', condition=(du.id == party.du))
+
+        query = join.select(
+            day.as_('day'),
+            pathology.as_('pathology'),
+            du.operational_sector.as_('operational_sector'),
+            party.gender.as_('gender'),
+            age_band.as_('age_band'),
+            party.ethnic_group.as_('ethnic_group'),
+            Count(Literal(1)).as_('cases'),
+            where=(day != Null)
+            & (day.in_(days) if days is not None else Literal(True)),
+            group_by=[day, pathology, du.operational_sector,
+                party.gender, age_band, party.ethnic_group])
+
+        # Facts touched since a given time, including the changes in the
+        # person and domiciliary unit dimensions
+        def changed(since):
+            return join.select(
+                day,
+                where=(day != Null)
+                & ((Coalesce(fact.write_date, fact.create_date) > since)
+                    | (Coalesce(party.write_date, party.create_date) > since)
+                    | (Coalesce(du.write_date, du.create_date) > since)),
+                group_by=[day])
+
+        return query, changed
+
+    @classmethod
+    def insert_facts(cls, source, days=None):
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        query, _ = cls.source_query(source, days)
+        facts = query.select(
+            Literal(source), query.day, query.pathology,
+            query.operational_sector, query.gender, query.age_band,
+            query.ethnic_group, query.cases,
+            Literal(Transaction().user), CurrentTimestamp())
+        cursor.execute(*table.insert(
+                [table.source, table.day, table.pathology,
+                    table.operational_sector, table.gender, table.age_band,
+                    table.ethnic_group, table.cases,
+                    table.create_uid, table.create_date],
+                facts))
+
+    @classmethod
+    def refresh(cls):
+        """ Refresh the cube from the write_date watermark.
+            Only the days with new or modified facts, and the days that
+            facts have left (deleted or moved), are re-aggregated.
+            The first run (or after a rebuild) aggregates the full history.
+        """
+        pool = Pool()
+        State = pool.get('gnuhealth.epidemiology.cube.state')
+        StaleDay = pool.get('gnuhealth.epidemiology.cube.stale_day')
+        table = cls.__table__()
+        stale = StaleDay.__table__()
+        cursor = Transaction().connection.cursor()
+
+        state = State(1)
+        watermark = datetime.utcnow()
+
+        for source in ('evaluation', 'condition'):
+            # Only the stale days read here are removed, those recorded
+            # by transactions committed meanwhile wait for the next refresh
+            cursor.execute(*stale.select(
+                    stale.id, stale.day,
+                    where=stale.source == source))
+            stale_ids, stale_days = [], set()
+            for stale_id, day in cursor:
+                stale_ids.append(stale_id)
+                stale_days.add(day)
+            for sub_ids in grouped_slice(stale_ids):
+                cursor.execute(*stale.delete(
+                        where=reduce_ids(stale.id, sub_ids)))
+
+            if not state.watermark:
+                cursor.execute(*table.delete(where=table.source == source))
+                cls.insert_facts(source)
+                continue
+
+            _, changed = cls.source_query(source)
+            cursor.execute(*changed(state.watermark - REFRESH_MARGIN))
+            days = list(stale_days.union(row[0] for row in cursor))
+
+            for sub_days in grouped_slice(days):
+                sub_days = list(sub_days)
+                cursor.execute(*table.delete(
+                        where=(table.source == source)
+                        & table.day.in_(sub_days)))
+                cls.insert_facts(source, sub_days)
+
+        State.write([state], {'watermark': watermark})
+
+    @classmethod
+    def rebuild(cls):
+        """ Aggregate again the full history.
+            Needed after a change of the institution timezone or
+            after facts have been modified directly in the database.
+        """
+        State = Pool().get('gnuhealth.epidemiology.cube.state')
+        State.write([State(1)], {'watermark': None})
+        cls.refresh()
+
+
+class EpidemiologyCubeState(ModelSingleton, ModelSQL):
+    'Epidemiology Cube State'
+    __name__ = 'gnuhealth.epidemiology.cube.state'
+
+    watermark = fields.DateTime(
+        'Watermark', readonly=True,
+        help="Start time of the last refresh of the cube")
+
+
+class EpidemiologyCubeStaleDay(ModelSQL):
+    'Epidemiology Cube Stale Day'
+    __name__ = 'gnuhealth.epidemiology.cube.stale_day'
+
+    source = fields.Selection([
+        ('evaluation', 'Evaluation'),
+        ('condition', 'Condition'),
+        ], 'Source', readonly=True)
+    day = fields.Date('Day', readonly=True)
+
+    @classmethod
+    def record(cls, source, ids):
+        """ Record the current days of the facts before they are
+            deleted or moved to another day """
+        Cube = Pool().get('gnuhealth.epidemiology.cube')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        fact, day = Cube.fact_day(source)
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.insert(
+                    [table.source, table.day,
+                        table.create_uid, table.create_date],
+                    fact.select(
+                        Literal(source), day,
+                        Literal(Transaction().user), CurrentTimestamp(),
+                        where=reduce_ids(fact.id, sub_ids) & (day != Null),
+                        distinct=True)))
+
+
+class EpidemiologyFactMixin(object):
+    # Source of the cube and field that gives the day of the fact
+    _cube_source = None
+    _cube_day_field = None
+
+    @classmethod
+    def write(cls, *args):
+        StaleDay = Pool().get('gnuhealth.epidemiology.cube.stale_day')
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if cls._cube_day_field in values:
+                StaleDay.record(cls._cube_source, [r.id for r in records])
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        StaleDay = Pool().get('gnuhealth.epidemiology.cube.stale_day')
+        StaleDay.record(cls._cube_source, [r.id for r in records])
+        super().delete(records)
+
+
+class PatientEvaluation(EpidemiologyFactMixin, metaclass=PoolMeta):
+    __name__ = 'gnuhealth.patient.evaluation'
+    _cube_source = 'evaluation'
+    _cube_day_field = 'evaluation_start'
+
+
+class PatientDiseaseInfo(EpidemiologyFactMixin, metaclass=PoolMeta):
+    __name__ = 'gnuhealth.patient.disease'
+    _cube_source = 'condition'
+    _cube_day_field = 'diagnosed_date'
+
+
+class ReportingCron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(ReportingCron, cls).__setup__()
+        cls.method.selection.extend([
+            ('gnuhealth.epidemiology.cube|refresh',
+                "Refresh Epidemiology Cube"),
+            ])
@@ -5,20 +5,20 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sql.aggregate import Count
-from sql.functions import DateTrunc
-from datetime import date, datetime
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import AtTimeZone, DateTrunc
+from datetime import datetime
 from trytond.report import Report
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from dateutil.relativedelta import relativedelta
 
-from matplotlib import pyplot as plt
-from matplotlib.ticker import MaxNLocator
+from trytond.modules.health.core import (
+    convert_date_timezone, get_institution_timezone, get_population_pyramid)
 
-from trytond.modules.health.core import convert_date_timezone
-
-import io
+from .plots import render_figures
 
 __all__ = ['InstitutionEpidemicsReport']
 
@@ -121,28 +121,61 @@ class InstitutionEpidemicsReport(Report):
         return(res)
 
     @classmethod
-    def get_epi_by_day(cls, start_date, end_date, dx):
-        """ Return number of confirmed cases """
-
-        Condition = Pool().get('gnuhealth.patient.disease')
-
-        current_day = start_date
+    def get_day_series(cls, start_date, end_date, daily_values, default):
+        """ Return the list of days of the period, filling in the default
+            values on those days without data """
         aggr = []
+        current_day = start_date
         while current_day <= end_date:
+            daily_data = {'date': current_day}
+            daily_data.update(daily_values.get(current_day, default))
+            aggr.append(daily_data)
             current_day = current_day + relativedelta(days=1)
+        return aggr
 
-            clause = [
-                ('diagnosed_date', '=', current_day),
-                ]
+    @classmethod
+    def get_epi_by_day(cls, start_date, end_date, dx):
+        """ Return number of confirmed cases by day """
 
+        pool = Pool()
+        Condition = pool.get('gnuhealth.patient.disease')
+        Cube = pool.get('gnuhealth.epidemiology.cube')
+        cursor = Transaction().connection.cursor()
+
+        if Cube.covers(end_date):
+            # Read the cases from the pre-aggregated epidemiology cube
+            cube = Cube.__table__()
+            where = ((cube.source == 'condition')
+                     & (cube.day >= start_date) & (cube.day <= end_date))
             if dx:
-                clause.append(('pathology', '=', dx))
+                where &= (cube.pathology == dx)
+            cursor.execute(*cube.select(
+                    cube.day, Sum(cube.cases),
+                    where=where,
+                    group_by=[cube.day]))
+            cases = {day: {'cases': int(count)} for day, count in cursor}
+            return cls.get_day_series(
+                start_date, end_date, cases, {'cases': 0})
+
+        table = Condition.__table__()
+        day = DateTrunc('day', table.diagnosed_date)
+        where = ((table.diagnosed_date >= start_date)
+                 & (table.diagnosed_date <= end_date))
+        if dx:
+            where &= (table.pathology == dx)
 
-            res = Condition.search(clause)
-            cases_day = len(res)
-            daily_data = {'date': current_day, 'cases': cases_day}
-            aggr.append(daily_data)
-        return(aggr)
+        cursor.execute(*table.select(
+                day, Count(Literal(1)),
+                where=where,
+                group_by=[day]))
+
+        cases = {}
+        for cases_day, count in cursor:
+            if isinstance(cases_day, datetime):
+                cases_day = cases_day.date()
+            cases[cases_day] = {'cases': count}
+
+        return cls.get_day_series(start_date, end_date, cases, {'cases': 0})
 
     # Death Certificates by day
     @classmethod
@@ -151,50 +184,66 @@ class InstitutionEpidemicsReport(Report):
             Includes both the ultimate case as well as those
             certificates that have the condition as a leading cause
         """
+        pool = Pool()
+        DeathCert = pool.get('gnuhealth.death_certificate')
+        UnderlyingCondition = pool.get('gnuhealth.death_underlying_condition')
+        cert = DeathCert.__table__()
+        underlying = UnderlyingCondition.__table__()
+        cursor = Transaction().connection.cursor()
 
-        DeathCert = Pool().get('gnuhealth.death_certificate')
-
-        current_day = start_date
-        aggr = []
-        while current_day <= end_date:
-            cur_day_time = datetime.combine((current_day), datetime.min.time())
-
-            utc_from = convert_date_timezone(cur_day_time, 'utc')
-            utc_to = convert_date_timezone(cur_day_time +
-                                           relativedelta(days=1), 'utc')
-
-            clause = [
-                ('dod', '>=', utc_from),
-                ('dod', '<', utc_to)
-                ]
-
-            res = DeathCert.search(clause)
-
-            # Reset the cases for each day
-            as_immediate_cause = 0
-            as_underlying_condition = 0
-
-            # Get the immediate cause of death and the underlying conditions
-            # for each certificate on each day.
-
-            for cert in res:
-                if (cert.cod.id == dx):
-                    as_immediate_cause = as_immediate_cause + 1
-                for underlying_condition in cert.underlying_conditions:
-                    if (underlying_condition.condition.id == dx):
-                        as_underlying_condition = as_underlying_condition + 1
-
-            daily_data = {'date': current_day,
-                          'certs_day_ic': as_immediate_cause,
-                          'certs_day_uc': as_underlying_condition}
-            aggr.append(daily_data)
-            current_day = current_day + relativedelta(days=1)
+        # The date of death is stored in UTC. Group the certificates
+        # by the day of death in the institution timezone
+        utc_from = convert_date_timezone(
+            datetime.combine(start_date, datetime.min.time()), 'utc')
+        utc_to = convert_date_timezone(
+            datetime.combine(end_date + relativedelta(days=1),
+                             datetime.min.time()), 'utc')
+        timezone = get_institution_timezone()
+        day = DateTrunc('day',
+                        AtTimeZone(AtTimeZone(cert.dod, 'UTC'), timezone))
+
+        # Number of times the condition is an underlying condition
+        # of each certificate
+        underlying_count = underlying.select(
+            underlying.death_certificate,
+            Count(Literal(1)).as_('conditions'),
+            where=(underlying.condition == dx),
+            group_by=[underlying.death_certificate])
+
+        query = cert.join(underlying_count, 'LEFT',
+                          condition=(underlying_count.death_certificate
+                                     == cert.id)
+                          ).select(
+            day,
+            Sum(Case((cert.cod == dx, 1), else_=0)),
+            Sum(Coalesce(underlying_count.conditions, 0)),
+            where=((cert.dod >= utc_from.replace(tzinfo=None))
+                   & (cert.dod < utc_to.replace(tzinfo=None))
+                   & ((cert.cod == dx)
+                      | (underlying_count.conditions != Null))),
+            group_by=[day])
+        cursor.execute(*query)
+
+        deaths = {}
+        for death_day, as_immediate_cause, as_underlying_condition in cursor:
+            if isinstance(death_day, datetime):
+                death_day = death_day.date()
+            deaths[death_day] = {
+                'certs_day_ic': int(as_immediate_cause),
+                'certs_day_uc': int(as_underlying_condition)}
+
+        return cls.get_day_series(
+            start_date, end_date, deaths,
+            {'certs_day_ic': 0, 'certs_day_uc': 0})
 
-        return(aggr)
+    @classmethod
+    def get_figure_key(cls, start_date, end_date, health_condition_id):
+        # Identifies the figures of the report in the figures cache
+        return (cls.__name__, start_date, end_date, health_condition_id)
 
     @classmethod
-    def plot_cases_timeseries(cls, start_date, end_date,
-                              health_condition_id, hc):
+    def get_cases_timeseries_figure(cls, start_date, end_date,
+                                    health_condition_id, hc):
 
         epi_series = cls.get_epi_by_day(start_date,
                                         end_date, health_condition_id)
@@ -206,24 +255,12 @@ class InstitutionEpidemicsReport(Report):
             # Confirmed cases by day
             cases_day.append(day['cases'])
 
-        fig = plt.figure(figsize=(6, 3))
-        cases_by_day = fig.add_subplot(1, 1, 1)
         title = 'New cases by day: ' + hc.rec_name
-        cases_by_day.set_title(title)
-        cases_by_day.bar(days, cases_day)
-        cases_by_day.yaxis.set_major_locator(MaxNLocator(integer=True))
-        fig.autofmt_xdate()
-
-        holder = io.BytesIO()
-        fig.savefig(holder, format="svg")
-        image_png = holder.getvalue()
-
-        holder.close()
-        return (image_png)
+        return ('bar', title, days, [(None, cases_day)])
 
     @classmethod
-    def plot_deaths_timeseries(cls, start_date,
-                               end_date, health_condition_id, hc):
+    def get_deaths_timeseries_figure(cls, start_date,
+                                     end_date, health_condition_id, hc):
 
         death_certs = cls.get_deaths_by_day(start_date,
                                             end_date, health_condition_id)
@@ -239,25 +276,13 @@ class InstitutionEpidemicsReport(Report):
             certs_uc_day.append(day['certs_day_uc'])
 
         title = "New deaths by day: " + hc.rec_name
-        fig = plt.figure(figsize=(6, 3))
-        deaths_by_day = fig.add_subplot(1, 1, 1)
-        deaths_by_day.set_title(title)
-        deaths_by_day.plot(days, certs_ic_day, label="immediate cause")
-        deaths_by_day.plot(days, certs_uc_day, label="underlying condition")
-        deaths_by_day.yaxis.set_major_locator(MaxNLocator(integer=True))
-        deaths_by_day.legend()
-
-        fig.autofmt_xdate()
-
-        holder = io.BytesIO()
-        fig.savefig(holder, format="svg")
-        image_png = holder.getvalue()
-
-        holder.close()
-        return (image_png)
+        return ('lines', title, days, [
+                ("immediate cause", certs_ic_day),
+                ("underlying condition", certs_uc_day)])
 
     @classmethod
-    def plot_cases_ethnicity(cls, start_date, end_date, ethnic_count, hc):
+    def get_cases_ethnicity_figure(cls, start_date, end_date,
+                                   ethnic_count, hc):
 
         for k, v in list(ethnic_count.items()):
             if (v == 0):
@@ -265,21 +290,51 @@ class InstitutionEpidemicsReport(Report):
                 del(ethnic_count[k])
 
         title = "Cases by ethnic group: " + hc.rec_name
-        fig = plt.figure(figsize=(6, 3))
-        cases_by_ethnicity = fig.add_subplot(1, 1, 1)
-        cases_by_ethnicity.set_title(title)
-        cases_by_ethnicity.pie(ethnic_count.values(),
-                               autopct='%1.1f%%',
-                               labels=ethnic_count.keys())
+        return ('pie', title, list(ethnic_count.keys()),
+                [(None, list(ethnic_count.values()))], '%1.1f%%')
 
-        fig.autofmt_xdate()
+    @classmethod
+    def get_cases_socioeconomics_figure(cls, start_date, end_date,
+                                        ses_count, hc):
 
-        holder = io.BytesIO()
-        fig.savefig(holder, format="svg")
-        image_png = holder.getvalue()
+        for k, v in list(ses_count.items()):
+            if (v == 0):
+                # Remove socioeconomic groups with zero cases from the plot
+                del(ses_count[k])
+
+        title = "Cases by Socioeconomic groups: " + hc.rec_name
+        return ('pie', title, list(ses_count.keys()),
+                [(None, list(ses_count.values()))], '%1.1f%%')
 
-        holder.close()
-        return (image_png)
+    @classmethod
+    def plot_cases_timeseries(cls, start_date, end_date,
+                              health_condition_id, hc):
+        figure = cls.get_cases_timeseries_figure(
+            start_date, end_date, health_condition_id, hc)
+        key = cls.get_figure_key(start_date, end_date, health_condition_id)
+        return render_figures({'figure': (key, figure)})['figure']
+
+    @classmethod
+    def plot_deaths_timeseries(cls, start_date,
+                               end_date, health_condition_id, hc):
+        figure = cls.get_deaths_timeseries_figure(
+            start_date, end_date, health_condition_id, hc)
+        key = cls.get_figure_key(start_date, end_date, health_condition_id)
+        return render_figures({'figure': (key, figure)})['figure']
+
+    @classmethod
+    def plot_cases_ethnicity(cls, start_date, end_date, ethnic_count, hc):
+        figure = cls.get_cases_ethnicity_figure(
+            start_date, end_date, ethnic_count, hc)
+        key = cls.get_figure_key(start_date, end_date, hc.id)
+        return render_figures({'figure': (key, figure)})['figure']
+
+    @classmethod
+    def plot_cases_socioeconomics(cls, start_date, end_date, ses_count, hc):
+        figure = cls.get_cases_socioeconomics_figure(
+            start_date, end_date, ses_count, hc)
+        key = cls.get_figure_key(start_date, end_date, hc.id)
+        return render_figures({'figure': (key, figure)})['figure']
 
     @classmethod
     def get_ethnic_groups(cls):
@@ -291,31 +346,6 @@ class InstitutionEpidemicsReport(Report):
             ethnicities.append(ethnic_group.name)
         return (ethnicities)
 
-    @classmethod
-    def plot_cases_socioeconomics(cls, start_date, end_date, ses_count, hc):
-
-        for k, v in list(ses_count.items()):
-            if (v == 0):
-                # Remove socioeconomic groups with zero cases from the plot
-                del(ses_count[k])
-
-        title = "Cases by Socioeconomic groups: " + hc.rec_name
-        fig = plt.figure(figsize=(6, 3))
-        cases_by_socioeconomics = fig.add_subplot(1, 1, 1)
-        cases_by_socioeconomics.set_title(title)
-        cases_by_socioeconomics.pie(ses_count.values(),
-                                    autopct='%1,1f%%',
-                                    labels=ses_count.keys())
-
-        fig.autofmt_xdate()
-
-        holder = io.BytesIO()
-        fig.savefig(holder, format="svg")
-        image_png = holder.getvalue()
-
-        holder.close()
-        return (image_png)
-
     @classmethod
     def get_context(cls, records, header, data):
 
@@ -353,8 +383,6 @@ class InstitutionEpidemicsReport(Report):
         context['health_condition'] = hc
 
         # Demographics
-        today = date.today()
-
         context[''.join(['p', 'total_', 'f'])] = \
             cls.get_population(None, None, 'f', total=True)
 
@@ -366,24 +394,17 @@ class InstitutionEpidemicsReport(Report):
             cls.get_population_with_no_dob()
 
         # Build the Population Pyramid for registered people
+        # Bands of 5 years, the last one for those lucky over 105 years old :)
+        pyramid = get_population_pyramid()
 
         for age_group in range(0, 21):
-            date1 = today - relativedelta(years=(age_group*5))
-            date2 = today - relativedelta(years=((age_group*5)+5), days=-1)
-
             context[''.join(['p', str(age_group), 'f'])] = \
-                cls.get_population(date1, date2, 'f', total=False)
+                pyramid[age_group].get('f', 0)
             context[''.join(['p', str(age_group), 'm'])] = \
-                cls.get_population(date1, date2, 'm', total=False)
+                pyramid[age_group].get('m', 0)
 
-        # Count those lucky over 105 years old :)
-        date1 = today - relativedelta(years=105)
-        date2 = today - relativedelta(years=200)
-
-        context['over105f'] = \
-            cls.get_population(date1, date2, 'f', total=False)
-        context['over105m'] = \
-            cls.get_population(date1, date2, 'm', total=False)
+        context['over105f'] = pyramid[21].get('f', 0)
+        context['over105m'] = pyramid[21].get('m', 0)
 
         # Count registered people, and those within the system of health
         context['new_people'] = \
@@ -439,7 +460,7 @@ class InstitutionEpidemicsReport(Report):
                 if (ses_id == '4'):
                     ses_count['upper'] += 1
 
-            if not confirmed_case.name.age:
+            if confirmed_case.name.age_years is None:
                 non_age_cases += 1
 
         total_cases = len(confirmed_cases)
@@ -454,10 +475,8 @@ class InstitutionEpidemicsReport(Report):
 
         for case in confirmed_cases:
 
-            if (case.name.age):
-
-                # Strip to get the raw year
-                age = int(case.name.age.split(' ')[0][:-1])
+            age = case.name.age_years
+            if (age is not None):
 
                 # Age groups in this diagnostic
                 if (age < 5):
@@ -496,26 +515,23 @@ class InstitutionEpidemicsReport(Report):
 
         context['epidemics_dx'] = epidemics_dx
 
-        # New cases by day
-        context['cases_timeseries'] = cls.plot_cases_timeseries(
-            start_date,
-            end_date,
-            health_condition_id, hc)
-
-        # Cases by ethnic groups
-        context['cases_ethnicity'] = cls.plot_cases_ethnicity(
-            start_date,
-            end_date, ethnic_count, hc)
-
-        # Cases by Socioeconomic groups
-        context['cases_ses'] = cls.plot_cases_socioeconomics(
-            start_date,
-            end_date, ses_count, hc)
-
-        # Death certificates by day
-        context['deaths_timeseries'] = cls.plot_deaths_timeseries(
-            start_date,
-            end_date,
-            health_condition_id, hc)
+        # Render the figures of the report in parallel.
+        # Those already printed with the same data come from the cache
+        key = cls.get_figure_key(start_date, end_date, health_condition_id)
+        figures = render_figures({
+            # New cases by day
+            'cases_timeseries': (key, cls.get_cases_timeseries_figure(
+                start_date, end_date, health_condition_id, hc)),
+            # Cases by ethnic groups
+            'cases_ethnicity': (key, cls.get_cases_ethnicity_figure(
+                start_date, end_date, ethnic_count, hc)),
+            # Cases by Socioeconomic groups
+            'cases_ses': (key, cls.get_cases_socioeconomics_figure(
+                start_date, end_date, ses_count, hc)),
+            # Death certificates by day
+            'deaths_timeseries': (key, cls.get_deaths_timeseries_figure(
+                start_date, end_date, health_condition_id, hc)),
+            })
+        context.update(figures)
 
         return context
@@ -0,0 +1,132 @@
+# SPDX-FileCopyrightText: 2008-2022 Luis Falcón <falcon@gnuhealth.org>
+# SPDX-FileCopyrightText: 2011-2022 GNU Solidario <health@gnusolidario.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Rendering of the report figures.
+# The figures are rendered from plain data in a pool of processes and
+# kept as PNG bytes in a LRU cache, so printing again the same report
+# does not plot them again.
+
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import io
+import logging
+import os
+import threading
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+
+from trytond.config import config
+
+from trytond.modules.health.workers import WorkerPool
+
+__all__ = ['render_figure', 'render_figures']
+
+logger = logging.getLogger(__name__)
+
+PLOT_WORKERS = config.getint(
+    'health_reporting', 'plot_workers', default=min(4, os.cpu_count() or 1))
+PLOT_CACHE_SIZE = config.getint(
+    'health_reporting', 'plot_cache_size', default=128)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_workers = WorkerPool(PLOT_WORKERS, preload=[
+        'matplotlib.figure', 'matplotlib.backends.backend_agg'])
+
+
+def render_figure(kind, title, labels, series, autopct=None):
+    """ Render a figure and return it as PNG bytes
+
+        kind: 'bar', 'lines' or 'pie'
+        labels: values of the X axis or labels of the pie
+        series: list of (label, values)
+    """
+    # Use the object API instead of pyplot, that keeps a global state
+    fig = Figure(figsize=(6, 3))
+    FigureCanvasAgg(fig)
+    plot = fig.add_subplot(1, 1, 1)
+    plot.set_title(title)
+
+    if kind == 'bar':
+        plot.bar(labels, series[0][1])
+        plot.yaxis.set_major_locator(MaxNLocator(integer=True))
+    elif kind == 'lines':
+        for label, values in series:
+            plot.plot(labels, values, label=label)
+        plot.yaxis.set_major_locator(MaxNLocator(integer=True))
+        plot.legend()
+    elif kind == 'pie':
+        plot.pie(series[0][1], autopct=autopct, labels=labels)
+
+    fig.autofmt_xdate()
+
+    holder = io.BytesIO()
+    fig.savefig(holder, format="png")
+    image_png = holder.getvalue()
+
+    holder.close()
+    return image_png
+
+
+def get_cache_key(key, figure):
+    # The fingerprint of the data makes the key change
+    # as soon as any of the plotted values changes
+    fingerprint = hashlib.sha1(repr(figure).encode('utf-8')).hexdigest()
+    return key + (fingerprint,)
+
+
+def render_figures(figures):
+    """ Render the figures that are not in the cache, in parallel
+
+        figures: dictionary name: (key, figure), where the key identifies
+            the figure (report, date range, pathology, ...) and figure
+            holds the arguments of render_figure.
+        Returns a dictionary name: PNG bytes
+    """
+    images = {}
+    to_render = {}
+
+    with _cache_lock:
+        for name, (key, figure) in figures.items():
+            cache_key = get_cache_key(key, figure)
+            if cache_key in _cache:
+                _cache.move_to_end(cache_key)
+                images[name] = _cache[cache_key]
+            else:
+                to_render[name] = (cache_key, figure)
+
+    if not to_render:
+        return images
+
+    executor = _workers.get()
+    rendered = {}
+    if executor and len(to_render) > 1:
+        try:
+            futures = {
+                name: executor.submit(render_figure, *figure)
+                for name, (cache_key, figure) in to_render.items()}
+            rendered = {
+                name: future.result() for name, future in futures.items()}
+        except BrokenProcessPool:
+            logger.warning("Plot workers unavailable, rendering locally")
+            _workers.reset()
+            rendered = {}
+
+    for name, (cache_key, figure) in to_render.items():
+        if name not in rendered:
+            rendered[name] = render_figure(*figure)
+
+    with _cache_lock:
+        for name, (cache_key, figure) in to_render.items():
+            _cache[cache_key] = rendered[name]
+            _cache.move_to_end(cache_key)
+        while len(_cache) > PLOT_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    images.update(rendered)
+    return images
@@ -7,12 +7,14 @@
 
 from sql.aggregate import Count
 from sql.functions import DateTrunc
-from datetime import date, datetime
+from datetime import datetime
 from trytond.report import Report
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from dateutil.relativedelta import relativedelta
 
+from trytond.modules.health.core import get_population_pyramid
+
 __all__ = ['InstitutionSummaryReport']
 
 
@@ -135,8 +137,6 @@ class InstitutionSummaryReport(Report):
         context['end_date'] = data['end_date']
 
         # Demographics
-        today = date.today()
-
         context[''.join(['p', 'total_', 'f'])] = \
             cls.get_population(None, None, 'f', total=True)
 
@@ -148,23 +148,17 @@ class InstitutionSummaryReport(Report):
             cls.get_population_with_no_dob()
 
         # Build the Population Pyramid for registered people
-        for age_group in range(0, 21):
-            date1 = today - relativedelta(years=(age_group*5))
-            date2 = today - relativedelta(years=((age_group*5)+5), days=-1)
+        # Bands of 5 years, the last one for those lucky over 105 years old :)
+        pyramid = get_population_pyramid()
 
+        for age_group in range(0, 21):
             context[''.join(['p', str(age_group), 'f'])] = \
-                cls.get_population(date1, date2, 'f', total=False)
+                pyramid[age_group].get('f', 0)
             context[''.join(['p', str(age_group), 'm'])] = \
-                cls.get_population(date1, date2, 'm', total=False)
-
-        # Count those lucky over 105 years old :)
-        date1 = today - relativedelta(years=105)
-        date2 = today - relativedelta(years=200)
+                pyramid[age_group].get('m', 0)
 
-        context['over105f'] = \
-            cls.get_population(date1, date2, 'f', total=False)
-        context['over105m'] = \
-            cls.get_population(date1, date2, 'm', total=False)
+        context['over105f'] = pyramid[21].get('f', 0)
+        context['over105m'] = pyramid[21].get('m', 0)
 
         # Count registered people, and those within the system of health
         context['new_people'] = \
@@ -4,8 +4,8 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from sql import Literal, Join
-from sql.aggregate import Max, Count
+from sql import Literal, Join, Null
+from sql.aggregate import Max, Count, Sum
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import Wizard, StateView, StateAction, StateTransition, \
     Button
@@ -154,6 +154,10 @@ class EvaluationsSector(ModelSQL, ModelView):
     @staticmethod
     def table_query():
         pool = Pool()
+        Cube = pool.get('gnuhealth.epidemiology.cube')
+        if Cube.covers(Transaction().context.get('end_date')):
+            return EvaluationsSector.cube_query()
+
         evaluation = pool.get('gnuhealth.patient.evaluation').__table__()
         party = pool.get('party.party').__table__()
         patient = pool.get('gnuhealth.patient').__table__()
@@ -168,12 +172,13 @@ class EvaluationsSector(ModelSQL, ModelView):
         join4 = Join(join3, sector)
         join4.condition = join4.right.id == join3.right.operational_sector
         where = Literal(True)
+        # Same day boundaries as the cube: the day of the evaluation
+        # in the institution timezone
+        _, day = Cube.fact_day('evaluation', evaluation)
         if Transaction().context.get('start_date'):
-            where &= evaluation.evaluation_start >= \
-                Transaction().context['start_date']
+            where &= day >= Transaction().context['start_date']
         if Transaction().context.get('end_date'):
-            where &= evaluation.evaluation_start <= \
-                Transaction().context['end_date']
+            where &= day <= Transaction().context['end_date']
 
         return join4.select(
             join4.right.id,
@@ -185,3 +190,25 @@ class EvaluationsSector(ModelSQL, ModelView):
             Count(join4.right.id).as_('evaluations'),
             where=where,
             group_by=join4.right.id)
+
+    @staticmethod
+    def cube_query():
+        # Read the evaluations from the pre-aggregated epidemiology cube
+        Cube = Pool().get('gnuhealth.epidemiology.cube')
+        cube = Cube.__table__()
+        where = ((cube.source == 'evaluation')
+            & (cube.operational_sector != Null))
+        if Transaction().context.get('start_date'):
+            where &= cube.day >= Transaction().context['start_date']
+        where &= cube.day <= Transaction().context['end_date']
+
+        return cube.select(
+            cube.operational_sector.as_('id'),
+            Max(cube.create_uid).as_('create_uid'),
+            Max(cube.create_date).as_('create_date'),
+            Max(cube.write_uid).as_('write_uid'),
+            Max(cube.write_date).as_('write_date'),
+            cube.operational_sector.as_('sector'),
+            Sum(cube.cases).as_('evaluations'),
+            where=where,
+            group_by=cube.operational_sector)
@@ -5,7 +5,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sql import Join, Null
-from sql.aggregate import Max, Count
+from sql.aggregate import Max, Count, Sum
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.pyson import PYSONEncoder
@@ -31,17 +31,22 @@ class TopDiseases(ModelSQL, ModelView):
     @staticmethod
     def table_query():
         pool = Pool()
+        Cube = pool.get('gnuhealth.epidemiology.cube')
+        if Cube.covers(Transaction().context.get('end_date')):
+            return TopDiseases.cube_query()
+
         Evaluation = pool.get('gnuhealth.patient.evaluation')
         evaluation = Evaluation.__table__()
         source = evaluation
         where = evaluation.diagnosis != Null
 
+        # Same day boundaries as the cube: the day of the evaluation
+        # in the institution timezone
+        _, day = Cube.fact_day('evaluation', evaluation)
         if Transaction().context.get('start_date'):
-            where &= evaluation.evaluation_start >= \
-                Transaction().context['start_date']
+            where &= day >= Transaction().context['start_date']
         if Transaction().context.get('end_date'):
-            where &= evaluation.evaluation_start <= \
-                Transaction().context['end_date']
+            where &= day <= Transaction().context['end_date']
         if Transaction().context.get('group'):
             DiseaseGroupMembers = pool.get('gnuhealth.disease_group.members')
             diseasegroupmembers = DiseaseGroupMembers.__table__()
@@ -66,6 +71,43 @@ class TopDiseases(ModelSQL, ModelView):
 
         return select
 
+    @staticmethod
+    def cube_query():
+        # Read the diagnoses from the pre-aggregated epidemiology cube
+        pool = Pool()
+        Cube = pool.get('gnuhealth.epidemiology.cube')
+        cube = Cube.__table__()
+        source = cube
+        where = (cube.source == 'evaluation') & (cube.pathology != Null)
+
+        if Transaction().context.get('start_date'):
+            where &= cube.day >= Transaction().context['start_date']
+        where &= cube.day <= Transaction().context['end_date']
+        if Transaction().context.get('group'):
+            DiseaseGroupMembers = pool.get('gnuhealth.disease_group.members')
+            diseasegroupmembers = DiseaseGroupMembers.__table__()
+            join = Join(cube, diseasegroupmembers)
+            join.condition = join.right.name == cube.pathology
+            where &= join.right.disease_group == Transaction().context['group']
+            source = join
+
+        select = source.select(
+            cube.pathology.as_('id'),
+            Max(cube.create_uid).as_('create_uid'),
+            Max(cube.create_date).as_('create_date'),
+            Max(cube.write_uid).as_('write_uid'),
+            Max(cube.write_date).as_('write_date'),
+            cube.pathology.as_('disease'),
+            Sum(cube.cases).as_('cases'),
+            where=where,
+            group_by=cube.pathology,
+            order_by=Sum(cube.cases).desc)
+
+        if Transaction().context.get('number_records'):
+            select.limit = Transaction().context['number_records']
+
+        return select
+
 
 class OpenTopDiseasesStart(ModelView):
     'Open Top Diseases'
@@ -4,7 +4,6 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import socketserver
 import socket
 import http.server
 import urllib.parse
@@ -12,14 +11,16 @@ import time
 import urllib.request, urllib.parse, urllib.error
 import logging
 import os
-from threading import local, Thread
+import gzip
+import queue
+from threading import local, Thread, Lock, BoundedSemaphore
 import xml.dom.minidom
 from base64 import decodebytes
 from pywebdav.lib import WebDAVServer, iface
 from pywebdav.lib.errors import DAV_Error, DAV_NotFound, DAV_Secret, \
     DAV_Forbidden, DAV_Requested_Range_Not_Satisfiable
 from pywebdav.lib.constants import COLLECTION, DAV_VERSION_1, DAV_VERSION_2
-from pywebdav.lib.utils import get_urifilename, quote_uri
+from pywebdav.lib.utils import get_urifilename, quote_uri, rfc1123_date
 from pywebdav.lib.davcmd import copyone, copytree, moveone, movetree, \
     delone, deltree
 from trytond.security import login
@@ -28,6 +29,10 @@ from trytond.transaction import Transaction
 from trytond.cache import Cache
 from trytond.config import config
 from trytond.exceptions import UserError, UserWarning, ConcurrencyException
+
+from .webdav import cache_statistics
+from .stream import FileRange, parse_range
+
 domimpl = xml.dom.minidom.getDOMImplementation()
 
 DAV_VERSION_1['version'] += ',access-control'
@@ -35,6 +40,19 @@ DAV_VERSION_2['version'] += ',access-control'
 
 logger = logging.getLogger(__name__)
 
+# Number of threads handling the connections
+WORKERS = config.getint('webdav', 'workers', default=16)
+# Number of connections waiting for a worker before answering 503
+QUEUE_SIZE = config.getint('webdav', 'queue_size', default=64)
+# Seconds an idle connection is kept alive
+KEEPALIVE_TIMEOUT = config.getint('webdav', 'keepalive_timeout', default=15)
+# Number of requests served on a connection before closing it
+KEEPALIVE_MAX = config.getint('webdav', 'keepalive_max', default=100)
+# Seconds spent on the TLS handshake of a connection rejected with 503
+REJECT_TIMEOUT = 1
+# Number of TLS connections rejected at once, the others are closed
+REJECT_THREADS = 8
+
 
 def SSLSocket(socket):
     # Let the import error raise only when used
@@ -59,6 +77,8 @@ def setupConfig():
         lockemulation = False
         verbose = False
         baseurl = ''
+        # Read the request bodies by chunks
+        http_request_use_iterator = True
 
         def getboolean(self, name):
             return bool(self.get(name))
@@ -72,10 +92,119 @@ def setupConfig():
     return Config()
 
 
-class BaseThreadedHTTPServer(socketserver.ThreadingMixIn,
-        http.server.HTTPServer):
+class WorkerPoolMixIn(object):
+    '''
+    Handle the connections with a fixed number of threads.
+    The accepted connections wait in a bounded queue and are answered with
+    503 when it is full, so the number of transactions is bounded.
+    '''
+    workers = WORKERS
+    queue_size = QUEUE_SIZE
+    reject_response = (b'HTTP/1.1 503 Service Unavailable\r\n'
+        b'Retry-After: 1\r\n'
+        b'Content-Length: 0\r\n'
+        b'Connection: close\r\n\r\n')
+
+    def start_workers(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._statistics_lock = Lock()
+        self._statistics = {
+            'requests': 0,
+            'rejected': 0,
+            'connections': 0,
+            'busy': 0,
+            'latency': 0.,
+            'max_latency': 0.,
+            'wait': 0.,
+            }
+        self._workers = []
+        for i in range(self.workers):
+            worker = Thread(target=self._work,
+                name='WebDAVWorker-%s' % i, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait(
+                (request, client_address, time.monotonic()))
+        except queue.Full:
+            with self._statistics_lock:
+                self._statistics['rejected'] += 1
+            logger.debug('Reject connection from %s', client_address)
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        "Answer 503 to the request and close it"
+        try:
+            request.sendall(self.reject_response)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def saturated(self):
+        "Return True if connections wait for a worker or none is free"
+        with self._statistics_lock:
+            busy = self._statistics['busy']
+        return not self._queue.empty() or busy >= len(self._workers)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            request, client_address, queued = item
+            with self._statistics_lock:
+                self._statistics['connections'] += 1
+                self._statistics['wait'] += time.monotonic() - queued
+                self._statistics['busy'] += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._statistics_lock:
+                    self._statistics['busy'] -= 1
+
+    def record_request(self, latency):
+        with self._statistics_lock:
+            self._statistics['requests'] += 1
+            self._statistics['latency'] += latency
+            self._statistics['max_latency'] = max(
+                self._statistics['max_latency'], latency)
+
+    def get_statistics(self):
+        "Return the queue depth, the busy workers and the request latencies"
+        with self._statistics_lock:
+            statistics = dict(self._statistics)
+        requests = statistics['requests']
+        statistics['latency'] = (
+            statistics['latency'] / requests if requests else 0.)
+        connections = statistics['connections']
+        statistics['wait'] = (
+            statistics['wait'] / connections if connections else 0.)
+        statistics['queue'] = self._queue.qsize()
+        statistics['workers'] = len(self._workers)
+        return statistics
+
+    def server_close(self):
+        super(WorkerPoolMixIn, self).server_close()
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+class BaseThreadedHTTPServer(WorkerPoolMixIn, http.server.HTTPServer):
     timeout = 1
 
+    def __init__(self, server_address, HandlerClass):
+        http.server.HTTPServer.__init__(self, server_address, HandlerClass)
+        self.start_workers()
+
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET,
                 socket.SO_REUSEADDR, 1)
@@ -92,11 +221,47 @@ class SecureThreadedHTTPServer(BaseThreadedHTTPServer):
         self.server_bind()
         self.server_activate()
 
+    def start_workers(self):
+        super(SecureThreadedHTTPServer, self).start_workers()
+        self._rejecting = BoundedSemaphore(REJECT_THREADS)
+
+    def reject_request(self, request):
+        # The TLS handshake is done by the workers, so the connections to
+        # reject are not wrapped yet. The handshake needed to send the 503 is
+        # done by a short-lived thread to not block the accepting thread, and
+        # the connections are closed without response when too many are
+        # already rejected.
+        if not self._rejecting.acquire(blocking=False):
+            self.shutdown_request(request)
+            return
+        try:
+            Thread(target=self._reject_secure, args=(request,),
+                name='WebDAVReject', daemon=True).start()
+        except RuntimeError:
+            self._rejecting.release()
+            self.shutdown_request(request)
+
+    def _reject_secure(self, request):
+        try:
+            request.settimeout(REJECT_TIMEOUT)
+            connection = SSLSocket(request)
+            try:
+                connection.sendall(self.reject_response)
+            finally:
+                connection.close()
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.shutdown_request(request)
+            self._rejecting.release()
+
 
 class WebDAVServerThread(Thread):
 
     def __init__(self, interface, port, secure=False):
         Thread.__init__(self, name='WebDAVServerThread')
+        self.interface = interface
+        self.port = port
         self.secure = secure
         self.ipv6 = False
         for family, _, _, _, _ in socket.getaddrinfo(interface or None, port,
@@ -119,6 +284,9 @@ class WebDAVServerThread(Thread):
         handler_class.IFACE_CLASS.baseurl = handler_class._config.DAV.baseurl
         self.server = server_class((interface, port), handler_class)
 
+    def statistics(self):
+        return self.server.get_statistics()
+
     def stop(self):
         self.server.shutdown()
         self.server.socket.shutdown(socket.SHUT_RDWR)
@@ -262,31 +430,29 @@ class TrytonDAVInterface(iface.dav_interface):
         pool = Pool(Transaction().database.name)
         Collection = pool.get('webdav.collection')
 
+        with_body = getattr(LOCAL, 'with_body', True)
         try:
-            res = Collection.get_data(dburi, cache=LOCAL.cache)
+            # The file store attachments are sent without being loaded
+            res = Collection.get_data_stream(dburi, range=range,
+                cache=LOCAL.cache, with_body=with_body)
+            if res is None:
+                res = Collection.get_data(dburi, cache=LOCAL.cache)
         except (DAV_Error, DAV_NotFound, DAV_Secret, DAV_Forbidden) as exception:
             self._log_exception(exception)
             raise
         except Exception as exception:
             self._log_exception(exception)
             raise DAV_Error(500)
-        if range is None:
+        if range is None or isinstance(res, FileRange) or not with_body:
             return res
-        size = len(res)
-        if range[1] == '':
-            range[1] = size
-        else:
-            range[1] = int(range[1])
-        if range[1] > size:
-            range[1] = size
-        if range[0] == '':
-            range[0] = size - range[1]
-        else:
-            range[0] = int(range[0])
-        if range[0] > size:
+        try:
+            bounds = parse_range(range, len(res))
+        except ValueError:
+            # An invalid range is ignored
+            return res
+        if bounds is None:
             raise DAV_Requested_Range_Not_Satisfiable
-
-        return res[range[0]:range[1]]
+        return res[bounds[0]:bounds[1]]
 
     def put(self, uri, data, content_type=''):
         dbname, dburi = self._get_dburi(uri)
@@ -396,7 +562,20 @@ class TrytonDAVInterface(iface.dav_interface):
         return res
 
     def _get_dav_getetag(self, uri):
-        return '"' + str(self.get_lastmodified(uri)) + '"'
+        dbname, dburi = self._get_dburi(uri)
+        if not dbname or not dburi:
+            return '"' + str(self.get_lastmodified(uri)) + '"'
+        pool = Pool(Transaction().database.name)
+        Collection = pool.get('webdav.collection')
+        try:
+            res = Collection.get_etag(dburi, cache=LOCAL.cache)
+        except (DAV_Error, DAV_NotFound, DAV_Secret, DAV_Forbidden) as exception:
+            self._log_exception(exception)
+            raise
+        except Exception as exception:
+            self._log_exception(exception)
+            raise DAV_Error(500)
+        return res
 
     def get_creationdate(self, uri):
         dbname, dburi = self._get_dburi(uri)
@@ -552,10 +731,34 @@ TrytonDAVInterface.PROPS['DAV:'] = tuple(list(TrytonDAVInterface.PROPS['DAV:']
 
 
 class WebDAVAuthRequestHandler(WebDAVServer.DAVRequestHandler):
+    # Keep the connections alive between the requests
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def setup(self):
+        WebDAVServer.DAVRequestHandler.setup(self)
+        self.request_count = 0
+
+    def handle_one_request(self):
+        # The transaction and the cache belong to one request because the
+        # connection and the thread serve many
+        start = time.monotonic()
+        self.raw_requestline = b''
+        try:
+            WebDAVServer.DAVRequestHandler.handle_one_request(self)
+        finally:
+            self.end_transaction()
+            LOCAL.cache.clear()
+            if self.raw_requestline:
+                self.server.record_request(time.monotonic() - start)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Cache statistics: %s', cache_statistics())
 
     def finish(self):
         WebDAVServer.DAVRequestHandler.finish(self)
+        self.end_transaction()
 
+    def end_transaction(self):
         if not Transaction().connection:
             return
         dbname = Transaction().database.name
@@ -565,9 +768,123 @@ class WebDAVAuthRequestHandler(WebDAVServer.DAVRequestHandler):
         #     with Transaction().start(dbname, 0):
         #         Cache.resets(dbname)
 
+    def do_GET(self):
+        if self.not_modified():
+            return 304
+        return WebDAVServer.DAVRequestHandler.do_GET(self)
+
+    def do_HEAD(self):
+        # The response has no body, so the data is not opened
+        LOCAL.with_body = False
+        try:
+            return WebDAVServer.DAVRequestHandler.do_HEAD(self)
+        finally:
+            LOCAL.with_body = True
+
+    def not_modified(self):
+        "Answer 304 if the resource matches the ETag of If-None-Match"
+        if 'If-None-Match' not in self.headers:
+            return False
+        dc = self.IFACE_CLASS
+        uri = urllib.parse.unquote(
+            urllib.parse.urljoin(self.get_baseuri(dc), self.path))
+        try:
+            etag = dc.get_prop(uri, 'DAV:', 'getetag')
+        except DAV_Error:
+            return False
+        matches = [m.strip() for m in self.headers['If-None-Match'].split(',')]
+        if etag not in matches:
+            return False
+        self.send_body(None, 304, headers={'ETag': etag})
+        self.log_request(304)
+        return True
+
+    def send_connection_header(self, code):
+        if (code or 200) >= 400 or self.request_count >= KEEPALIVE_MAX:
+            # The body of the request may not have been read
+            self.close_connection = True
+        elif self.server.saturated():
+            # An idle connection would keep the worker from the waiting ones
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Connection', 'keep-alive')
+            self.send_header('Keep-Alive', 'timeout=%s, max=%s' % (
+                    KEEPALIVE_TIMEOUT, KEEPALIVE_MAX - self.request_count))
+
+    def send_body(self, DATA, code=None, msg=None, desc=None,
+            ctype='application/octet-stream', headers={}):
+        "Send a body in one part with its exact length to keep the connection"
+        if code is not None and code < 200:
+            self.send_response_only(code, msg)
+            self.end_headers()
+            return
+        if DATA is None:
+            body = b''
+        elif isinstance(DATA, str):
+            body = DATA.encode('utf-8')
+        elif isinstance(DATA, bytes):
+            body = DATA
+        else:
+            body = b''.join(d.encode('utf-8') if isinstance(d, str) else d
+                for d in DATA)
+        accept_encoding = [e.strip()
+            for e in self.headers.get('Accept-Encoding', '').split(',')]
+        encoded = ('gzip' in accept_encoding
+            and len(body) > self.encode_threshold)
+        if encoded:
+            body = gzip.compress(body)
+
+        self.send_response(code, message=msg)
+        self.send_connection_header(code)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Date', rfc1123_date())
+        self._send_dav_version()
+        for key, value in headers.items():
+            if key.lower() not in {'connection', 'keep-alive'}:
+                self.send_header(key, value)
+        if encoded:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', len(body))
+        if body:
+            self.send_header('Content-Type', ctype)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_body_chunks_if_http11(self, DATA, code, msg=None, desc=None,
+            ctype='text/xml; encoding="utf-8"', headers={}):
+        if isinstance(DATA, FileRange):
+            return self.send_file_range(DATA, code, msg, ctype, headers)
+        return WebDAVServer.DAVRequestHandler.send_body_chunks_if_http11(
+            self, DATA, code, msg, desc, ctype, headers)
+
+    def send_file_range(self, DATA, code, msg=None,
+            ctype='application/octet-stream', headers={}):
+        "Send the file directly from the file store to the socket"
+        if not DATA.partial:
+            code = 200
+        self.send_response(code, message=msg)
+        self.send_connection_header(code)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Date', rfc1123_date())
+        self._send_dav_version()
+        for key, value in headers.items():
+            if key.lower() not in {'connection', 'keep-alive'}:
+                self.send_header(key, value)
+        if DATA.partial:
+            self.send_header('Content-Range', DATA.content_range)
+        self.send_header('Content-Length', len(DATA))
+        self.send_header('Content-Type', ctype)
+        self.end_headers()
+        self.wfile.flush()
+        DATA.send(self.connection)
+
     def parse_request(self):
         if not http.server.BaseHTTPRequestHandler.parse_request(self):
             return False
+        self.request_count += 1
 
         authorization = self.headers.get('Authorization', '')
         if authorization:
@@ -47,6 +47,7 @@ class GNUHealthWebdavServer(object):
             self.logger.info('using default configuration')
         self.logger.info('initialising distributed objects services')
         self.webdavd = []
+        self.rejected = {}
         self.options = options
 
         if time.tzname[0] != 'UTC':
@@ -75,6 +76,20 @@ class GNUHealthWebdavServer(object):
                 time.sleep(1)
             else:
                 time.sleep(60)
+            self.log_statistics()
+
+    def log_statistics(self):
+        "Log the queue depth and the latencies of the WebDAV servers"
+        for server in self.webdavd:
+            statistics = server.statistics()
+            # Warn only about the connections rejected since the last time
+            if statistics['rejected'] > self.rejected.get(server, 0):
+                level = logging.WARNING
+            else:
+                level = logging.DEBUG
+            self.rejected[server] = statistics['rejected']
+            self.logger.log(level, 'WebDAV %s:%s statistics: %s',
+                server.interface or '*', server.port, statistics)
 
     def start_servers(self):
         ssl = config.get('ssl', 'privatekey')
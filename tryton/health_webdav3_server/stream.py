@@ -0,0 +1,154 @@
+# SPDX-FileCopyrightText: 2017-2022 GNU Solidario <health@gnusolidario.org>
+# SPDX-FileCopyrightText: 2017-2022 Luis Falcon <falcon@gnuhealth.org>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Streaming access to the attachments kept in the file store
+
+The data is read and written by chunks directly in the files of the
+default trytond file store, so the memory used by a GET or a PUT does not
+depend on the size of the attachment.
+"""
+
+import filecmp
+import hashlib
+import mmap
+import os
+import random
+import tempfile
+
+from trytond.config import config
+from trytond.filestore import filestore, FileStore
+
+# Size of the chunks read from and written to the file store
+BUFFER_SIZE = config.getint('webdav', 'buffer_size', default=64 * 1024)
+
+
+def streamable():
+    "Return True if the files of the file store can be accessed directly"
+    return type(filestore) is FileStore
+
+
+def parse_range(range, size):
+    '''
+    Return the start and the end (excluded) of the HTTP byte range
+    or None if the range can not be satisfied
+    range is the [first, last] list of strings sent by the client
+    Raise ValueError for an invalid range, that must be ignored (RFC 7233)
+    '''
+    if len(range) != 2:
+        raise ValueError('Invalid range: %r' % (range,))
+    first, last = [int(x) if x.strip() else None for x in range]
+    if first is None:
+        if last is None:
+            raise ValueError('Invalid range: %r' % (range,))
+        # Suffix range: the last bytes of the file
+        if not last or not size:
+            return None
+        return max(size - last, 0), size
+    if last is not None and last < first:
+        raise ValueError('Invalid range: %r' % (range,))
+    if first >= size:
+        return None
+    end = size if last is None else min(last + 1, size)
+    return first, end
+
+
+class FileRange(object):
+    "A byte range of a file of the file store"
+
+    def __init__(self, file, start, end, size, partial=False):
+        self.file = file
+        self.start = start
+        self.end = end
+        self.size = size
+        self.partial = partial
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        if not len(self):
+            return
+        with mmap.mmap(self.file.fileno(), 0,
+                access=mmap.ACCESS_READ) as map_:
+            view = memoryview(map_)
+            try:
+                for offset in range(self.start, self.end, BUFFER_SIZE):
+                    yield bytes(view[offset:min(offset + BUFFER_SIZE,
+                                self.end)])
+            finally:
+                view.release()
+
+    @property
+    def content_range(self):
+        if not len(self):
+            return 'bytes */%s' % self.size
+        return 'bytes %s-%s/%s' % (self.start, self.end - 1, self.size)
+
+    def send(self, sock):
+        "Send the range on the socket without copying it in user space"
+        try:
+            if len(self):
+                sock.sendfile(self.file, self.start, len(self))
+        finally:
+            self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def open_range(file_id, prefix, range=None):
+    '''
+    Return the FileRange of the stored file for the HTTP range
+    or None if the range can not be satisfied
+    '''
+    file = open(filestore._filename(file_id, prefix), 'rb')
+    size = os.fstat(file.fileno()).st_size
+    if range is None:
+        return FileRange(file, 0, size, size)
+    try:
+        bounds = parse_range(range, size)
+    except ValueError:
+        # An invalid range is ignored and the whole file is sent
+        return FileRange(file, 0, size, size)
+    if bounds is None:
+        file.close()
+        return None
+    start, end = bounds
+    return FileRange(file, start, end, size, partial=True)
+
+
+def store_chunks(chunks, prefix):
+    '''
+    Write the chunks in the file store and return the file id
+    The id is computed like FileStore.set but without holding the data
+    '''
+    directory = os.path.join(
+        os.path.normpath(config.get('database', 'path')), prefix)
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.md5()
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as tmp:
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                tmp.write(chunk)
+        except Exception:
+            os.unlink(tmp.name)
+            raise
+    id_ = digest.hexdigest()
+    filename = filestore._filename(id_, prefix)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    while True:
+        if os.path.exists(filename):
+            if not filecmp.cmp(tmp.name, filename, shallow=False):
+                collision = random.randint(1, 1000000)
+                filename = filestore._filename(
+                    '%s-%s' % (id_, collision), prefix)
+                continue
+            os.unlink(tmp.name)
+        else:
+            os.replace(tmp.name, filename)
+        return os.path.basename(filename)
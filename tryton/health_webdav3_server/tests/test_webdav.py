@@ -6,9 +6,27 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import hashlib
+import http.server
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from trytond.modules.health_webdav3_server.protocol import (
+    BaseThreadedHTTPServer)
+from trytond.modules.health_webdav3_server.stream import (
+    open_range, parse_range, store_chunks)
+from trytond.modules.health_webdav3_server.webdav import cache_statistics
 
 
 class WebdavTestCase(ModuleTestCase):
@@ -16,8 +34,357 @@ class WebdavTestCase(ModuleTestCase):
     module = 'webdav'
 
 
+class WebdavCacheTestCase(ModuleTestCase):
+    'Test the caches shared by the WebDAV requests'
+    module = 'health_webdav3_server'
+
+    def lookups(self, name):
+        "Return the hits and misses counted so far by the cache"
+        statistics = cache_statistics()[name]
+        return statistics['hits'], statistics['misses']
+
+    def assertLookup(self, name, lookup, hits=0, misses=0):
+        "Check the hits and misses counted by the lookup"
+        before = self.lookups(name)
+        result = lookup()
+        after = self.lookups(name)
+        self.assertEqual(
+            (after[0] - before[0], after[1] - before[1]), (hits, misses))
+        return result
+
+    def resolve(self, uri, **counts):
+        Collection = Pool().get('webdav.collection')
+        return self.assertLookup('uri2object',
+            lambda: Collection._uri2object(uri), **counts)
+
+    def metadata(self, attachment, **counts):
+        Collection = Pool().get('webdav.collection')
+        return self.assertLookup('attachment',
+            lambda: Collection._get_attachment_metadata(attachment.id),
+            **counts)
+
+    @with_transaction()
+    def test_uri2object(self):
+        'Test the URI resolutions are kept between the resolutions'
+        Collection = Pool().get('webdav.collection')
+        collection, = Collection.create([{'name': 'Cache'}])
+
+        self.assertEqual(self.resolve('Cache', misses=1),
+            (Collection.__name__, collection.id))
+        self.assertEqual(self.resolve('Cache', hits=1),
+            (Collection.__name__, collection.id))
+
+        # The resolution depends on the access rights of the user
+        with Transaction().set_user(0):
+            self.resolve('Cache', misses=1)
+            self.resolve('Cache', hits=1)
+        self.resolve('Cache', hits=1)
+
+    @with_transaction()
+    def test_uri2object_collection_modified(self):
+        'Test the URI resolutions are cleared when a collection is modified'
+        Collection = Pool().get('webdav.collection')
+        collection, = Collection.create([{'name': 'Cache'}])
+        self.resolve('Cache', misses=1)
+
+        other, = Collection.create([{'name': 'Other'}])
+        self.resolve('Cache', misses=1)
+
+        Collection.write([collection], {'name': 'Renamed'})
+        self.assertEqual(self.resolve('Renamed', misses=1),
+            (Collection.__name__, collection.id))
+        self.assertNotEqual(self.resolve('Cache', misses=1),
+            (Collection.__name__, collection.id))
+        self.resolve('Renamed', hits=1)
+
+        Collection.delete([collection])
+        self.assertNotEqual(self.resolve('Renamed', misses=1),
+            (Collection.__name__, collection.id))
+        self.resolve('Other', misses=1)
+
+    @with_transaction()
+    def test_attachment_modified(self):
+        'Test the caches are cleared when an attachment is modified'
+        pool = Pool()
+        Collection = pool.get('webdav.collection')
+        Attachment = pool.get('ir.attachment')
+        collection, = Collection.create([{'name': 'Cache'}])
+        self.resolve('Cache', misses=1)
+
+        attachment, = Attachment.create([{
+                    'name': 'note.txt',
+                    'resource': str(collection),
+                    'data': b'note',
+                    }])
+        self.resolve('Cache', misses=1)
+        self.assertEqual(
+            self.metadata(attachment, misses=1)['contentlength'], '4')
+        self.assertEqual(
+            self.metadata(attachment, hits=1)['contentlength'], '4')
+
+        Attachment.write([attachment], {'data': b'longer note'})
+        self.resolve('Cache', misses=1)
+        self.assertEqual(
+            self.metadata(attachment, misses=1)['contentlength'], '11')
+        self.metadata(attachment, hits=1)
+
+        Attachment.delete([attachment])
+        self.resolve('Cache', misses=1)
+        self.assertIsNone(self.metadata(attachment, misses=1))
+
+    @with_transaction()
+    def test_cache_statistics(self):
+        'Test the ratio of the hits of the caches'
+        Collection = Pool().get('webdav.collection')
+        Collection.create([{'name': 'Cache'}])
+        self.resolve('Cache', misses=1)
+        for _ in range(3):
+            self.resolve('Cache', hits=1)
+
+        for statistics in cache_statistics().values():
+            lookups = statistics['hits'] + statistics['misses']
+            self.assertEqual(statistics['ratio'],
+                statistics['hits'] / lookups if lookups else 0.0)
+        self.assertGreater(cache_statistics()['uri2object']['ratio'], 0)
+
+
+class ParseRangeTestCase(unittest.TestCase):
+    'Test the parsing of the HTTP byte ranges'
+
+    def test_bounded(self):
+        'Test a range with first and last bytes'
+        self.assertEqual(parse_range(['0', '99'], 1000), (0, 100))
+        self.assertEqual(parse_range(['500', '599'], 1000), (500, 600))
+        self.assertEqual(parse_range(['900', '1999'], 1000), (900, 1000))
+        self.assertEqual(parse_range(['999', '999'], 1000), (999, 1000))
+
+    def test_open_end(self):
+        'Test a range up to the end of the file'
+        self.assertEqual(parse_range(['500', ''], 1000), (500, 1000))
+        self.assertEqual(parse_range(['0', ''], 1000), (0, 1000))
+
+    def test_suffix(self):
+        'Test a range of the last bytes of the file'
+        self.assertEqual(parse_range(['', '100'], 1000), (900, 1000))
+        self.assertEqual(parse_range(['', '5000'], 1000), (0, 1000))
+        self.assertIsNone(parse_range(['', '0'], 1000))
+
+    def test_not_satisfiable(self):
+        'Test a range that starts after the end of the file'
+        self.assertIsNone(parse_range(['1000', ''], 1000))
+        self.assertIsNone(parse_range(['1000', '1999'], 1000))
+
+    def test_empty_file(self):
+        'Test a range of an empty file'
+        self.assertIsNone(parse_range(['0', ''], 0))
+        self.assertIsNone(parse_range(['', '100'], 0))
+
+    def test_invalid(self):
+        'Test an invalid range is rejected to be ignored'
+        for range in [['500', '100'], ['', ''], ['a', '10'],
+                ['0', '10,20', '30']]:
+            with self.assertRaises(ValueError):
+                parse_range(range, 1000)
+
+
+class FileStoreStreamTestCase(unittest.TestCase):
+    'Test the streaming access to the file store'
+    prefix = 'test'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        path = config.get('database', 'path')
+        config.set('database', 'path', self.path)
+        self.addCleanup(config.set, 'database', 'path', path)
+
+    def stored(self):
+        "Return the names of the files of the store"
+        return sorted(name
+            for _, _, names in os.walk(os.path.join(self.path, self.prefix))
+            for name in names)
+
+    def read(self, file_id):
+        with open(filestore._filename(file_id, self.prefix), 'rb') as file:
+            return file.read()
+
+    def test_store_chunks(self):
+        'Test the chunks are stored in one file named by its digest'
+        data = b'0123456789' * 1000
+        file_id = store_chunks(
+            [data[i:i + 1024] for i in range(0, len(data), 1024)],
+            self.prefix)
+
+        self.assertEqual(file_id, hashlib.md5(data).hexdigest())
+        self.assertEqual(self.read(file_id), data)
+        self.assertEqual(self.stored(), [file_id])
+
+    def test_store_identical(self):
+        'Test storing again the same data keeps a single file'
+        file_id = store_chunks([b'same data'], self.prefix)
+        self.assertEqual(store_chunks([b'same ', 'data'], self.prefix),
+            file_id)
+        self.assertEqual(self.stored(), [file_id])
+
+    def test_store_collision(self):
+        'Test different data with the same digest is not overwritten'
+        data = b'new data'
+        file_id = hashlib.md5(data).hexdigest()
+        filename = filestore._filename(file_id, self.prefix)
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as file:
+            file.write(b'colliding data')
+
+        new_id = store_chunks([data], self.prefix)
+        self.assertNotEqual(new_id, file_id)
+        self.assertTrue(new_id.startswith(file_id + '-'))
+        self.assertEqual(self.read(new_id), data)
+        self.assertEqual(self.read(file_id), b'colliding data')
+        self.assertEqual(self.stored(), sorted([file_id, new_id]))
+
+    def test_open_range(self):
+        'Test opening the whole file or a range of it'
+        data = bytes(range(256)) * 1000
+        file_id = store_chunks([data], self.prefix)
+
+        whole = open_range(file_id, self.prefix)
+        self.addCleanup(whole.close)
+        self.assertFalse(whole.partial)
+        self.assertEqual(b''.join(whole), data)
+
+        part = open_range(file_id, self.prefix, ['1000', '70999'])
+        self.addCleanup(part.close)
+        self.assertTrue(part.partial)
+        self.assertEqual(len(part), 70000)
+        self.assertEqual(part.content_range, 'bytes 1000-70999/256000')
+        self.assertEqual(b''.join(part), data[1000:71000])
+
+        self.assertIsNone(
+            open_range(file_id, self.prefix, ['256000', '']))
+
+        # An invalid range is ignored
+        ignored = open_range(file_id, self.prefix, ['500', '100'])
+        self.addCleanup(ignored.close)
+        self.assertFalse(ignored.partial)
+        self.assertEqual(len(ignored), len(data))
+
+    def test_open_empty(self):
+        'Test opening an empty file'
+        file_id = store_chunks([], self.prefix)
+
+        empty = open_range(file_id, self.prefix)
+        self.addCleanup(empty.close)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(list(empty), [])
+        self.assertEqual(empty.content_range, 'bytes */0')
+        self.assertIsNone(open_range(file_id, self.prefix, ['0', '']))
+
+
+class BlockingHandler(http.server.BaseHTTPRequestHandler):
+    "Answer the requests once the server releases them"
+
+    def handle_one_request(self):
+        start = time.monotonic()
+        http.server.BaseHTTPRequestHandler.handle_one_request(self)
+        self.server.record_request(time.monotonic() - start)
+
+    def do_GET(self):
+        self.server.release.wait(10)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WorkerPoolServer(BaseThreadedHTTPServer):
+    workers = 1
+    queue_size = 1
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    'Test the connections served by the bounded worker pool'
+
+    def setUp(self):
+        self.server = WorkerPoolServer(('localhost', 0), BlockingHandler)
+        self.server.release = threading.Event()
+        thread = threading.Thread(target=self.server.serve_forever,
+            daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.release.set)
+
+    def request(self):
+        "Send a request and return the connection to read the response"
+        connection = socket.create_connection(self.server.server_address,
+            timeout=10)
+        self.addCleanup(connection.close)
+        connection.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        return connection
+
+    def response(self, connection):
+        data = b''
+        while True:
+            chunk = connection.recv(1024)
+            if not chunk:
+                return data
+            data += chunk
+
+    def wait_statistics(self, name, value):
+        "Wait for the statistic to reach the value"
+        for _ in range(100):
+            statistics = self.server.get_statistics()
+            if statistics[name] == value:
+                return statistics
+            time.sleep(0.05)
+        self.fail('%s is %s instead of %s' % (name, statistics[name], value))
+
+    def test_reject(self):
+        'Test the connections are answered with 503 when the queue is full'
+        served = self.request()
+        statistics = self.wait_statistics('busy', 1)
+        self.assertEqual(statistics['workers'], 1)
+        self.assertEqual(statistics['queue'], 0)
+
+        waiting = self.request()
+        self.wait_statistics('queue', 1)
+
+        rejected = self.request()
+        response = self.response(rejected)
+        self.assertTrue(
+            response.startswith(b'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertIn(b'Retry-After: 1\r\n', response)
+        statistics = self.server.get_statistics()
+        self.assertEqual(statistics['rejected'], 1)
+        self.assertEqual(statistics['queue'], 1)
+        self.assertEqual(statistics['requests'], 0)
+
+        self.server.release.set()
+        for connection in [served, waiting]:
+            self.assertTrue(
+                self.response(connection).startswith(b'HTTP/1.0 200 '))
+        statistics = self.wait_statistics('requests', 2)
+        self.assertEqual(statistics['queue'], 0)
+        self.assertEqual(statistics['connections'], 2)
+        self.assertEqual(statistics['rejected'], 1)
+        self.assertGreater(statistics['latency'], 0)
+        self.assertGreaterEqual(statistics['max_latency'],
+            statistics['latency'])
+        self.assertGreater(statistics['wait'], 0)
+
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
             WebdavTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            WebdavCacheTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            ParseRangeTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            FileStoreStreamTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            WorkerPoolTestCase))
     return suite
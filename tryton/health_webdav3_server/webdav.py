@@ -6,6 +6,7 @@
 
 import os
 import time
+import threading
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -18,6 +19,7 @@ from dateutil.relativedelta import relativedelta
 from sql.functions import Extract
 from sql.conditionals import Coalesce
 
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.tools import reduce_ids
 from trytond.transaction import Transaction
@@ -27,11 +29,38 @@ from trytond.pyson import Eval
 from trytond.tools import grouped_slice
 
 from .exceptions import InvalidAttachmentName
+from . import stream
 
 __all__ = [
     'Collection', 'Share', 'Attachment',
     ]
 
+# Size of the caches shared by the requests
+CACHE_SIZE = config.getint('webdav', 'cache_size', default=10240)
+
+_statistics = {
+    'uri2object': {'hits': 0, 'misses': 0},
+    'attachment': {'hits': 0, 'misses': 0},
+    }
+_statistics_lock = threading.Lock()
+
+
+def record_lookup(cache_name, hits=0, misses=0):
+    with _statistics_lock:
+        _statistics[cache_name]['hits'] += hits
+        _statistics[cache_name]['misses'] += misses
+
+
+def cache_statistics():
+    "Return the hits, misses and hit ratio of the caches shared by requests"
+    with _statistics_lock:
+        result = {}
+        for name, counters in _statistics.items():
+            lookups = counters['hits'] + counters['misses']
+            result[name] = dict(counters,
+                ratio=counters['hits'] / lookups if lookups else 0.0)
+        return result
+
 
 def get_webdav_url():
     if config.get('ssl', 'privatekey'):
@@ -61,6 +90,12 @@ class Collection(ModelSQL, ModelView):
     domain = fields.Char('Domain')
     complete_name = fields.Function(fields.Char('Complete Name'),
                                     'get_rec_name')
+    # URI resolutions and attachments metadata, kept between the requests
+    # and cleared by the writes on the collections and the attachments
+    _uri2object_cache = Cache('webdav_collection.uri2object',
+                              size_limit=CACHE_SIZE, context=False)
+    _attachment_cache = Cache('webdav_collection.attachment',
+                              size_limit=CACHE_SIZE, context=False)
 
     @classmethod
     def __setup__(cls):
@@ -90,6 +125,27 @@ class Collection(ModelSQL, ModelView):
         else:
             return self.name
 
+    @classmethod
+    def create(cls, vlist):
+        collections = super(Collection, cls).create(vlist)
+        cls._uri2object_cache.clear()
+        return collections
+
+    @classmethod
+    def write(cls, *args):
+        super(Collection, cls).write(*args)
+        cls._uri2object_cache.clear()
+
+    @classmethod
+    def delete(cls, collections):
+        super(Collection, cls).delete(collections)
+        cls._uri2object_cache.clear()
+
+    @classmethod
+    def clear_cache(cls):
+        cls._uri2object_cache.clear()
+        cls._attachment_cache.clear()
+
     @classmethod
     def validate(cls, collections):
         super(Collection, cls).validate(collections)
@@ -116,6 +172,31 @@ class Collection(ModelSQL, ModelView):
     @classmethod
     def _uri2object(cls, uri, object_name=__name__, object_id=None,
                     cache=None):
+        # Only the resolutions from the root are shared between the
+        # requests, the others are steps of the recursion
+        if object_name != cls.__name__ or object_id is not None:
+            return cls._resolve_uri(uri, object_name, object_id, cache=cache)
+
+        if cache is not None:
+            cache.setdefault('_uri2object', {})
+            if uri in cache['_uri2object']:
+                return cache['_uri2object'][uri]
+
+        # The resolution depends on the access rights of the user
+        key = (Transaction().user, uri)
+        res = cls._uri2object_cache.get(key)
+        if res is not None:
+            record_lookup('uri2object', hits=1)
+        else:
+            record_lookup('uri2object', misses=1)
+            res = cls._resolve_uri(uri, object_name, object_id, cache=cache)
+            cls._uri2object_cache.set(key, res)
+        if cache is not None:
+            cache['_uri2object'][uri] = res
+        return res
+
+    @classmethod
+    def _resolve_uri(cls, uri, object_name, object_id, cache=None):
         pool = Pool()
         Attachment = pool.get('ir.attachment')
         Report = pool.get('ir.action.report')
@@ -373,40 +454,77 @@ class Collection(ModelSQL, ModelView):
         return Model(object_id).rec_name
 
     @classmethod
-    def get_contentlength(cls, uri, cache=None):
+    def _get_attachment_metadata(cls, object_id, cache=None):
+        '''
+        Return the content length, creation and last modification dates of
+        the attachment.
+        The attachments listed in the request are fetched at once and their
+        metadata is kept in the request cache, so each of them is looked up
+        only once per request.
+        '''
         pool = Pool()
         Attachment = pool.get('ir.attachment')
 
-        object_name, object_id = cls._uri2object(uri, cache=cache)
-        if object_name == 'ir.attachment':
-
-            if cache is not None:
-                cache.setdefault('ir.attachment', {})
-                ids = list(cache['ir.attachment'].keys())
-                if object_id not in ids:
-                    ids.append(object_id)
-                elif 'contentlength' in cache['ir.attachment'][object_id]:
-                    return cache['ir.attachment'][object_id]['contentlength']
+        ids = [object_id]
+        if cache is not None:
+            attachments = cache.setdefault(Attachment.__name__, {})
+            entry = attachments.setdefault(object_id, {})
+            if 'metadata' in entry:
+                return entry['metadata']
+            ids.extend(i for i, e in attachments.items()
+                       if i != object_id and 'metadata' not in e)
+
+        metadata = {}
+        missing = []
+        for attachment_id in ids:
+            value = cls._attachment_cache.get(attachment_id)
+            if value is not None:
+                metadata[attachment_id] = value
             else:
-                ids = [object_id]
-
-            attachments = Attachment.browse(ids)
-
-            res = '0'
-            for attachment in attachments:
+                missing.append(attachment_id)
+        record_lookup('attachment', hits=len(metadata), misses=len(missing))
+
+        if missing:
+            cursor = Transaction().connection.cursor()
+            table = Attachment.__table__()
+            for sub_ids in grouped_slice(missing):
+                red_sql = reduce_ids(table.id, sub_ids)
+                cursor.execute(*table.select(table.id,
+                                             Extract('EPOCH',
+                                                     table.create_date),
+                                             Extract('EPOCH', Coalesce(
+                                                 table.write_date,
+                                                 table.create_date)),
+                                             where=red_sql))
+                for attachment_id, creationdate, lastmodified in cursor:
+                    metadata[attachment_id] = {
+                        'creationdate': creationdate,
+                        'lastmodified': lastmodified,
+                        }
+            for attachment in Attachment.browse(
+                    [i for i in missing if i in metadata]):
                 size = '0'
                 try:
                     if attachment.data_size:
                         size = str(attachment.data_size)
                 except Exception:
                     pass
-                if attachment.id == object_id:
-                    res = size
-                if cache is not None:
-                    cache['ir.attachment'].setdefault(attachment.id, {})
-                    cache['ir.attachment'][attachment.id]['contentlength'] = \
-                        size
-            return res
+                metadata[attachment.id]['contentlength'] = size
+                cls._attachment_cache.set(attachment.id,
+                                          metadata[attachment.id])
+        if cache is not None:
+            for attachment_id in ids:
+                attachments.setdefault(attachment_id, {})['metadata'] = (
+                    metadata.get(attachment_id))
+        return metadata.get(object_id)
+
+    @classmethod
+    def get_contentlength(cls, uri, cache=None):
+        object_name, object_id = cls._uri2object(uri, cache=cache)
+        if object_name == 'ir.attachment' and object_id:
+            metadata = cls._get_attachment_metadata(object_id, cache=cache)
+            if metadata:
+                return metadata['contentlength']
         return '0'
 
     @classmethod
@@ -421,79 +539,26 @@ class Collection(ModelSQL, ModelView):
 
     @classmethod
     def get_creationdate(cls, uri, cache=None):
-        pool = Pool()
         object_name, object_id = cls._uri2object(uri, cache=cache)
-        if object_name == 'ir.attachment':
-            Model = pool.get(object_name)
-            if object_id:
-                if cache is not None:
-                    cache.setdefault(Model.__name__, {})
-                    ids = list(cache[Model.__name__].keys())
-                    if object_id not in ids:
-                        ids.append(object_id)
-                    elif 'creationdate' in cache[Model.__name__][object_id]:
-                        return cache[Model.__name__][object_id][
-                            'creationdate']
-                else:
-                    ids = [object_id]
-                res = None
-                cursor = Transaction().connection.cursor()
-                table = Model.__table__()
-                for sub_ids in grouped_slice(ids):
-                    red_sql = reduce_ids(table.id, sub_ids)
-                    cursor.execute(*table.select(table.id,
-                                                 Extract('EPOCH',
-                                                         table.create_date),
-                                                 where=red_sql))
-                    for object_id2, date in cursor.fetchall():
-                        if object_id2 == object_id:
-                            res = date
-                        if cache is not None:
-                            cache[Model.__name__].setdefault(object_id2, {})
-                            cache[Model.__name__][object_id2][
-                                'creationdate'] = date
-                if res is not None:
-                    return res
+        if object_name == 'ir.attachment' and object_id:
+            metadata = cls._get_attachment_metadata(object_id, cache=cache)
+            if metadata and metadata['creationdate'] is not None:
+                return metadata['creationdate']
         return time.time()
 
     @classmethod
     def get_lastmodified(cls, uri, cache=None):
-        pool = Pool()
         object_name, object_id = cls._uri2object(uri, cache=cache)
-        if object_name == 'ir.attachment':
-            Model = pool.get(object_name)
-            if object_id:
-                if cache is not None:
-                    cache.setdefault(Model.__name__, {})
-                    ids = list(cache[Model.__name__].keys())
-                    if object_id not in ids:
-                        ids.append(object_id)
-                    elif 'lastmodified' in cache[Model.__name__][object_id]:
-                        return cache[Model.__name__][object_id][
-                            'lastmodified']
-                else:
-                    ids = [object_id]
-                res = None
-                cursor = Transaction().connection.cursor()
-                table = Model.__table__()
-                for sub_ids in grouped_slice(ids):
-                    red_sql = reduce_ids(table.id, sub_ids)
-                    cursor.execute(*table.select(table.id,
-                                                 Extract('EPOCH', Coalesce(
-                                                     table.write_date,
-                                                     table.create_date)),
-                                                 where=red_sql))
-                    for object_id2, date in cursor.fetchall():
-                        if object_id2 == object_id:
-                            res = date
-                        if cache is not None:
-                            cache[Model.__name__].setdefault(object_id2, {})
-                            cache[Model.__name__][object_id2][
-                                'lastmodified'] = date
-                if res is not None:
-                    return res
+        if object_name == 'ir.attachment' and object_id:
+            metadata = cls._get_attachment_metadata(object_id, cache=cache)
+            if metadata and metadata['lastmodified'] is not None:
+                return metadata['lastmodified']
         return time.time()
 
+    @classmethod
+    def get_etag(cls, uri, cache=None):
+        return '"%s"' % cls.get_lastmodified(uri, cache=cache)
+
     @classmethod
     def get_data(cls, uri, cache=None):
         from pywebdav.lib.errors import DAV_NotFound
@@ -547,6 +612,64 @@ class Collection(ModelSQL, ModelView):
                     return val[1]
         raise DAV_NotFound
 
+    @classmethod
+    def get_data_stream(cls, uri, range=None, cache=None, with_body=True):
+        '''
+        Return a stream.FileRange of the attachment kept in the file store
+        or None if the data must be read with get_data.
+        Without body (HEAD request) the file is not opened and an empty
+        string is returned.
+        '''
+        from pywebdav.lib.errors import DAV_NotFound, \
+            DAV_Requested_Range_Not_Satisfiable
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+
+        if not uri or not Attachment.data.file_id or not stream.streamable():
+            return None
+        object_name, object_id = cls._uri2object(uri, cache=cache)
+        if object_name != 'ir.attachment' or not object_id:
+            return None
+        try:
+            file_id = Attachment(object_id).file_id
+        except Exception:
+            raise DAV_NotFound
+        if not file_id:
+            return None
+        if not with_body:
+            return ''
+        try:
+            res = stream.open_range(file_id, cls._store_prefix(), range)
+        except (OSError, ValueError):
+            raise DAV_NotFound
+        if res is None:
+            raise DAV_Requested_Range_Not_Satisfiable
+        return res
+
+    @staticmethod
+    def _store_prefix():
+        Attachment = Pool().get('ir.attachment')
+        prefix = Attachment.data.store_prefix
+        if prefix is None:
+            prefix = Transaction().database.name
+        return prefix
+
+    @classmethod
+    def _data_values(cls, data):
+        '''
+        Return the attachment values to store the data
+        The data is either bytes or an iterable of chunks which are written
+        directly in the file store when possible.
+        '''
+        Attachment = Pool().get('ir.attachment')
+        if data is None or isinstance(data, (bytes, str)):
+            return {'data': data}
+        if Attachment.data.file_id and stream.streamable():
+            return {
+                'file_id': stream.store_chunks(data, cls._store_prefix()),
+                }
+        return {'data': b''.join(data)}
+
     @classmethod
     def put(cls, uri, data, content_type, cache=None):
         from pywebdav.lib.errors import DAV_Forbidden
@@ -560,21 +683,22 @@ class Collection(ModelSQL, ModelView):
         pool = Pool()
         Attachment = pool.get('ir.attachment')
         object_name2, object_id2 = cls._uri2object(uri, cache=cache)
+        try:
+            values = cls._data_values(data)
+        except OSError:
+            raise DAV_Forbidden
         if not object_id2:
             name = get_urifilename(uri)
             try:
-                Attachment.create([{
-                            'name': name,
-                            'data': data,
-                            'resource': '%s,%s' % (object_name, object_id),
-                            }])
+                Attachment.create([dict(values,
+                            name=name,
+                            resource='%s,%s' % (object_name, object_id),
+                            )])
             except Exception:
                 raise DAV_Forbidden
         else:
             try:
-                Attachment.write(object_id2, {
-                    'data': data,
-                    })
+                Attachment.write([Attachment(object_id2)], values)
             except Exception:
                 raise DAV_Forbidden
         return
@@ -711,6 +835,22 @@ class Attachment(ModelSQL, ModelView):
                                              depends=['path']),
                              'get_shares', 'set_shares')
 
+    @classmethod
+    def create(cls, vlist):
+        attachments = super(Attachment, cls).create(vlist)
+        Pool().get('webdav.collection').clear_cache()
+        return attachments
+
+    @classmethod
+    def write(cls, *args):
+        super(Attachment, cls).write(*args)
+        Pool().get('webdav.collection').clear_cache()
+
+    @classmethod
+    def delete(cls, attachments):
+        super(Attachment, cls).delete(attachments)
+        Pool().get('webdav.collection').clear_cache()
+
     @classmethod
     def validate(cls, attachments):
         super(Attachment, cls).validate(attachments)